@@ -20,7 +20,27 @@
 
 __version__ = '2024/12/02 v1.4.1'
 
-import argparse, re, sys, pathlib, os
+import argparse, re, sys, pathlib, os, time
+from memoize_mmz import parse_mmz, Prefix, Memo, Extern, ENDINPUT
+
+# The arguments of |--max-size| and |--max-age|: a number with an optional
+# unit suffix.
+def size_type(size):
+    if not (m := re.fullmatch(r'([0-9]+(?:\.[0-9]*)?)([KMGT]?)', size.upper())):
+        raise argparse.ArgumentTypeError(f"invalid size: '{size}'")
+    return float(m[1]) * 1024 ** ' KMGT'.index(m[2] or ' ')
+
+def age_type(age):
+    if not (m := re.fullmatch(r'([0-9]+(?:\.[0-9]*)?)([smhdw]?)', age)):
+        raise argparse.ArgumentTypeError(f"invalid age: '{age}'")
+    return float(m[1]) * {'s': 1, 'm': 60, 'h': 3600, '': 86400, 'd': 86400,
+                          'w': 7 * 86400}[m[2]]
+
+# The argument of |--jobs|: a non-negative number.
+def jobs_type(jobs):
+    if not re.fullmatch(r'[0-9]+', jobs):
+        raise argparse.ArgumentTypeError(f"invalid number of jobs: '{jobs}'")
+    return int(jobs)
 
 parser = argparse.ArgumentParser(
     description="Remove (stale) memo and extern files.",
@@ -34,29 +54,58 @@ parser.add_argument('--all', '-a', action = 'store_true',
 parser.add_argument('--quiet', '-q', action = 'store_true')
 parser.add_argument('--prefix', '-p', action = 'append', default = [],
     help = 'A path prefix to clean; this option can be specified multiple times.')
+parser.add_argument('--catalog', action = 'store_true',
+    help = 'Find the memos and externs in the catalog of the memo directory, '
+           'rather than by listing the directory.')
+parser.add_argument('--rebuild-catalog', action = 'store_true',
+    help = 'Regenerate the catalog from the directory (implies --catalog).')
+parser.add_argument('--stats', action = 'store_true',
+    help = 'Show the catalogued memos and externs (implies --catalog), '
+           'instead of cleaning.')
+parser.add_argument('--jobs', '-j', type = jobs_type, default = 1, metavar = 'N',
+    help = 'Read the .mmz files and delete the files using N threads '
+           '(0 = a default number).')
+parser.add_argument('--plan', choices = ['text', 'json'],
+    help = 'Show what would be deleted, with the total size, and exit.')
+parser.add_argument('--max-size', type = size_type, metavar = 'SIZE',
+    help = 'Rather than removing the stale files, keep the memos and externs '
+           'within SIZE bytes (suffixes K, M, G and T allowed), evicting the '
+           'least recently used ones.')
+parser.add_argument('--max-age', type = age_type, metavar = 'AGE',
+    help = 'Rather than removing the stale files, evict the memos and externs '
+           'not used in AGE days (suffixes s, m, h, d and w allowed).')
+parser.add_argument('--gc-store', metavar = 'DIR',
+    help = 'Rather than cleaning the documents, remove the entries of the '
+           'global store DIR which no document uses.')
 parser.add_argument('mmz', nargs= '*', help='.mmz record files')
 parser.add_argument('--version', '-V', action = 'version',
                     version = f"%(prog)s of Memoize " + __version__)
 args = parser.parse_args()
-
-re_prefix = re.compile(r'\\mmzPrefix *{(.*?)}')
-re_memo = re.compile(r'%? *\\mmz(?:New|Used)(?:CC?Memo|Extern) *{(.*?)}')
-re_endinput = re.compile(r' *\\endinput *$')
-
-prefixes = set(pathlib.Path(prefix).resolve() for prefix in args.prefix)
-keep = set()
+args.catalog = args.catalog or args.rebuild_catalog or args.stats
+budget = args.max_size is not None or args.max_age is not None
+if budget and args.all:
+    parser.error('options --max-size and --max-age cannot be used with --all')
+if args.gc_store and (budget or args.all):
+    parser.error('option --gc-store cannot be used with --all, --max-size '
+                 'and --max-age')
 
 # We loop through the given .mmz files, adding prefixes to whatever manually
-# specified by the user, and collecting the files to keep.
-for mmz_fn in args.mmz:
+# specified by the user, and collecting the files to keep.  Function
+# |read_mmz| reads a single file, returning its prefixes and the files it uses
+# (along with whether they are new), so that several files can be read
+# concurrently; the results are merged in the order of the files.
+def read_mmz(mmz_fn):
     mmz = pathlib.Path(mmz_fn)
     mmz_parent = mmz.parent.resolve()
+    mmz_prefixes = []
+    used = []
     try:
         with open(mmz) as mmz_fh:
+            last_used = os.stat(mmz_fh.fileno()).st_mtime
             prefix = ''
             endinput = False
             empty = None
-            for line in mmz_fh:
+            for line, record in parse_mmz(mmz_fh):
                 line = line.strip()
                 
                 if not line:
@@ -67,24 +116,25 @@ for mmz_fn in args.mmz:
                         rf'Bailing out, '
                         rf'\endinput is not the last line of file {mmz_fn}.')
                 
-                elif m := re_prefix.match(line):
-                    prefix = m[1]
-                    prefixes.add( (mmz_parent/prefix).resolve() )
+                elif isinstance(record, Prefix):
+                    prefix = record.path
+                    mmz_prefixes.append( (mmz_parent/prefix).resolve() )
                     if empty is None:
                         empty = True
 
-                elif m := re_memo.match(line):
+                elif isinstance(record, (Memo, Extern)):
+                    path = record.path
                     if not prefix:
                         raise RuntimeError(
-                            f'Bailing out, no prefix announced before file "{m[1]}".')
-                    if not m[1].startswith(prefix):
+                            f'Bailing out, no prefix announced before file "{path}".')
+                    if not path.startswith(prefix):
                         raise RuntimeError(
-                            f'Bailing out, prefix of file "{m[1]}" does not match '
+                            f'Bailing out, prefix of file "{path}" does not match '
                             f'the last announced prefix ({prefix}).')
-                    keep.add((mmz_parent / m[1]))
+                    used.append((mmz_parent / path, record.new))
                     empty = False
 
-                elif re_endinput.match(line):
+                elif record is ENDINPUT:
                     endinput = True
                     continue
 
@@ -105,28 +155,221 @@ for mmz_fn in args.mmz:
     # It is not an error if the file doesn't exist.
     # Otherwise, cleaning from scripts would be cumbersome.
     except FileNotFoundError:
-        pass
+        return
+    return mmz_prefixes, (mmz.resolve(), last_used, used)
+
+# With |--jobs|, the .mmz files are read, and the files deleted, by a pool of
+# threads.  (The time is mostly spent waiting for the file system.)
+if args.jobs != 1:
+    from concurrent.futures import ThreadPoolExecutor
+    pool = ThreadPoolExecutor(args.jobs or None)
+    pmap = pool.map
+else:
+    pool = None
+    pmap = map
+
+prefixes = set(pathlib.Path(prefix).resolve() for prefix in args.prefix)
+keep = set()
+# For the catalog: the |.mmz| files, with their modification time and the
+# memos and externs they use (and whether they are new).
+documents = []
+for result in pmap(read_mmz, args.mmz):
+    if result:
+        mmz_prefixes, document = result
+        prefixes.update(mmz_prefixes)
+        keep.update(path for path, new in document[2])
+        documents.append(document)
+
+# With |--catalog|, the memos and externs are looked up in the catalogs (see
+# |memoize_catalog.py|) of the directories holding them: the directories given
+# as prefixes, and the directories containing the basename prefixes.  A
+# missing catalog is created by rebuilding it from the directory.  Elsewhere,
+# we only use the catalog if it exists.
+catalogs = {}
+homes = set(prefix if prefix.is_dir() else prefix.parent for prefix in prefixes)
+def catalog(folder):
+    if folder not in catalogs:
+        catalogs[folder] = None
+        exists = (folder / CATALOG_NAME).exists()
+        if exists or folder in homes and folder.is_dir():
+            catalogs[folder] = Catalog(folder)
+            if not exists or args.rebuild_catalog:
+                n = catalogs[folder].rebuild()
+                if not args.quiet:
+                    print(f"Catalogued {n} files in {folder}")
+    return catalogs[folder]
+
+if args.catalog:
+    from memoize_catalog import Catalog, CATALOG_NAME
+    for folder in homes:
+        catalog(folder)
+    # Record the memos and externs used by the documents.
+    for mmz, last_used, used in documents:
+        folders = {}
+        for path, new in used:
+            names, new_names = folders.setdefault(path.parent, ([], set()))
+            names.append(path.name)
+            if new:
+                new_names.add(path.name)
+        for folder, (names, new_names) in folders.items():
+            if c := catalog(folder):
+                c.record(names, str(mmz), last_used, new_names)
+
+if args.stats:
+    for folder, c in sorted(catalogs.items()):
+        if c:
+            print(f"Catalog {folder / CATALOG_NAME}:")
+            for document, kind, count, size, last_used in c.stats():
+                print(f"  {document or '(unknown document)'}: "
+                      f"{count} {kind} files, {size} bytes")
+    sys.exit()
+
+# "prefix" is interpreted both as a directory (if it exists) and a basename
+# prefix.  We group the basename prefixes by their directory, so that every
+# directory is listed only once, however many documents share it.
+folders = {}
+for prefix in prefixes:
+    if prefix.is_dir():
+        folders.setdefault(prefix, set()).add('')
+    folders.setdefault(prefix.parent, set()).add(prefix.name)
+
+# The names of the files to keep, by directory.
+keep_names = {}
+for f in keep:
+    keep_names.setdefault(f.parent, set()).add(f.name)
 
 tbdeleted = []
-def populate_tbdeleted(folder, basename_prefix):
+# With |--max-size| or |--max-age|, all the memos and externs are candidates
+# for eviction: we collect them with their group, i.e.\ the path prefix
+# followed by the MD5 sum of the code, which is shared by a c-memo and its
+# cc-memos and externs.
+candidates = []
+def populate_tbdeleted(folder, basename_prefixes):
+    # A single regular expression matches the memos and externs of all the
+    # basename prefixes.
     re_aux = re.compile(
-        re.escape(basename_prefix) + 
-        r'[0-9A-F]{32}(?:-[0-9A-F]{32})?'
+        '(?P<group>(?:' + '|'.join(re.escape(basename_prefix)
+                                   for basename_prefix in basename_prefixes)
+        + ')[0-9A-F]{32})(?:-[0-9A-F]{32})?'
         r'(?:-[0-9]+)?(?:\.memo|(?:-[0-9]+)?\.pdf|\.log)$')
+    if args.catalog and (c := catalog(folder)):
+        names = c.names(os.path.commonprefix(list(basename_prefixes)))
+    else:
+        try:
+            with os.scandir(folder) as it:
+                names = [entry.name for entry in it]
+        except FileNotFoundError:
+            return
+    if budget:
+        candidates.extend((folder, name, m['group']) for name in names
+                          if (m := re_aux.match(name)))
+        return
+    keep_here = set() if args.all else keep_names.get(folder, set())
+    tbdeleted.extend(folder / name for name in names
+                     if re_aux.match(name) and name not in keep_here)
+
+# With |--gc-store|, we rather collect the garbage in the global store
+# maintained by |memoize-extract.py --store|.  An entry of the store is
+# referenced by its hard links outside the store, and by the copies listed in
+# its |.refs| file; it is garbage if it has no such hard link and none of the
+# listed copies exists anymore.  Several entries may be hard links of one
+# another (deduplicated externs, see |memoize_dedup.py|, are published as
+# such), so we count the links of an inode which are not entries of the
+# store.
+def populate_store_garbage(store):
+    inodes = {}
+    for shard in store.iterdir():
+        if not shard.is_dir():
+            continue
+        for entry in shard.iterdir():
+            if entry.suffix in ('.memo', '.pdf'):
+                st = entry.stat()
+                inodes.setdefault((st.st_dev, st.st_ino),
+                                  [st.st_nlink, []])[1].append(entry)
+    for nlink, entries in inodes.values():
+        if nlink > len(entries):
+            continue
+        for entry in entries:
+            refs = entry.with_name(entry.name + '.refs')
+            try:
+                copies = refs.read_text().splitlines()
+            except FileNotFoundError:
+                copies = []
+            if not any(os.path.exists(copy) for copy in copies):
+                tbdeleted.append(entry)
+                if copies:
+                    tbdeleted.append(refs)
+
+if args.gc_store:
+    store = pathlib.Path(args.gc_store).absolute()
+    # A store is only created by the first extraction publishing into it.
+    if not store.is_dir():
+        if not args.quiet:
+            print(f"Store '{store}' does not exist, "
+                  f"assuming there's nothing to do")
+        sys.exit()
+    populate_store_garbage(store)
+else:
+    for folder, basename_prefixes in folders.items():
+        populate_tbdeleted(folder, basename_prefixes)
+
+# The eviction.  A group was last used at the latest time any of its files was
+# used: either by a document (the modification time of its .mmz file, if the
+# file is listed by an |\mmzNew*| or |\mmzUsed*| record) or, according to the
+# file system, accessed or modified.  We first evict the groups not used
+# within |--max-age|, and then, as long as the total size exceeds
+# |--max-size|, the least recently used groups.  Identical externs may share
+# their content as hard links (see |memoize_dedup.py|): the size of such a file
+# is counted once, and is only reclaimed once all its links are evicted.
+used_at = {}
+for mmz, last_used, used in documents:
+    for path, new in used:
+        folder_used_at = used_at.setdefault(path.parent, {})
+        folder_used_at[path.name] = max(folder_used_at.get(path.name, 0),
+                                        last_used)
+
+def file_use(candidate):
+    folder, name, group = candidate
     try:
-        for f in folder.iterdir():
-            if re_aux.match(f.name) and (args.all or f not in keep):
-                tbdeleted.append(f)
+        st = os.stat(folder / name)
     except FileNotFoundError:
-        pass
+        return
+    return st.st_size, max(used_at.get(folder, {}).get(name, 0),
+                           st.st_atime, st.st_mtime), (st.st_dev, st.st_ino)
 
-for prefix in prefixes:
-    # "prefix" is interpreted both as a directory (if it exists) and a basename prefix.
-    if prefix.is_dir():
-        populate_tbdeleted(prefix, '')
-    populate_tbdeleted(prefix.parent, prefix.name)
+def evict():
+    groups = {}
+    # The size and the number of links (among the candidates) of every inode.
+    inodes = {}
+    for (folder, name, group), use in zip(candidates, pmap(file_use, candidates)):
+        if use:
+            size, last_used, inode = use
+            g = groups.setdefault((folder, group), [0, []])
+            g[0] = max(g[0], last_used)
+            g[1].append((folder / name, inode))
+            inodes.setdefault(inode, [size, 0])[1] += 1
+    now = time.time()
+    total = sum(size for size, links in inodes.values())
+    evicted = 0
+    for last_used, files in sorted(groups.values(), key = lambda g: g[0]):
+        if (args.max_age is not None and now - last_used > args.max_age) or \
+           (args.max_size is not None and total > args.max_size):
+            for f, inode in files:
+                tbdeleted.append(f)
+                inodes[inode][1] -= 1
+                if not inodes[inode][1]:
+                    total -= inodes[inode][0]
+            evicted += 1
+    if not args.quiet and not args.plan:
+        print(f"Evicting {evicted} of {len(groups)} memo groups; "
+              f"{total} bytes remain")
+
+if budget:
+    evict()
 
 allowed_dirs = [pathlib.Path().absolute()] # todo: output directory
+if args.gc_store:
+    allowed_dirs = [pathlib.Path(args.gc_store).absolute()]
 deletion_not_allowed = [f for f in tbdeleted if not f.is_relative_to(*allowed_dirs)]
 if deletion_not_allowed:
     raise RuntimeError("Bailing out, "
@@ -140,7 +383,88 @@ def relativize(path):
     except ValueError:
         return path
 
-if tbdeleted:
+# The files to delete, grouped by directory.
+def by_folder(files):
+    folders = {}
+    for f in files:
+        folders.setdefault(f.parent, []).append(f.name)
+    return folders
+
+# With |--plan|, we show the deletion set with the sizes of the files, rather
+# than deleting anything.  A file which cannot be found has no size.
+def file_size(f):
+    try:
+        return f.stat().st_size
+    except FileNotFoundError:
+        return None
+
+def show_plan():
+    sizes = list(pmap(file_size, tbdeleted))
+    directories = {}
+    for f, size in zip(tbdeleted, sizes):
+        d = directories.setdefault(str(relativize(f.parent)),
+                                   {'files': 0, 'size': 0})
+        d['files'] += 1
+        d['size'] += size or 0
+    total = sum(size or 0 for size in sizes)
+    if args.plan == 'json':
+        import json
+        json.dump({
+            'files': [{'path': str(relativize(f)), 'size': size}
+                      for f, size in zip(tbdeleted, sizes)],
+            'directories': directories,
+            'files_total': len(tbdeleted),
+            'size_total': total,
+        }, sys.stdout, indent = 2)
+        print()
+    else:
+        for f, size in zip(tbdeleted, sizes):
+            print(relativize(f), '?' if size is None else size)
+        print(f'Total: {len(tbdeleted)} files, {total} bytes')
+
+# The files are deleted by name, relative to a file descriptor of their
+# directory, if the platform supports it; this saves resolving the directory
+# path for every file.  With |--jobs|, the files of a directory are deleted in
+# batches, concurrently.
+def unlink_batch(folder, names, dir_fd):
+    failed = []
+    for name in names:
+        try:
+            if dir_fd is None:
+                (folder / name).unlink()
+            else:
+                os.unlink(name, dir_fd = dir_fd)
+        except FileNotFoundError:
+            failed.append(folder / name)
+    return failed
+
+def delete(tbdeleted):
+    batch_size = 256 if pool else sys.maxsize
+    dir_fds = []
+    batches = []
+    try:
+        for folder, names in by_folder(tbdeleted).items():
+            dir_fd = None
+            if os.unlink in os.supports_dir_fd:
+                dir_fd = os.open(folder, os.O_RDONLY)
+                dir_fds.append(dir_fd)
+            for i in range(0, len(names), batch_size):
+                batches.append((folder, names[i:i+batch_size], dir_fd))
+        for batch, failed in zip(batches, pmap(lambda b: unlink_batch(*b),
+                                               batches)):
+            if not args.quiet:
+                for name in batch[1]:
+                    print("Deleting", relativize(batch[0] / name))
+            for f in failed:
+                print(f"Cannot delete {f}")
+    finally:
+        for dir_fd in dir_fds:
+            os.close(dir_fd)
+
+if args.plan:
+    tbdeleted.sort()
+    show_plan()
+elif tbdeleted:
     tbdeleted.sort()
     if not args.yes:
         print('I will delete the following files:')
@@ -149,18 +473,23 @@ if tbdeleted:
         print("Proceed (y/n)? ")
         a = input()
     if args.yes or a == 'y' or a == 'yes':
-        for f in tbdeleted:
-            if not args.quiet:
-                print("Deleting", relativize(f))
-            try:
-                f.unlink()
-            except FileNotFoundError:
-                print(f"Cannot delete {f}")
+        delete(tbdeleted)
+        # The deleted files (and the catalogued files which did not exist
+        # anymore) are removed from the catalogs.
+        for folder, names in by_folder(tbdeleted).items():
+            if c := catalogs.get(folder):
+                c.forget(names)
     else:
         print("Bailing out.")
 elif not args.quiet:
     print('Nothing to do, the directory seems clean.')
 
+for c in catalogs.values():
+    if c:
+        c.close()
+if pool:
+    pool.shutdown()
+
 # Local Variables:
 # fill-column: 79
 # after-save-hook: py2dtx
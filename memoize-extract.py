@@ -20,10 +20,12 @@
 
 __version__ = '2024/12/02 v1.4.1'
 
-import argparse, re, sys, os, subprocess, itertools, traceback, platform
-from pathlib import Path, PurePath
-# We will only try to import the PDF processing library once we set up the
-# error log.
+# Memoize invokes this script at every compilation, at least to create the memo
+# directory, so we keep the startup as lean as possible: we only import the
+# modules needed by all code paths here, and defer all other imports (including
+# the PDF processing library) until they are actually needed.
+import re, sys, os
+from pathlib import Path
 
 # \paragraph{Messages}
 
@@ -31,6 +33,13 @@ from pathlib import Path, PurePath
 # output to stdout rather than stderr so that messages on the TeX terminal and
 # document |.log| appear in chronological order).  Messages are automatically
 # adapted to the TeX |--format|.
+#
+# As the extraction log is input by \hologo{TeX} at the next compilation, and
+# a document may have thousands of externs, we don't report every extern by
+# default: the informational messages are divided into the details, issued by
+# |info| and only shown with |--verbose|, and the reports, issued by |report|,
+# most notably the summary of the extraction.  Warnings and errors are always
+# shown (on the terminal, unless |--quiet| is given).
 
 # The format of the messages.  It depends on the given |--format|; the last
 # entry is for t the terminal output.
@@ -95,6 +104,10 @@ def warning(text):
     exit_code = 10
     
 def info(text):
+    if getattr(args, 'verbose', False):
+        report(text)
+
+def report(text):
     if text and not args.quiet:
         print(INFO[None].format(text = text, header = header, indent = indent))
         if log:
@@ -159,13 +172,108 @@ def _paranoia(f, mode):
 # the |\| but lacking the drive.  On Windows, |pathlib|'s |is_absolute| returns
 # |True| only for paths starting with |\| and containing the drive.
 def sanitize_filename(f):
-    if f and platform.system() == 'Windows' and not (f.is_absolute() or not f.drive):
+    if f and sys.platform == 'win32' and not (f.is_absolute() or not f.drive):
         error(f"\"Semi-absolute\" paths are disallowed: '{f}'", r"The path must "
               r"either contain both the drive letter and start with '\', "
               r"or none of these; paths like 'C:foo' and '\foo' are disallowed")
 
+# \paragraph{Directory listings}
+
+# During the extraction, |find_in| and |find_out| probe the same few
+# directories for thousands of files.  Rather than asking the file system
+# about each file, we list each probed directory once, using |os.scandir|, and
+# answer the existence queries from the listing; the results of |os.access|
+# are remembered as well.  The answers are exactly those the file system would
+# give, or we ask the file system after all: a directory we cannot search is
+# not listed, a symbolic link might be broken, and on Windows and macOS, a file
+# absent from the listing might exist under a name differing in case.  Outside
+# the extraction (e.g.\ in the unit tests), the listings are disabled.
+class DirectoryListings:
+    def __init__(self, enabled = False):
+        self.enabled = enabled
+        # Directory -> |dict| mapping the names in the directory to
+        # |'dir'|, |'file'| or |None| (unknown), or |None| if not listed.
+        self.listings = {}
+        self.accessible = {}
+        # The number of file system calls avoided, and the number of
+        # directories listed (each costing about two calls).
+        self.saved = 0
+        self.listed = 0
+
+    def listing(self, d):
+        if not self.enabled:
+            return
+        key = str(d)
+        if key not in self.listings:
+            self.listed += 1
+            listing = None
+            try:
+                if os.access(d, os.X_OK):
+                    with os.scandir(d) as entries:
+                        listing = {
+                            e.name: None if e.is_symlink()
+                            else 'dir' if e.is_dir(follow_symlinks = False)
+                            else 'file'
+                            for e in entries}
+            except OSError:
+                pass
+            self.listings[key] = listing
+        return self.listings[key]
+
+    # |'dir'|, |'file'| or |'missing'| if the listing tells, or |None|.
+    def kind(self, f):
+        if f.name in ('', '.', '..') or (listing := self.listing(f.parent)) is None:
+            return
+        if f.name in listing:
+            return listing[f.name]
+        if os.name == 'posix' and sys.platform != 'darwin':
+            return 'missing'
+
+    def exists(self, f):
+        if (kind := self.kind(f)) is None:
+            return f.exists()
+        self.saved += 1
+        return kind != 'missing'
+
+    def is_dir(self, f):
+        if (kind := self.kind(f)) is None:
+            return f.is_dir()
+        self.saved += 1
+        return kind == 'dir'
+
+    def access(self, f, mode):
+        key = (str(f), mode)
+        if key in self.accessible:
+            self.saved += 1
+            return self.accessible[key]
+        if self.kind(f) == 'missing':
+            self.saved += 1
+            return False
+        result = os.access(f, mode)
+        if self.enabled:
+            self.accessible[key] = result
+        return result
+
+    # Record that we have created file |f|.
+    def created(self, f):
+        if (listing := self.listings.get(str(f.parent))) is not None:
+            listing[f.name] = 'file'
+        for mode in (os.R_OK, os.W_OK, os.X_OK):
+            self.accessible.pop((str(f), mode), None)
+
+    # Forget everything, e.g.\ after creating a directory.
+    def forget(self):
+        self.listings.clear()
+        self.accessible.clear()
+
+    # The net number of file system calls saved.
+    def report(self):
+        return self.saved - 2 * self.listed
+
+listings = DirectoryListings()
+
 def access_in(f):
-    return os.access(f, os.R_OK)
+    return listings.access(f, os.R_OK)
 
 # This function can fail on Windows, reporting a non-writable file or dir as
 # writable, because |os.access| does not work with Windows' |icacls|
@@ -174,7 +282,7 @@ def access_in(f):
 # is unaffected, as it doesn't use |access_*| functions.
 def access_out(f):
     try:
-        exists = f.exists()
+        exists = listings.exists(f)
     # Presumably, we get this error when the parent directory is not
     # executable.
     except PermissionError:
@@ -182,12 +290,13 @@ def access_out(f):
     if exists:
         # An existing file should be writable, and if it's a directory, it
         # should also be executable.
-        return os.access(f, os.W_OK) and (not f.is_dir() or os.access(f, os.X_OK))
+        return listings.access(f, os.W_OK) and \
+            (not listings.is_dir(f) or listings.access(f, os.X_OK))
     else:
         # For a non-existing file, the parent directory should be writable.
         # (This is the only place where function |pathlib.parent| is used, so
         # it's ok that it returns the logical parent.)
-        return os.access(f.parent, os.W_OK)
+        return listings.access(f.parent, os.W_OK)
 
 # This function finds the location for an input file, respecting
 # |TEXMF_OUTPUT_DIRECTORY| and |TEXMFOUTPUT|, and the permissions in the
@@ -244,58 +353,182 @@ def mkdir(folder):
         # |TEXMF_OUTPUT_DIRECTORY|/|TEXMFOUTPUT|, if given, exists, and that
         # ``folder'' contains no |..|.
         folder.mkdir(parents = True, exist_ok = True)
+        listings.forget()
         # This does not get logged when the function is invoked via |--mkdir|,
         # as it is not clear what the log name should be.
         info(f"Created directory {folder}")
 
-_re_unquote = re.compile(r'"(.*?)"')
-def unquote(fn):
-    return _re_unquote.sub(r'\1', fn)
-        
 # \paragraph{Kpathsea}
 
 # Get the values of |openin_any|, |openout_any|, |TEXMFOUTPUT| and
-# |TEXMF_OUTPUT_DIRECTORY|.
-
-kpsewhich_output = subprocess.run(['kpsewhich',
-                                   f'-expand-var='
-                                   f'openin_any=$openin_any,'
-                                   f'openout_any=$openout_any,'
-                                   f'TEXMFOUTPUT=$TEXMFOUTPUT'],
-                                  capture_output = True
-                                  ).stdout.decode().strip()
-if not kpsewhich_output:
-    # No TeX? (Note that |kpsewhich| should exist in MiKTeX as well.)  In
-    # absence of |kpathsea| information, we get very paranoid, but still try to
-    # get |TEXMFOUTPUT| from an environment variable.
-    openin_any, openout_any = 'p', 'p'
-    texmfoutput, texmf_output_directory = None, None
-    # Unfortunately, this warning can't make it into the log.  But then again,
-    # the chances of a missing |kpsewhich| are very slim, and its absence would
-    # show all over the place anyway.
-    warning('I failed to execute "kpsewhich"; , is there no TeX system installed? '
-            'Assuming openin_any = openout_any = "p" '
-            '(i.e. restricting all file operations to non-hidden files '
-            'in the current directory of its subdirectories).')
-else:
-    m = re.fullmatch(r'openin_any=(.*),openout_any=(.*),TEXMFOUTPUT=(.*)',
-                     kpsewhich_output)
-    openin_any, openout_any, texmfoutput = m.groups()
-    texmf_output_directory = os.environ.get('TEXMF_OUTPUT_DIRECTORY', None)
-    if openin_any == '$openin_any':
-        # When the |open*_any| variables are not expanded, we assume we're
-        # running MiKTeX. The two config settings below correspond to TeXLive's
-        # |openin_any| and |openout_any|; afaik, there is no analogue to
-        # |TEXMFOUTPUT|.
-        initexmf_output = subprocess.run(
-            ['initexmf', '--show-config-value=[Core]AllowUnsafeInputFiles',
-             '--show-config-value=[Core]AllowUnsafeOutputFiles'],
-            capture_output = True).stdout.decode().strip()
-        openin_any, openout_any = initexmf_output.split()
-        openin_any = 'a' if openin_any == 'true' else 'p'
-        openout_any = 'a' if openout_any == 'true' else 'p'
-        texmfoutput = None
-        texmf_output_directory = None
+# |TEXMF_OUTPUT_DIRECTORY|.  The probe is performed by function |kpathsea|,
+# which is only called once we know that we will do the work ourselves, rather
+# than hand it over to an extraction server (which has already done the probe).
+# The variables are initialized to |None| so that they exist when the script is
+# loaded from the testing code, which sets them by itself.
+
+openin_any, openout_any = None, None
+texmfoutput, texmf_output_directory = None, None
+# The unsanitized value of |TEXMFOUTPUT|, and whether we should respect
+# |TEXMF_OUTPUT_DIRECTORY| (MiKTeX has no analogue to it).
+texmfoutput_setting = None
+respect_texmf_output_directory = False
+
+# The environment variables which influence the values obtained from kpathsea.
+KPATHSEA_ENVIRONMENT = ('openin_any', 'openout_any', 'TEXMFOUTPUT', 'TEXMFCNF')
+
+def kpathsea():
+    global openin_any, openout_any, texmfoutput_setting, \
+        respect_texmf_output_directory
+    kpsewhich = which('kpsewhich')
+    cache_key = kpathsea_cache_key(kpsewhich)
+    if cached := kpathsea_cache_lookup(cache_key):
+        openin_any, openout_any, texmfoutput_setting = cached
+        respect_texmf_output_directory = True
+        return
+    import subprocess
+    kpsewhich_output = subprocess.run([kpsewhich,
+                                       f'-expand-var='
+                                       f'openin_any=$openin_any,'
+                                       f'openout_any=$openout_any,'
+                                       f'TEXMFOUTPUT=$TEXMFOUTPUT'],
+                                      capture_output = True
+                                      ).stdout.decode().strip() \
+                                      if kpsewhich else ''
+    if not kpsewhich_output:
+        # No TeX? (Note that |kpsewhich| should exist in MiKTeX as well.)  In
+        # absence of |kpathsea| information, we get very paranoid, but still
+        # try to get |TEXMFOUTPUT| from an environment variable.
+        openin_any, openout_any = 'p', 'p'
+        texmfoutput_setting, respect_texmf_output_directory = None, False
+        # Unfortunately, this warning can't make it into the log.  But then
+        # again, the chances of a missing |kpsewhich| are very slim, and its
+        # absence would show all over the place anyway.
+        warning('I failed to execute "kpsewhich"; , is there no TeX system '
+                'installed? Assuming openin_any = openout_any = "p" '
+                '(i.e. restricting all file operations to non-hidden files '
+                'in the current directory of its subdirectories).')
+    else:
+        m = re.fullmatch(r'openin_any=(.*),openout_any=(.*),TEXMFOUTPUT=(.*)',
+                         kpsewhich_output)
+        openin_any, openout_any, texmfoutput_setting = m.groups()
+        respect_texmf_output_directory = True
+        if openin_any == '$openin_any':
+            # When the |open*_any| variables are not expanded, we assume we're
+            # running MiKTeX. The two config settings below correspond to
+            # TeXLive's |openin_any| and |openout_any|; afaik, there is no
+            # analogue to |TEXMFOUTPUT|.  We don't cache these values, as we
+            # don't know where MiKTeX keeps its configuration.
+            initexmf_output = subprocess.run(
+                ['initexmf', '--show-config-value=[Core]AllowUnsafeInputFiles',
+                 '--show-config-value=[Core]AllowUnsafeOutputFiles'],
+                capture_output = True).stdout.decode().strip()
+            openin_any, openout_any = initexmf_output.split()
+            openin_any = 'a' if openin_any == 'true' else 'p'
+            openout_any = 'a' if openout_any == 'true' else 'p'
+            texmfoutput_setting = None
+            respect_texmf_output_directory = False
+        else:
+            kpathsea_cache_store(cache_key, kpsewhich)
+
+# Find an executable in the |PATH|, like |shutil.which|, but without importing
+# |shutil|.
+def which(program):
+    extensions = os.environ.get('PATHEXT', '.EXE').split(os.pathsep) \
+        if sys.platform == 'win32' else ['']
+    for d in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        for extension in extensions:
+            f = os.path.join(d, program + extension)
+            if os.path.isfile(f) and os.access(f, os.X_OK):
+                return f
+
+# \paragraph{The kpathsea cache}
+
+# Probing kpathsea costs a subprocess round-trip, so we remember the results in
+# a cache file, |kpathsea.json| in the directory given by environment variable
+# |MEMOIZE_CACHE_DIR| (an empty value disables the cache), or in the user's
+# cache directory.  The cache may hold the results for several TeX
+# installations: it maps the cache key, consisting of the path to |kpsewhich|
+# and the values of the relevant environment variables, to the results and a
+# stamp, i.e.\ the modification times of |kpsewhich|, all |texmf.cnf| files and
+# the directories containing them.  An entry is only valid if the stamp did not
+# change, so any edit of the configuration automatically invalidates it.
+
+def kpathsea_cache_file():
+    d = os.environ.get('MEMOIZE_CACHE_DIR')
+    if d is None:
+        if sys.platform == 'win32':
+            d = os.environ.get('LOCALAPPDATA')
+        else:
+            d = os.environ.get('XDG_CACHE_HOME') \
+                or os.path.join(os.path.expanduser('~'), '.cache')
+        d = os.path.join(d, 'memoize') if d else None
+    return os.path.join(d, 'kpathsea.json') if d else None
+
+def kpathsea_cache_key(kpsewhich):
+    return '\0'.join([kpsewhich or ''] + [os.environ.get(var, '\0')
+                                          for var in KPATHSEA_ENVIRONMENT])
+
+def kpathsea_stamp(files):
+    stamp = {}
+    for f in files:
+        try:
+            stamp[f] = os.stat(f).st_mtime_ns
+        except OSError:
+            stamp[f] = None
+    return stamp
+
+def kpathsea_cache_read(cache_file):
+    import json
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def kpathsea_cache_lookup(cache_key):
+    if not cache_key.split('\0', 1)[0] \
+       or not (cache_file := kpathsea_cache_file()):
+        return
+    entry = kpathsea_cache_read(cache_file).get(cache_key)
+    try:
+        if kpathsea_stamp(entry['stamp']) == entry['stamp']:
+            return entry['openin_any'], entry['openout_any'], \
+                entry['TEXMFOUTPUT']
+    except (TypeError, KeyError):
+        pass
+
+def kpathsea_cache_store(cache_key, kpsewhich):
+    import json, tempfile, subprocess
+    if not (cache_file := kpathsea_cache_file()):
+        return
+    cnf_files = subprocess.run([kpsewhich, '-all', 'texmf.cnf'],
+                               capture_output = True
+                               ).stdout.decode().split('\n')
+    cnf_files = [os.path.abspath(f) for f in cnf_files if f.strip()]
+    if not cnf_files:
+        return
+    cnf_dirs = list(dict.fromkeys(os.path.dirname(f) for f in cnf_files))
+    try:
+        os.makedirs(os.path.dirname(cache_file), mode = 0o700, exist_ok = True)
+        cache = kpathsea_cache_read(cache_file)
+        cache[cache_key] = {
+            'openin_any': openin_any,
+            'openout_any': openout_any,
+            'TEXMFOUTPUT': texmfoutput_setting,
+            'stamp': kpathsea_stamp([kpsewhich] + cnf_files + cnf_dirs),
+        }
+        # Replace the cache file atomically, so that a concurrent compilation
+        # never sees a partially written cache.
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(cache_file),
+                                   prefix = '.kpathsea.', suffix = '.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f, indent = 1)
+        os.replace(tmp, cache_file)
+    except OSError:
+        # Failing to write the cache is not a reason to fail the extraction.
+        pass
 
 # An output directory should exist, and may not point to the root on Linux. On
 # Windows, it may point to the root, because we only allow absolute filenames
@@ -306,17 +539,1271 @@ def sanitize_output_dir(d_str):
     return d if d and d.is_dir() and \
         (not d.is_absolute() or len(d.parts) != 1 or d.drive) else None
 
-texmfoutput = sanitize_output_dir(texmfoutput)
-texmf_output_directory = sanitize_output_dir(texmf_output_directory)
+# Set |texmfoutput| and |texmf_output_directory|.  As these may be relative to
+# the current directory, this function is called anew for every job processed
+# by the extraction server.
+def output_directories():
+    global texmfoutput, texmf_output_directory
+    texmfoutput = sanitize_output_dir(texmfoutput_setting)
+    texmf_output_directory = sanitize_output_dir(
+        os.environ.get('TEXMF_OUTPUT_DIRECTORY', None)
+        if respect_texmf_output_directory else None)
 
 class NotExtracted(UserWarning):
     pass
 
-# We don't delve into the real script when loaded from the testing code.
-if __name__ == '__main__':
+# \paragraph{Extraction server}
+
+# Every invocation of this script pays for starting up Python, probing
+# kpathsea and importing the PDF processing library before it reads a single
+# line of the |.mmz| file.  An extraction server started by |--serve| pays
+# these costs only once: it listens on a Unix socket, and for every job
+# received from a client (which is this very script, invoked as usual, finding
+# the socket), it forks a worker which performs the extraction in the client's
+# current directory and reports the output and the exit code back to the
+# client.  As the workers are forked, the server can process several jobs
+# concurrently.  When no server is running, the client falls back to
+# extracting by itself.
+
+# As the server probes kpathsea only once, it refuses jobs from clients whose
+# values of |KPATHSEA_ENVIRONMENT| differ from its own; such clients then
+# extract by themselves.
+
+# The socket is given by |--socket|, environment variable
+# |MEMOIZE_EXTRACT_SOCKET|, or is a per-user file in the runtime or temporary
+# directory.  |None| signals that the platform has no Unix sockets.  (We avoid
+# importing |socket| and |tempfile| here, as this is executed at every
+# invocation.)
+def server_socket(path = None):
+    if sys.platform == 'win32':
+        return
+    if path or (path := os.environ.get('MEMOIZE_EXTRACT_SOCKET')):
+        return path
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR')
+                        or os.environ.get('TMPDIR') or '/tmp',
+                        f'memoize-extract-{os.getuid()}.sock')
+
+# We only talk to a socket which we own, and which nobody else may access;
+# otherwise, another user could create the socket before us, and receive our
+# jobs and fake their outcome.
+def trusted_socket(path):
+    import stat
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid() \
+        and not st.st_mode & 0o077
+
+# Hand the job over to the extraction server, if there is one.  If the server
+# performs the extraction, we exit with its exit code; otherwise, we return, and
+# the caller should extract by itself.
+def client(argv, path):
+    if not path or not trusted_socket(path):
+        return
+    import socket, json
+    job = {
+        'argv': argv,
+        'cwd': os.getcwd(),
+        'env': {var: os.environ.get(var)
+                for var in KPATHSEA_ENVIRONMENT + ('TEXMF_OUTPUT_DIRECTORY',)},
+    }
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(path)
+            s.sendall(json.dumps(job).encode() + b'\n')
+            with s.makefile('rb') as f:
+                reply = json.loads(f.readline() or 'null')
+    except (OSError, ValueError):
+        # A stale socket, or a server which died while processing our job.
+        return
+    if not reply or 'exit_code' not in reply:
+        return
+    print(reply['output'], end = '')
+    sys.exit(reply['exit_code'])
+
+# Run the extraction server.  This function never returns.
+def serve(path, backend):
+    import socketserver, json, io
+    if not path:
+        sys.exit("memoize-extract.py: Unix sockets are not available "
+                 "on this platform")
+    # Make sure that the socket is not left behind by a running server.
+    if os.path.exists(path):
+        import socket
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.connect(path)
+            sys.exit(f"memoize-extract.py: a server is already listening "
+                     f"on '{path}'")
+        except ConnectionRefusedError:
+            os.unlink(path)
+    # Everything which can be done upfront is done upfront.
+    kpathsea()
+    try:
+        pdf_backend(backend)
+    except ModuleNotFoundError as err:
+        sys.exit(f"memoize-extract.py: {err}")
+    environment = {var: os.environ.get(var) for var in KPATHSEA_ENVIRONMENT}
+
+    class Handler(socketserver.StreamRequestHandler):
+        # This is executed in a forked worker.
+        def handle(self):
+            job = json.loads(self.rfile.readline())
+            if any(job['env'][var] != value
+                   for var, value in environment.items()):
+                reply = {'refused': 'environment mismatch'}
+            else:
+                print(f"Job in '{job['cwd']}': {' '.join(job['argv'])}",
+                      flush = True)
+                reply = {'output': '', 'exit_code': 0}
+                sys.stdout = output = io.StringIO()
+                try:
+                    os.chdir(job['cwd'])
+                    if (tod := job['env']['TEXMF_OUTPUT_DIRECTORY']) is None:
+                        os.environ.pop('TEXMF_OUTPUT_DIRECTORY', None)
+                    else:
+                        os.environ['TEXMF_OUTPUT_DIRECTORY'] = tod
+                    output_directories()
+                    run(argument_parser().parse_args(job['argv']))
+                except SystemExit as e:
+                    reply['exit_code'] = e.code if isinstance(e.code, int) \
+                        else 0 if e.code is None else 1
+                    if isinstance(e.code, str):
+                        print(e.code)
+                finally:
+                    sys.stdout = sys.__stdout__
+                reply['output'] = output.getvalue()
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+    # Only the user running the server may connect to it.  We restrict the
+    # permissions of the socket alone: the workers inherit the umask of the
+    # server, and the files they create should follow the user's umask.
+    class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+        def server_bind(self):
+            umask = os.umask(0o077)
+            try:
+                super().server_bind()
+            finally:
+                os.umask(umask)
+
+    with Server(path, Handler) as server:
+        print(f"memoize-extract.py: serving on '{path}'", flush = True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
+    sys.exit()
+
+# \paragraph{PDF backends}
+
+# The PDF processing library used to read the document and to write the
+# externs is selected by |--backend|.  A backend wraps a library, which is
+# only imported when the backend is created, behind a minimal interface:
+# |read| loads a document from a file or from bytes, and the document's
+# |pages| is a sequence of its pages; |media_box| returns the media box of a
+# page as four numbers; |write| writes a new PDF consisting of the given
+# pages into a file, given by its path or as a binary file object; and
+# |errors| are the exceptions the library raises for a malformed document.
+# Writing the same pages twice must produce the same bytes (see
+# |backend_write_extern|).  Attribute |fork_safe| tells whether a document loaded by the main
+# process may be used by the forked extern writer processes.
+
+class PdfrwBackend:
+    name = 'pdfrw'
+    fork_safe = True
+
+    def __init__(self):
+        import pdfrw
+        self.pdfrw = pdfrw
+        self.errors = (pdfrw.errors.PdfParseError,)
+
+    def read(self, source):
+        if isinstance(source, bytes):
+            return self.pdfrw.PdfReader(fdata = source)
+        return self.pdfrw.PdfReader(source)
+
+    def media_box(self, page):
+        return [float(x) for x in page['/MediaBox']]
+
+    def write(self, pages, pdf_file):
+        writer = self.pdfrw.PdfWriter(pdf_file)
+        writer.addpages(pages)
+        writer.write()
+
+# |pypdf| reads the entire document into memory, so it is fork-safe as well.
+class PypdfBackend:
+    name = 'pypdf'
+    fork_safe = True
+
+    def __init__(self):
+        import pypdf
+        self.pypdf = pypdf
+        self.errors = (pypdf.errors.PdfReadError,)
+
+    def read(self, source):
+        if isinstance(source, bytes):
+            import io
+            source = io.BytesIO(source)
+        return self.pypdf.PdfReader(source)
+
+    def media_box(self, page):
+        box = page.mediabox
+        return [float(box.left), float(box.bottom),
+                float(box.right), float(box.top)]
+
+    def write(self, pages, pdf_file):
+        writer = self.pypdf.PdfWriter()
+        for page in pages:
+            writer.add_page(page)
+        writer.write(pdf_file)
+
+# |pikepdf| is based on the \texttt{qpdf} library, written in C++.  It reads
+# the objects on demand, through a file handle which a forked process would
+# share with its parent, so the extern writer processes read the document by
+# themselves.
+class PikepdfBackend:
+    name = 'pikepdf'
+    fork_safe = False
+
+    def __init__(self):
+        import pikepdf
+        self.pikepdf = pikepdf
+        self.errors = (pikepdf.PdfError,)
+
+    def read(self, source):
+        if isinstance(source, bytes):
+            import io
+            source = io.BytesIO(source)
+        return self.pikepdf.open(source)
+
+    def media_box(self, page):
+        return [float(x) for x in page.mediabox]
+
+    def write(self, pages, pdf_file):
+        pdf = self.pikepdf.new()
+        pdf.pages.extend(pages)
+        # Like the other backends, we keep the streams as they are.
+        # The document ID is derived from the content, so that writing the
+        # same page twice produces the same file.
+        pdf.save(pdf_file, compress_streams = False, deterministic_id = True)
+
+# The backends, in the order of preference for |--backend auto|.  |pdfrw|,
+# the library this script was written for, comes first, so that installing
+# another library does not change the externs of existing users; it is also
+# the fastest one when the document is read in full.
+BACKENDS = {backend.name: backend
+            for backend in (PdfrwBackend, PikepdfBackend, PypdfBackend)}
+
+_backends = {}
+
+# Return the backend |name|, or with |auto|, the first one whose library is
+# installed.  Raise |ModuleNotFoundError| if there is no such library.
+def pdf_backend(name = 'auto'):
+    if name in _backends:
+        return _backends[name]
+    if name != 'auto' and name not in BACKENDS:
+        raise ModuleNotFoundError(f"Unknown PDF backend '{name}'")
+    for candidate in (BACKENDS if name == 'auto' else (name,)):
+        try:
+            backend = _backends.get(candidate) or BACKENDS[candidate]()
+        except ImportError:
+            continue
+        _backends[name] = _backends[candidate] = backend
+        return backend
+    if name == 'auto':
+        raise ModuleNotFoundError(
+            'None of the Python modules ' +
+            ', '.join(f"'{n}'" for n in BACKENDS) + ' was found')
+    raise ModuleNotFoundError(f"Python module '{name}' was not found")
+
+# \paragraph{A lazy PDF reader}
+
+# |pdfrw.PdfReader| reads the entire document into memory and decompresses all
+# object streams before we get to look at a single page, so the cost of loading
+# the document grows with the size of the document, rather than with the number
+# of externs we extract from it.  With |--lazy|, we read the document through a
+# |LazyPdfReader| instead.  It memory-maps the document, parses the
+# cross-reference sections, and only reads the objects reachable from the pages
+# we actually access.  For each such page, it builds a small PDF holding the
+# page and the objects reachable from it, and hands it over to the PDF
+# backend, so the rest of the script can process the page as usual.
+#
+# With |--raw|, the page does not go through the backend at all.  The extern is
+# written by |LazyPdfReader.extract_page|: only the object headers (i.e.\ the
+# dictionaries, with the references renumbered) and the cross-reference table
+# are written anew, while the stream data (images, fonts, content streams),
+# which typically accounts for most of an extern, is copied from the document
+# file to the extern file by the kernel, without passing through Python.
+
+class LazyPdfError(Exception):
+    pass
+
+# An indirect reference.
+class Ref(tuple):
+    def __new__(cls, num, gen):
+        return tuple.__new__(cls, (num, gen))
+
+# The tokenizer.  Scalars (numbers, names, strings, booleans and null) are kept
+# as raw bytes, dictionaries become |dict|s keyed by the raw name, and arrays
+# become |list|s.
+_re_pdf_space = re.compile(rb'(?:[\0\t\n\f\r ]|%[^\r\n]*)*')
+_re_pdf_token = re.compile(
+    rb'<<|>>|[\[\]]|/[^\0\t\n\f\r ()<>\[\]{}/%]*|<[0-9A-Fa-f\0\t\n\f\r ]*>'
+    rb'|\(|[^\0\t\n\f\r ()<>\[\]{}/%]+')
+_re_pdf_string = re.compile(rb'[()\\]')
+_re_pdf_integer = re.compile(rb'[0-9]+')
+_re_pdf_ref_tail = re.compile(
+    rb'(?:[\0\t\n\f\r ]|%[^\r\n]*)*([0-9]+)(?:[\0\t\n\f\r ]|%[^\r\n]*)+'
+    rb'R(?![^\0\t\n\f\r ()<>\[\]{}/%])')
+
+def _pdf_string_end(data, pos):
+    # |pos| points just behind the opening parenthesis.
+    depth = 1
+    while depth:
+        m = _re_pdf_string.search(data, pos)
+        if not m:
+            raise LazyPdfError('unterminated string')
+        pos = m.end()
+        c = m.group()
+        if c == b'\\':
+            pos += 1
+        elif c == b'(':
+            depth += 1
+        else:
+            depth -= 1
+    return pos
+
+def parse_pdf_object(data, pos):
+    stack = [[]]
+    while True:
+        pos = _re_pdf_space.match(data, pos).end()
+        if not (m := _re_pdf_token.match(data, pos)):
+            raise LazyPdfError(f'cannot parse the object at offset {pos}')
+        token = m.group()
+        start, pos = pos, m.end()
+        if token == b'(':
+            pos = _pdf_string_end(data, pos)
+            value = data[start:pos]
+        elif token == b'<<' or token == b'[':
+            stack.append([])
+            continue
+        elif token == b'>>':
+            items = stack.pop()
+            if len(items) % 2:
+                raise LazyPdfError(f'malformed dictionary at offset {start}')
+            value = dict(zip(items[::2], items[1::2]))
+        elif token == b']':
+            value = stack.pop()
+        elif token == b'R':
+            items = stack[-1]
+            gen, num = items.pop(), items.pop()
+            value = Ref(int(num), int(gen))
+        else:
+            value = token
+        if len(stack) == 1:
+            # A scalar at the top level might be the first part of a reference.
+            if isinstance(value, bytes) and _re_pdf_integer.fullmatch(value):
+                if m := _re_pdf_ref_tail.match(data, pos):
+                    return Ref(int(value), int(m[1])), m.end()
+            return value, pos
+        stack[-1].append(value)
+
+# Without |renumber|, the references are serialized as they are.
+def serialize_pdf_object(value, renumber = None):
+    if isinstance(value, Ref):
+        return b'%d 0 R' % renumber(value) if renumber else b'%d %d R' % value
+    elif isinstance(value, dict):
+        return b'<<' + b' '.join(
+            key + b' ' + serialize_pdf_object(v, renumber)
+            for key, v in value.items()) + b'>>'
+    elif isinstance(value, list):
+        return b'[' + b' '.join(serialize_pdf_object(v, renumber)
+                                for v in value) + b']'
+    else:
+        return value
+
+def pdf_references(value):
+    if isinstance(value, Ref):
+        yield value
+    elif isinstance(value, dict):
+        for v in value.values():
+            yield from pdf_references(v)
+    elif isinstance(value, list):
+        for v in value:
+            yield from pdf_references(v)
+
+# The page attributes which may be inherited from the page tree.
+INHERITABLE = (b'/Resources', b'/MediaBox', b'/CropBox', b'/Rotate')
+
+class LazyPdfReader:
+    def __init__(self, pdf_file, backend):
+        import mmap
+        self.backend = backend
+        # We keep the file open for copying the stream data with |--raw|.
+        self.file = open(pdf_file, 'rb')
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0,
+                                  access = mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise LazyPdfError('empty file')
+        # Object number -> offset, or (object stream number, index).
+        self.xref = {}
+        self.trailer = {}
+        self.objects = {}
+        self.object_streams = {}
+        self.page_tree_nodes = {}
+        self.objects_read = 0
+        self.read_xref()
+        if b'/Encrypt' in self.trailer:
+            raise LazyPdfError('the document is encrypted')
+        root = self.resolve(self.trailer.get(b'/Root'))
+        self.page_tree = root.get(b'/Pages') if isinstance(root, dict) else None
+        if not isinstance(self.page_tree, Ref):
+            raise LazyPdfError('no page tree')
+        self.pages = LazyPdfPages(self)
+
+    # \paragraph{Cross-reference sections}
+    
+    def read_xref(self):
+        data = self.data
+        startxref = data.rfind(b'startxref')
+        if startxref < 0 or not (m := re.compile(rb'startxref\s+([0-9]+)').match(
+                data, startxref)):
+            raise LazyPdfError('startxref not found')
+        offset, seen = int(m[1]), set()
+        # Remember the newest section, in case we append an incremental update.
+        self.startxref = offset
+        self.xref_is_stream = data[offset:offset+4] != b'xref'
+        # We start with the newest section, so entries already in |self.xref|
+        # take precedence.
+        while offset is not None and offset not in seen:
+            seen.add(offset)
+            if data[offset:offset+4] == b'xref':
+                trailer = self.read_xref_table(offset + 4)
+                if isinstance(xrefstm := trailer.get(b'/XRefStm'), bytes):
+                    self.read_xref_stream(int(xrefstm))
+            else:
+                trailer = self.read_xref_stream(offset)
+            for key, value in trailer.items():
+                self.trailer.setdefault(key, value)
+            prev = trailer.get(b'/Prev')
+            offset = int(prev) if isinstance(prev, bytes) else None
+
+    def read_xref_table(self, pos):
+        data = self.data
+        re_subsection = re.compile(rb'\s*([0-9]+)\s+([0-9]+)')
+        re_entry = re.compile(rb'\s*([0-9]+)\s+([0-9]+)\s+([nf])')
+        while m := re_subsection.match(data, pos):
+            pos = m.end()
+            for num in range(int(m[1]), int(m[1]) + int(m[2])):
+                if not (e := re_entry.match(data, pos)):
+                    raise LazyPdfError(f'malformed xref entry at offset {pos}')
+                pos = e.end()
+                if e[3] == b'n':
+                    self.xref.setdefault(num, int(e[1]))
+                else:
+                    self.xref.setdefault(num, None)
+        if not (m := re.compile(rb'\s*trailer').match(data, pos)):
+            raise LazyPdfError(f'trailer not found at offset {pos}')
+        trailer, pos = parse_pdf_object(data, m.end())
+        return trailer
 
-    # \paragraph{Arguments}
+    def read_xref_stream(self, offset):
+        _, d, span = self.read_indirect(offset)
+        if d.get(b'/Type') != b'/XRef':
+            raise LazyPdfError(f'no xref section at offset {offset}')
+        stream = self.decode(d, self.stream(span))
+        widths = [int(w) for w in d[b'/W']]
+        index = [int(i) for i in d.get(b'/Index', [b'0', d[b'/Size']])]
+        pos = 0
+        def field(width, default):
+            nonlocal pos
+            if not width:
+                return default
+            value = int.from_bytes(stream[pos:pos+width], 'big')
+            pos += width
+            return value
+        for start, count in zip(index[::2], index[1::2]):
+            for num in range(start, start + count):
+                kind = field(widths[0], 1)
+                a = field(widths[1], 0)
+                b = field(widths[2], 0)
+                if kind == 1:
+                    self.xref.setdefault(num, a)
+                elif kind == 2:
+                    self.xref.setdefault(num, (a, b))
+                else:
+                    self.xref.setdefault(num, None)
+        return d
 
+    # \paragraph{Objects}
+
+    # Read the indirect object at |offset|, returning the object number, the
+    # object, and for a stream, the span of its raw (undecoded) data, i.e.\ its
+    # offset in the file and its length.  The data itself is only read when
+    # needed, by |stream|.
+    def read_indirect(self, offset):
+        data = self.data
+        if not (m := re.compile(rb'\s*([0-9]+)\s+([0-9]+)\s+obj').match(
+                data, offset)):
+            raise LazyPdfError(f'no object at offset {offset}')
+        value, pos = parse_pdf_object(data, m.end())
+        stream = None
+        if isinstance(value, dict) and \
+           (s := re.compile(rb'\s*stream(?:\r\n|\n|\r)').match(data, pos)):
+            length = self.resolve(value.get(b'/Length'))
+            try:
+                length = int(length)
+            except (TypeError, ValueError):
+                raise LazyPdfError(f'bad stream length at offset {offset}')
+            if s.end() + length > len(data):
+                raise LazyPdfError(f'truncated stream at offset {offset}')
+            stream = (s.end(), length)
+        return int(m[1]), value, stream
+
+    def stream(self, span):
+        return self.data[span[0]:span[0]+span[1]]
+
+    def decode(self, d, stream):
+        filters = self.resolve(d.get(b'/Filter'))
+        filters = filters if isinstance(filters, list) else [filters]
+        filters = [f for f in filters if f is not None]
+        if filters and filters != [b'/FlateDecode']:
+            raise LazyPdfError(f'unsupported filter {filters}')
+        if filters:
+            import zlib
+            stream = zlib.decompress(stream)
+        params = self.resolve(d.get(b'/DecodeParms'))
+        if isinstance(params, dict) and \
+           int(params.get(b'/Predictor', b'1')) >= 10:
+            stream = self.unpredict(stream, int(params.get(b'/Columns', b'1')))
+        return stream
+
+    # Undo a PNG predictor (only ``None'' and ``Up'', as used by pdf\TeX; and
+    # ``Sub'').
+    def unpredict(self, stream, columns):
+        rows, previous = [], bytes(columns)
+        for i in range(0, len(stream), columns + 1):
+            kind, row = stream[i], bytearray(stream[i+1:i+1+columns])
+            if kind == 1:
+                for j in range(1, len(row)):
+                    row[j] = (row[j] + row[j-1]) & 0xff
+            elif kind == 2:
+                for j in range(len(row)):
+                    row[j] = (row[j] + previous[j]) & 0xff
+            elif kind != 0:
+                raise LazyPdfError(f'unsupported PNG predictor {kind}')
+            rows.append(row)
+            previous = row
+        return b''.join(rows)
+
+    # Return the object and the span of the raw stream data (|None| if it is
+    # not a stream) of the given reference; an inexisting object is |null|.
+    def get(self, ref):
+        if ref in self.objects:
+            return self.objects[ref]
+        where = self.xref.get(ref[0])
+        if where is None:
+            obj = (b'null', None)
+        elif isinstance(where, tuple):
+            obj = (self.object_stream(where[0])[where[1]], None)
+        else:
+            _, value, stream = self.read_indirect(where)
+            obj = (value, stream)
+        self.objects[ref] = obj
+        self.objects_read += 1
+        return obj
+
+    def resolve(self, value):
+        return self.get(value)[0] if isinstance(value, Ref) else value
+
+    def object_stream(self, num):
+        if (objects := self.object_streams.get(num)) is None:
+            d, span = self.get(Ref(num, 0))
+            stream = self.decode(d, self.stream(span))
+            n, first = int(d[b'/N']), int(d[b'/First'])
+            header = stream[:first].split()
+            objects = []
+            for i in range(n):
+                offset = first + int(header[2*i+1])
+                objects.append(parse_pdf_object(stream, offset)[0])
+            self.object_streams[num] = objects
+        return objects
+
+    # \paragraph{Pages}
+
+    def page_count(self):
+        return int(self.resolve(self.get(self.page_tree)[0].get(b'/Count')))
+
+    # Find the |n|th page, returning its reference and the attributes it
+    # inherits from the page tree.
+    def find_page(self, n):
+        import bisect
+        ref, inherited = self.page_tree, {}
+        while True:
+            node = self.get(ref)[0]
+            if node.get(b'/Type') == b'/Page' or b'/Kids' not in node:
+                return ref, inherited
+            for key in INHERITABLE:
+                if key in node:
+                    inherited[key] = node[key]
+            kids, starts = self.kids(ref)
+            if not 0 <= n < starts[-1]:
+                raise LazyPdfError(f'page {n} not found in the page tree')
+            i = bisect.bisect_right(starts, n) - 1
+            ref = kids[i]
+            n -= starts[i]
+
+    # The kids of page tree node |ref|, and the number of the first page below
+    # each kid (relative to the node), followed by the page count of the node.
+    # We remember these, so that finding a page takes logarithmic time in the
+    # number of kids, which matters for documents with a flat page tree.
+    def kids(self, ref):
+        if (kids := self.page_tree_nodes.get(ref)) is None:
+            kid_refs = self.resolve(self.get(ref)[0][b'/Kids'])
+            starts = [0]
+            for kid in kid_refs:
+                kid_node = self.get(kid)[0]
+                count = int(self.resolve(kid_node.get(b'/Count', b'1'))) \
+                    if kid_node.get(b'/Type') == b'/Pages' else 1
+                starts.append(starts[-1] + count)
+            kids = self.page_tree_nodes[ref] = (kid_refs, starts)
+        return kids
+
+    # The objects of a PDF containing the |n|th page and all the objects
+    # reachable from it (except for the page tree of the document), numbered
+    # consecutively from 1: the page tree, the catalog, the page, and the
+    # objects reachable from it.  For each object, we yield the serialized
+    # object up to (and including) keyword |stream|, or |endobj| if it is not a
+    # stream; and the span of the stream data, or |None|.
+    def page_objects(self, n):
+        ref, inherited = self.find_page(n)
+        page = dict(self.get(ref)[0])
+        for key, value in inherited.items():
+            page.setdefault(key, value)
+        page[b'/Parent'] = b'1 0 R'
+        yield b'1 0 obj\n<</Type /Pages /Kids [3 0 R] /Count 1>>\nendobj\n', None
+        yield b'2 0 obj\n<</Type /Catalog /Pages 1 0 R>>\nendobj\n', None
+        numbers = {ref: 3}
+        queue = [ref]
+        def renumber(r):
+            if r not in numbers:
+                numbers[r] = len(numbers) + 3
+                queue.append(r)
+            return numbers[r]
+        i = 0
+        while i < len(queue):
+            r = queue[i]
+            value, span = (page, None) if r == ref else self.get(r)
+            if span is not None:
+                value = dict(value)
+                value[b'/Length'] = b'%d' % span[1]
+            yield (b'%d 0 obj\n' % (i + 3) + serialize_pdf_object(value, renumber)
+                   + (b'\nstream\n' if span else b'\nendobj\n')), span
+            i += 1
+
+    # Write the PDF containing the |n|th page, through function |write|,
+    # except for the stream data, which is written by calling |copy| with its
+    # span.  Returns the size of the PDF.
+    def write_page(self, n, write, copy):
+        pos = 0
+        def emit(data):
+            nonlocal pos
+            write(data)
+            pos += len(data)
+        emit(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+        offsets = []
+        for head, span in self.page_objects(n):
+            offsets.append(pos)
+            emit(head)
+            if span:
+                copy(span)
+                pos += span[1]
+                emit(b'\nendstream\nendobj\n')
+        emit(b'xref\n0 %d\n0000000000 65535 f \n' % (len(offsets) + 1)
+             + b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+             + b'trailer\n<</Size %d /Root 2 0 R>>\nstartxref\n%d\n%%%%EOF\n'
+             % (len(offsets) + 1, pos))
+        return pos
+
+    # Build the PDF containing the |n|th page in memory, and load it using
+    # the backend.  We keep the last such PDF alive while its page is in use,
+    # as a |pikepdf| page does not hold on to its document.
+    def page(self, n):
+        out = []
+        self.write_page(n, out.append, lambda span: out.append(self.stream(span)))
+        self.page_pdf = self.backend.read(b''.join(out))
+        return self.page_pdf.pages[0]
+
+    # Write the PDF containing the |n|th page into |extern_file|, copying the
+    # stream data directly from the document file.  If the extern file
+    # |exists|, it is left untouched if it is identical to the PDF we would
+    # write, and otherwise replaced (rather than written into, as it may be a
+    # hard link to another extern, see |memoize_dedup.py|).  Returns whether
+    # the extern file was written.
+    def extract_page(self, n, extern_file, exists = False):
+        if exists and self.is_extracted(n, extern_file):
+            return False
+        out_file = extern_file.with_name(
+            f'{extern_file.name}.{os.getpid()}.tmp') if exists else extern_file
+        with open(out_file, 'wb') as f:
+            source, target = self.file.fileno(), f.fileno()
+            def copy(span):
+                f.flush()
+                copy_range(source, target, *span, self.data)
+            self.write_page(n, f.write, copy)
+        if exists:
+            os.replace(out_file, extern_file)
+        return True
+
+    # Is |extern_file| identical to the PDF containing the |n|th page?  As
+    # serializing the object closure of the page without the stream data is
+    # cheap, we first compare the sizes.  Only if they match do we compute the
+    # digest of the serialization, stream data included, and compare it to the
+    # digest of the file.
+    def is_extracted(self, n, extern_file):
+        try:
+            size = os.stat(extern_file).st_size
+        except FileNotFoundError:
+            return False
+        if size != self.write_page(n, lambda data: None, lambda span: None):
+            return False
+        import hashlib
+        digest = hashlib.sha256()
+        self.write_page(n, digest.update,
+                        lambda span: digest.update(self.stream(span)))
+        return digest.digest() == file_digest(extern_file)
+
+    # The media box of the |n|th page, as a list of numbers.
+    def media_box(self, n):
+        ref, inherited = self.find_page(n)
+        box = self.get(ref)[0].get(b'/MediaBox', inherited.get(b'/MediaBox'))
+        return [float(self.resolve(x)) for x in self.resolve(box)]
+
+    # \paragraph{Pruning}
+    
+    # Return an incremental update which removes the given pages (a set of
+    # zero-based page numbers) from the document.  Only the page tree nodes on
+    # the paths to the removed pages are rewritten, so the size of the update,
+    # and the time needed to produce it, is proportional to the number of the
+    # removed pages, not to the size of the document.
+    def prune(self, pages):
+        import bisect
+        changed = {}
+        # |removed| is a sorted list of the page numbers to remove, relative to
+        # the subtree rooted in |ref|.  Returns the new page count of the
+        # subtree.
+        def prune_node(ref, removed):
+            node = dict(self.get(ref)[0])
+            new_kids, offset = [], 0
+            for kid in self.resolve(node[b'/Kids']):
+                kid_node = self.get(kid)[0]
+                is_page = kid_node.get(b'/Type') == b'/Page' \
+                    or b'/Kids' not in kid_node
+                count = 1 if is_page \
+                    else int(self.resolve(kid_node.get(b'/Count', b'0')))
+                lo = bisect.bisect_left(removed, offset)
+                hi = bisect.bisect_left(removed, offset + count)
+                if lo == hi:
+                    new_kids.append(kid)
+                elif not is_page and \
+                     prune_node(kid, [n - offset for n in removed[lo:hi]]):
+                    new_kids.append(kid)
+                offset += count
+            node[b'/Kids'] = new_kids
+            node[b'/Count'] = b'%d' % (offset - len(removed))
+            changed[ref] = node
+            return offset - len(removed)
+        pages = sorted(n for n in pages if 0 <= n < self.page_count())
+        if pages:
+            prune_node(self.page_tree, pages)
+        # |pdfrw| lets the objects in object streams take precedence over their
+        # newer versions, so we give the changed objects which live in object
+        # streams new numbers.  If this happens to the page tree root, the
+        # catalog must change as well.
+        size = int(self.resolve(self.trailer.get(b'/Size', b'0')))
+        size = max([size] + [num + 1 for num in self.xref])
+        renumbered = {}
+        def renumber(ref):
+            nonlocal size
+            if isinstance(self.xref.get(ref[0]), tuple):
+                renumbered[ref] = Ref(size, 0)
+                size += 1
+        for ref in list(changed):
+            renumber(ref)
+        # The kids which a renumbered node keeps must point to it by their
+        # |/Parent| (which |relink| below takes care of), so they change as
+        # well.  They keep their numbers, as they may be referred to from
+        # elsewhere, e.g.\ a page by an outline entry.
+        for ref in list(renumbered):
+            for kid in changed[ref][b'/Kids']:
+                if kid not in changed:
+                    changed[kid] = dict(self.get(kid)[0])
+        trailer ={key: self.trailer[key] for key in (b'/Root', b'/Info', b'/ID')
+                   if key in self.trailer}
+        if self.page_tree in renumbered:
+            root = trailer[b'/Root']
+            changed[root] = dict(self.get(root)[0])
+            renumber(root)
+            trailer[b'/Root'] = renumbered.get(root, root)
+        def relink(value):
+            if isinstance(value, Ref):
+                return renumbered.get(value, value)
+            elif isinstance(value, dict):
+                return {key: relink(v) for key, v in value.items()}
+            elif isinstance(value, list):
+                return [relink(v) for v in value]
+            return value
+        return self.incremental_update(
+            {renumbered.get(ref, ref): relink(value)
+             for ref, value in changed.items()},
+            trailer, size)
+
+    # Serialize the given objects (a |dict| mapping references to values) as
+    # an incremental update of the document, with the given trailer entries.
+    # The cross-reference section of the update is a table or a stream,
+    # following the newest section of the document.
+    def incremental_update(self, objects, trailer, size):
+        base = len(self.data)
+        # Make sure the update starts on a new line.
+        out = [b''] if self.data[base-1:base] in (b'\n', b'\r') else [b'\n']
+        pos = base + len(out[0])
+        entries = []
+        for ref in sorted(objects):
+            chunk = b'%d %d obj\n' % ref \
+                + serialize_pdf_object(objects[ref]) + b'\nendobj\n'
+            entries.append((ref, pos))
+            out.append(chunk)
+            pos += len(chunk)
+        trailer = b' '.join(key + b' ' + serialize_pdf_object(value)
+                            for key, value in trailer.items())
+        if self.xref_is_stream:
+            # The cross-reference stream is an object itself.
+            entries.append((Ref(size, 0), pos))
+            size += 1
+            width = max(4, (pos.bit_length() + 7) // 8)
+            stream = b''.join(b'\x01' + offset.to_bytes(width, 'big')
+                              + ref[1].to_bytes(2, 'big')
+                              for ref, offset in entries)
+            index = b' '.join(b'%d 1' % ref[0] for ref, _ in entries)
+            out.append(b'%d 0 obj\n<</Type /XRef /Size %d /W [1 %d 2] '
+                       b'/Index [%s] /Prev %d /Length %d %s>>\nstream\n'
+                       % (size - 1, size, width, index, self.startxref,
+                          len(stream), trailer)
+                       + stream + b'\nendstream\nendobj\n')
+        else:
+            out.append(b'xref\n')
+            out.extend(b'%d 1\n%010d %05d n \n' % (ref[0], offset, ref[1])
+                       for ref, offset in entries)
+            out.append(b'trailer\n<</Size %d /Prev %d %s>>\n'
+                       % (size, self.startxref, trailer))
+        out.append(b'startxref\n%d\n%%%%EOF\n' % pos)
+        return b''.join(out)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+class LazyPdfPages:
+    def __init__(self, reader):
+        self.reader = reader
+        self.count = reader.page_count()
+    def __len__(self):
+        return self.count
+    def __getitem__(self, n):
+        if not 0 <= n < self.count:
+            raise IndexError(n)
+        return self.reader.page(n)
+
+# Copy |count| bytes at |offset| of the file open as file descriptor |source|
+# to the current position of file descriptor |target|.  We use
+# |os.copy_file_range| or, failing that, |os.sendfile|, so that the data is
+# copied by the kernel (or even shared by the file system); the last resort is
+# to write the data from |data|, the memory-mapped source file, in chunks.
+_kernel_copy = [name for name in ('copy_file_range', 'sendfile')
+                if hasattr(os, name)]
+
+def copy_range(source, target, offset, count, data):
+    while count and _kernel_copy:
+        try:
+            if _kernel_copy[0] == 'copy_file_range':
+                n = os.copy_file_range(source, target, count, offset)
+            else:
+                n = os.sendfile(target, source, offset, count)
+        except OSError:
+            # Not supported for these files (or by this kernel).
+            del _kernel_copy[0]
+            continue
+        if not n:
+            raise LazyPdfError('unexpected end of file')
+        offset += n
+        count -= n
+    while count:
+        n = os.write(target, data[offset:offset+min(count, 1 << 20)])
+        offset += n
+        count -= n
+
+def file_digest(path):
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.digest()
+
+# Write the extern file containing |page| through the backend.  If the extern
+# file |exists|, we serialize the PDF into memory, and compare its size and
+# then its digest to the extern file's; only if they differ is the extern file
+# replaced, so that an identical extern keeps its modification time.  (The
+# backends write deterministically, e.g.\ |pikepdf| derives the document ID
+# from the content.)  Returns whether the extern file was written.
+def backend_write_extern(backend, page, extern_file, exists = False):
+    if not exists:
+        backend.write([page], extern_file)
+        return True
+    import hashlib, io
+    buffer = io.BytesIO()
+    backend.write([page], buffer)
+    data = buffer.getvalue()
+    try:
+        if os.stat(extern_file).st_size == len(data) and \
+           hashlib.sha256(data).digest() == file_digest(extern_file):
+            return False
+    except FileNotFoundError:
+        pass
+    tmp_file = extern_file.with_name(f'{extern_file.name}.{os.getpid()}.tmp')
+    with open(tmp_file, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_file, extern_file)
+    return True
+
+# The peak memory usage of this process in bytes, or |None| if we can't tell.
+def peak_memory():
+    try:
+        import resource
+    except ImportError:
+        return
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+# \paragraph{Timings}
+
+# With |--timings|, we record the wall time, the CPU time and the peak memory
+# usage (of this process, so far) of every phase of the extraction, and of
+# writing every extern.  The phases may nest: e.g.\ phase |mmz| comprises
+# processing the |.mmz| file, including reading the PDF and writing the
+# externs.  Phase |kpathsea| is shared by all the documents processed by this
+# invocation (and it is absent when the job is performed by an extraction
+# server, which has performed the probe before).  The timings are written into
+# JSON file |doc.mmz.timings.json| and summarized in the log.  When disabled,
+# |start| returns |None|, and |stop| does nothing.
+class Timings:
+    def __init__(self, enabled = False, shared = ()):
+        self.enabled = enabled
+        self.phases = list(shared)
+        self.externs = []
+
+    def start(self):
+        if self.enabled:
+            import time
+            return time.perf_counter(), time.process_time()
+
+    def stop(self, phase, start, extern = None):
+        if start:
+            import time
+            record = {
+                'wall': round(time.perf_counter() - start[0], 6),
+                'cpu': round(time.process_time() - start[1], 6),
+                'peak_memory': peak_memory(),
+            }
+            if extern:
+                self.externs.append(dict(extern = str(extern), **record))
+            else:
+                self.phases.append(dict(phase = phase, **record))
+
+    # Record the timing of an extern written by a worker process, whose CPU
+    # time we got from the worker.
+    def add_extern(self, extern, wall, cpu):
+        if self.enabled:
+            self.externs.append({'extern': str(extern), 'wall': round(wall, 6),
+                                 'cpu': round(cpu, 6), 'peak_memory': None})
+
+    def summary(self):
+        phases = ', '.join(f"{p['phase']} {p['wall']:.3f}s"
+                           for p in self.phases if p['phase'] != 'total')
+        total = next((p for p in self.phases if p['phase'] == 'total'), None)
+        text = f"Timings: total {total['wall']:.3f}s" if total else "Timings:"
+        text += f" ({phases})" if phases else ''
+        if self.externs:
+            text += (f"; {len(self.externs)} externs written in "
+                     f"{sum(e['wall'] for e in self.externs):.3f}s")
+        if total and total['peak_memory']:
+            text += f"; peak memory {total['peak_memory']/2**20:.1f} MiB"
+        return text
+
+    def write(self, timings_file):
+        import json
+        with open(timings_file, 'w') as f:
+            json.dump({'phases': self.phases, 'externs': self.externs}, f,
+                      indent = 1)
+
+timings = Timings()
+# The timing of the kpathsea probe, shared by all documents.
+kpathsea_timings = Timings()
+
+# \paragraph{Extern writer processes}
+
+# With |--jobs|, the size and memo checks are still performed serially, but the
+# externs are serialized and written by a pool of worker processes.  The pool
+# is shared by all the documents processed in this invocation.  Each worker
+# reads the PDF of the current document by itself, unless it is forked and
+# inherits the PDF already read by the main process.
+
+pool = None
+# The PDF filename and the PDF object last used by the current process.
+_writer_pdf = (None, None)
+
+def extern_writer_pool(pdf, pdf_file, backend, jobs):
+    global _writer_pdf
+    from concurrent.futures import ProcessPoolExecutor
+    if isinstance(pdf, LazyPdfReader) or backend.fork_safe:
+        _writer_pdf = (pdf_file, pdf)
+    return ProcessPoolExecutor(max_workers = jobs or None)
+
+# Returns whether the extern file was written (see |backend_write_extern|),
+# and the wall and CPU time it took, for |--timings|.
+def write_extern(pdf_file, backend_name, lazy, raw, page_n, extern_file_out,
+                 exists):
+    global _writer_pdf
+    import time
+    start = time.perf_counter(), time.process_time()
+    backend = pdf_backend(backend_name)
+    if _writer_pdf[0] != pdf_file:
+        _writer_pdf = (pdf_file, LazyPdfReader(pdf_file, backend) if lazy
+                       else backend.read(pdf_file))
+    if raw:
+        written = _writer_pdf[1].extract_page(page_n, extern_file_out, exists)
+    else:
+        written = backend_write_extern(
+            backend, _writer_pdf[1].pages[page_n], extern_file_out, exists)
+    return (written, time.perf_counter() - start[0],
+            time.process_time() - start[1])
+
+# \paragraph{Rewriting the \texttt{.mmz} file}
+
+# The lines of the |.mmz| file, with the extracted |\mmzNewExtern|s commented
+# out, are streamed into a temporary file next to it, which atomically replaces
+# the |.mmz| file once the extraction is over.  An interrupted extraction
+# therefore leaves the original |.mmz| file intact.  The lines are only held in
+# memory until the first change; if nothing changes, nothing is written.  If
+# the temporary file cannot be created (say, the directory is not writable), we
+# keep buffering the lines and rewrite the |.mmz| file in place.
+class MmzRewriter:
+    def __init__(self, mmz_file):
+        self.mmz_file = mmz_file
+        self.tmp_file = mmz_file.with_name(f'{mmz_file.name}.{os.getpid()}.tmp')
+        self.out = None
+        self.lines = []
+        self.changed = False
+
+    def write(self, line, changed = False):
+        if changed and not self.changed:
+            self.changed = True
+            try:
+                self.out = open(self.tmp_file, 'x')
+            except OSError:
+                pass
+            else:
+                self.out.writelines(self.lines)
+                self.lines = None
+        if self.out:
+            self.out.write(line)
+        else:
+            self.lines.append(line)
+
+    def commit(self):
+        if self.out:
+            self.out.close()
+            self.out = None
+            os.chmod(self.tmp_file, os.stat(self.mmz_file).st_mode & 0o7777)
+            os.replace(self.tmp_file, self.mmz_file)
+        elif self.changed:
+            with open(self.mmz_file, 'w') as mmz:
+                mmz.writelines(self.lines)
+
+    def discard(self):
+        if self.out:
+            self.out.close()
+            self.out = None
+            os.unlink(self.tmp_file)
+
+# With |--journal|, the |.mmz| file is not rewritten at all.  Rather, the
+# extracted externs are appended to the journal, |doc.mmz.done|, as
+# |\mmzExtracted{<extern path>}|, where the path is given exactly as in the
+# |.mmz| file.  The journal is skipped by this script on the next run, and by
+# the \hologo{TeX}-based extraction.  Its first line records the size and the
+# modification time of the |.mmz| file it belongs to; when Memoize writes a new
+# |.mmz| file, the journal is emptied, and ignored by this script anyway.
+re_journal = re.compile(r'\\mmzExtracted{(?P<extern_path>.*)}$')
+
+def journal_stamp(mmz_file):
+    stat = os.stat(mmz_file)
+    return f'% {stat.st_size} {stat.st_mtime_ns}'
+
+# Returns the set of extern paths listed in the journal, or |None| if the
+# journal does not exist or does not belong to the |.mmz| file.
+def read_journal(journal_file, stamp):
+    try:
+        with open(journal_file) as journal:
+            if journal.readline().rstrip('\n') != stamp:
+                return
+            return {m['extern_path'] for line in journal
+                    if (m := re_journal.match(line.rstrip('\n')))}
+    except FileNotFoundError:
+        return
+
+# \paragraph{The catalog}
+
+# With |--catalog|, the memos and externs listed in the |.mmz| file are
+# recorded in the catalogs (see |memoize_catalog.py|) of the directories
+# holding them.  The time of the compilation is the modification time of the
+# |.mmz| file.  The size of a file is only looked up for the new memos and
+# externs, and for the files not catalogued yet.
+def update_catalog(records, mmz_file):
+    from memoize_catalog import Catalog, CATALOG_NAME
+    document = os.path.abspath(mmz_file)
+    last_used = os.stat(mmz_file).st_mtime
+    directories = {}
+    for record in records:
+        f = find_in(Path(record.path))
+        names, new = directories.setdefault(f.parent, ([], set()))
+        names.append(f.name)
+        if record.new:
+            new.add(f.name)
+    for directory, (names, new) in directories.items():
+        catalog_file = directory / CATALOG_NAME
+        if not (os.path.isdir(directory) and _paranoia(catalog_file, openout_any)
+                and access_out(catalog_file)):
+            report(f"Cannot update catalog '{catalog_file}'")
+            continue
+        catalog = Catalog(directory)
+        catalog.record(names, document, last_used, new)
+        catalog.close()
+        report(f"Recorded {len(names)} files in catalog '{catalog_file}'")
+
+# \paragraph{The global store}
+
+# With |--store|, the memos and externs are shared across documents through a
+# machine-wide store.  An entry is keyed by the filename of the memo or extern
+# without its path prefix (see |memo_key| in |memoize_mmz.py|), and stored as
+# |<store>/<first two characters>/<key>|.
+#
+# After extraction, a memo or extern listed in the |.mmz| file is published
+# into the store, by hard-linking it, unless the store already has it.  If the
+# document lacks a file the store has, the file is materialized in the
+# document's directory, again as a hard link, so that the next compilation
+# finds it.  A store entry is therefore referenced by its other hard links,
+# which allows |memoize-clean.py --gc-store| to remove the entries no document
+# uses.  Where a hard link cannot be made (e.g.\ across file systems), the
+# file is copied, and the path of the copy is recorded in |<entry>.refs|
+# instead.
+def store_entry(store, name):
+    from memoize_mmz import memo_key
+    if key := memo_key(name):
+        return store / key[:2] / key
+
+def link_or_copy(source, target, entry, referrer):
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        raise
+    except OSError:
+        import shutil
+        tmp = target.with_name(f'{target.name}.{os.getpid()}.tmp')
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, target)
+        with open(entry.with_name(entry.name + '.refs'), 'a') as refs:
+            print(os.path.abspath(referrer), file = refs)
+
+def update_store(records, store):
+    published = materialized = 0
+    for record in records:
+        f = find_in(Path(record.path))
+        if not (entry := store_entry(store, f.name)):
+            continue
+        if access_in(f):
+            if not entry.exists():
+                entry.parent.mkdir(parents = True, exist_ok = True)
+                try:
+                    link_or_copy(f, entry, entry, f)
+                except FileExistsError:
+                    # Published concurrently by another document.
+                    continue
+                published += 1
+        elif entry.exists():
+            f = find_out(Path(record.path))
+            paranoia_out(f)
+            mkdir(Path(record.path).parent)
+            link_or_copy(entry, f, entry, f)
+            listings.created(f)
+            materialized += 1
+    report(f"Published {published} and materialized {materialized} files "
+         f"through store '{store}'")
+
+# \paragraph{Deduplication}
+
+# With |--dedup|, an extracted extern identical to an extern already in its
+# directory (typically, the same picture memoized in another context) is
+# replaced by a hard link to that extern, see |memoize_dedup.py|.  Only the
+# externs of the same size are compared, so the other externs are not read.
+def dedup_externs(extern_files):
+    from memoize_dedup import Deduplicator
+    deduplicator = Deduplicator(report = info)
+    for extern_file in extern_files:
+        deduplicator.scan(extern_file.parent)
+    for extern_file in extern_files:
+        deduplicator.dedup(extern_file)
+    report(deduplicator.summary())
+
+# \paragraph{The remote cache}
+
+# With |--remote|, the memos and externs listed in the |.mmz| file are pushed
+# to a remote cache (see |memoize_remote.py|), from which command |pull| of
+# that script can fetch them before a compilation on another machine.  As the
+# cache is only an optimization, failing to reach it is not an error, and
+# neither is a malformed response of an HTTP cache.
+def push_to_remote(records, location):
+    from memoize_remote import backend, push, cache_errors
+    from memoize_mmz import memo_key
+    files = []
+    for record in records:
+        f = find_in(Path(record.path))
+        if (key := memo_key(f.name)) and access_in(f):
+            files.append((key, f))
+    cache = backend(location)
+    try:
+        n = push(cache, files, max(args.jobs, 1) * 4)
+        report(f"Pushed {n} of {len(files)} files to remote cache '{location}'")
+    except cache_errors() as err:
+        warning(f"Cannot push to remote cache '{location}': {err!r}")
+    finally:
+        cache.close()
+
+# \paragraph{Arguments}
+
+# The argument of |--jobs|: a non-negative number.
+def jobs_type(jobs):
+    if not re.fullmatch(r'[0-9]+', jobs):
+        import argparse
+        raise argparse.ArgumentTypeError(f"invalid number of jobs: '{jobs}'")
+    return int(jobs)
+
+def argument_parser():
+    import argparse
     parser = argparse.ArgumentParser(
         description = "Extract extern pages produced by package Memoize "
                       "out of the document PDF.",
@@ -326,26 +1813,161 @@ if __name__ == '__main__':
     parser.add_argument('-P', '--pdf', help = 'extract from file PDF')
     parser.add_argument('-p', '--prune', action = 'store_true',
         help = 'remove the extern pages after extraction')
+    parser.add_argument('--prune-rewrite', action = 'store_true',
+        help = 'prune by rewriting the PDF rather than appending '
+               'an incremental update')
     parser.add_argument('-k', '--keep', action = 'store_true',
         help = 'do not mark externs as extracted')
+    parser.add_argument('--journal', action = 'store_true',
+        help = 'mark externs as extracted in journal MMZ.done '
+               'rather than in the record file')
     parser.add_argument('-F', '--format', choices = ['latex', 'plain', 'context'],
         help = 'the format of the TeX document invoking extraction')
     parser.add_argument('-f', '--force', action = 'store_true',
         help = 'extract even if the size-check fails')
     parser.add_argument('-q', '--quiet', action = 'store_true',
-        help = "describe what's happening")
+        help = "only report warnings and errors, and only in the log")
+    parser.add_argument('-v', '--verbose', action = 'store_true',
+        help = "report every extern, rather than summarizing the extraction")
+    parser.add_argument('-l', '--lazy', action = 'store_true',
+        help = 'only read the parts of the PDF needed for extraction '
+               '(ignored with --prune-rewrite)')
+    parser.add_argument('--raw', action = 'store_true',
+        help = 'copy the extern pages from the PDF byte for byte, '
+               'rather than through the PDF backend (implies --lazy)')
+    parser.add_argument('--backend',
+        default = os.environ.get('MEMOIZE_EXTRACT_BACKEND', 'auto'),
+        choices = ['auto'] + list(BACKENDS),
+        help = 'the library used to read the PDF and write the externs '
+               '(default: $MEMOIZE_EXTRACT_BACKEND, or the first installed '
+               'one of %(choices)s)')
+    parser.add_argument('-j', '--jobs', type = jobs_type, default = 1,
+        metavar = 'N',
+        help = 'write the externs using N processes (0 = number of CPUs)')
     parser.add_argument('-m', '--mkdir', action = 'store_true',
         help = 'create a directory (and exit); '
                'mmz argument is interpreted as directory name')
+    parser.add_argument('--serve', action = 'store_true',
+        help = 'run an extraction server (the mmz argument is not given)')
+    parser.add_argument('--socket',
+        help = 'the socket of the extraction server')
+    parser.add_argument('--no-server', action = 'store_true',
+        help = 'do not hand the job over to an extraction server')
+    parser.add_argument('--dedup', action = 'store_true',
+        help = 'store an extern identical to another extern in its directory '
+               'as a hard link to that extern')
+    parser.add_argument('--catalog', action = 'store_true',
+        help = 'record the memos and externs in the catalog '
+               'of the memo directory')
+    parser.add_argument('--timings', action = 'store_true',
+        help = 'record the time and memory spent by every phase '
+               'into MMZ.timings.json')
+    parser.add_argument('--remote', metavar = 'CACHE',
+        help = 'push the memos and externs to the remote CACHE '
+               '(a directory or an HTTP URL)')
+    parser.add_argument('--store', metavar = 'DIR',
+        help = 'share the memos and externs with other documents '
+               'through the global store DIR')
     parser.add_argument('-V', '--version', action = 'version',
         version = f"%(prog)s of Memoize " + __version__)
-    parser.add_argument('mmz', help = 'the record file produced by Memoize: '
-                                      'doc.mmz when compiling doc.tex '
-                                      '(doc and doc.tex are accepted as well)')
+    parser.add_argument('-M', '--manifest',
+        help = 'extract from the documents listed in file MANIFEST '
+               '(one .mmz per line, optionally followed by a tab and the PDF)')
+    parser.add_argument('mmz', nargs = '*',
+                        help = 'the record file produced by Memoize: '
+                               'doc.mmz when compiling doc.tex '
+                               '(doc and doc.tex are accepted as well); '
+                               'several record files may be given')
+    return parser
+
+# A namespace holding the parsed arguments, for when we don't use |argparse|.
+class Arguments:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
 
+def main():
+    global args
+    # The fast path for the invocation issued by Memoize to create the memo
+    # directory: |--mkdir| followed by the directory name.  We don't need to
+    # build the argument parser for that, nor to contact the extraction server.
+    if len(sys.argv) == 3 and sys.argv[1] in ('-m', '--mkdir') \
+       and not sys.argv[2].startswith('-'):
+        args = Arguments(mkdir = True, mmz = [sys.argv[2]], pdf = None,
+                         manifest = None, format = None, quiet = False)
+        kpathsea()
+        output_directories()
+        run(args)
+    parser = argument_parser()
     args = parser.parse_args()
+    if not (args.mmz or args.manifest or args.serve):
+        parser.error('the following arguments are required: mmz')
+    if args.pdf and len(args.mmz) + bool(args.manifest) > 1:
+        parser.error('argument --pdf requires a single mmz argument')
+    if args.serve:
+        serve(server_socket(args.socket), args.backend)
+    if not args.no_server:
+        client(sys.argv[1:], server_socket(args.socket))
+    t = Timings(args.timings).start()
+    kpathsea()
+    output_directories()
+    kpathsea_timings.stop('kpathsea', t)
+    run(args)
+
+# \paragraph{Extraction}
+
+# Perform the job specified by the (parsed) command-line arguments: process
+# the given documents in turn, and exit with the most severe of their exit
+# codes.  Every document gets its own log.
+def run(arguments):
+    global log, exit_code, indent, texindent, listings
+    documents = [(mmz, arguments.pdf) for mmz in arguments.mmz]
+    if arguments.manifest:
+        documents.extend(read_manifest(arguments.manifest))
+    combined_exit_code = 0
+    for mmz, pdf in documents:
+        try:
+            extract(Arguments(**dict(vars(arguments), mmz = mmz, pdf = pdf)))
+        except SystemExit as e:
+            combined_exit_code = max(combined_exit_code,
+                                     e.code if isinstance(e.code, int)
+                                     else 0 if e.code is None else 1)
+        # Reset the message state for the next document.
+        if log:
+            log.close()
+        log, exit_code, indent, texindent = None, 0, '', ''
+        listings = DirectoryListings()
+    if pool:
+        pool.shutdown()
+    sys.exit(combined_exit_code)
+
+# A manifest lists a document per line: the |.mmz| file, optionally followed by
+# a tab and the PDF file.  Empty lines and lines starting with |#| are ignored.
+# As the manifest is read before any document is processed, failing to read it
+# is an error of the entire invocation.
+def read_manifest(manifest):
+    manifest = find_in(Path(manifest))
+    paranoia_in(manifest)
+    documents = []
+    try:
+        with open(manifest) as f:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if line.strip() and not line.lstrip().startswith('#'):
+                    mmz, _, pdf = line.partition('\t')
+                    documents.append((mmz, pdf or None))
+    except (OSError, UnicodeDecodeError) as err:
+        error(f"I cannot read manifest '{manifest}'", str(err))
+    return documents
 
-    header = parser.prog + ': ' if args.format else ''
+# Extract the externs of a single document.  This function exits, either
+# through |endinput| or |sys.exit|.
+def extract(arguments):
+    global args, header, log, indent, texindent, pool, _writer_pdf, listings, \
+        timings
+    args = arguments
+    listings = DirectoryListings(enabled = True)
+
+    header = 'memoize-extract.py: ' if args.format else ''
     
     # Start a new line in the TeX terminal output.
     if args.format:
@@ -358,6 +1980,14 @@ if __name__ == '__main__':
         mkdir(args.mmz)
         sys.exit()
 
+    # |--prune-rewrite| implies |--prune|.
+    args.prune = args.prune or args.prune_rewrite
+
+    timings = Timings(args.timings, kpathsea_timings.phases)
+    t_total = timings.start()
+    import time
+    start_time = time.perf_counter()
+
     # Normalize the |mmz| argument into a |.mmz| filename.
     mmz_file = Path(args.mmz)
     if mmz_file.suffix == '.tex':
@@ -372,15 +2002,8 @@ if __name__ == '__main__':
         info(f"Logging to '{log_file}'");
         log = open(log_file, 'w')
 
-    # Now that we have opened the log file, we can try loading the PDF
-    # processing library.
-    try:
-        import pdfrw
-    except ModuleNotFoundError:
-        error("Python module 'pdfrw' was not found",
-              'Have you followed the instructions is section 1.1 of the manual?')
-
     # Catch any errors in the script and output them to the log.
+    rewriter = None
     try:
         
         # Find the |.mmz| file we will read, but retain the original filename
@@ -388,15 +2011,36 @@ if __name__ == '__main__':
         given_mmz_file = mmz_file
         mmz_file = find_in(mmz_file)
         paranoia_in(mmz_file)
-        if not args.keep:
+        if not (args.keep or args.journal):
             paranoia_out(mmz_file,
-                remark = 'This file is rewritten unless option --keep is given.')
+                remark = 'This file is rewritten unless option --keep '
+                         'or --journal is given.')
         try:
             mmz = open(mmz_file)
         except FileNotFoundError:
-            info(f"File '{given_mmz_file}' does not exist, "
+            report(f"File '{given_mmz_file}' does not exist, "
                  f"assuming there's nothing to do")
             endinput()
+        # Most compilations produce no new externs.  Unless we need all the
+        # records anyway, or are timing the phases, a quick scan tells us
+        # whether there is anything to extract, so that in this common case,
+        # we neither resolve the PDF path nor parse the |.mmz| file.
+        if not (args.catalog or args.store or args.remote or args.timings):
+            from memoize_mmz import has_pending_externs
+            if not has_pending_externs(mmz):
+                mmz.close()
+                info(f"Extracting new externs listed in '{mmz_file}'")
+                report("Done (there was nothing to extract)")
+                endinput()
+        # With |--journal|, the externs listed in the journal are skipped.
+        journaled = set()
+        if args.journal and not args.keep:
+            journal_file = find_out(mmz_file.with_suffix('.mmz.done'))
+            paranoia_out(journal_file)
+            stamp = journal_stamp(mmz_file)
+            journaled = read_journal(journal_file, stamp)
+            journal_is_valid = journaled is not None
+            journaled = journaled or set()
 
         # Determine the PDF filename: it is either given via |--pdf|, or
         # constructed from the |.mmz| filename.
@@ -408,20 +2052,20 @@ if __name__ == '__main__':
                 remark = 'I would have to rewrite this file '
                          'because option --prune was given.')
 
-        # Various initializations.
+        # Various initializations.  The |.mmz| parser is shared with
+        # |memoize-clean.py|.
         
-        re_prefix = re.compile(r'\\mmzPrefix *{(?P<prefix>.*?)}')
-        re_split_prefix = re.compile(r'(?P<dir_prefix>.*/)?(?P<name_prefix>.*?)')
-        re_newextern = re.compile(
-            r'\\mmzNewExtern *{(?P<extern_path>.*?)}{(?P<page_n>[0-9]+)}'
-            r'{(?P<expected_width>[0-9.]*)pt}{(?P<expected_height>[0-9.]*)pt}')
-        re_extern_path = re.compile(
-            r'(?P<dir_prefix>.*/)?(?P<name_prefix>.*?)'
-            r'(?P<code_md5sum>[0-9A-F]{32})-'
-            r'(?P<context_md5sum>[0-9A-F]{32})(?:-[0-9]+)?.pdf')
+        from memoize_mmz import parse_mmz, Prefix, Memo, Extern, \
+            re_split_prefix, re_extern_path
         pdf = None
+        backend = None
+        raw = False
+        unchanged = 0
+        written_externs = []
+        extern_writers = []
         extern_pages = []
-        new_mmz = []
+        extracted = []
+        memos_and_externs = []
         tolerance = 0.01
         dir_to_make = None
         info(f"Extracting new externs listed in '{mmz_file}' from '{pdf_file}'")
@@ -431,32 +2075,45 @@ if __name__ == '__main__':
 
         # \paragraph{Process \texttt{.mmz}}
 
-        for line in mmz:
+        if not (args.keep or args.journal):
+            rewriter = MmzRewriter(mmz_file)
+        # We only need the prefixes and the pending externs; the other lines
+        # are passed through as they are.  With |--catalog|, |--store| and
+        # |--remote|, we need all the memos and externs.
+        everything = args.catalog or args.store or args.remote
+        t_mmz = timings.start()
+        for text, record in parse_mmz(mmz, pending = not everything):
+            if everything and isinstance(record, (Memo, Extern)):
+                memos_and_externs.append(record)
             try:
-                if m_p := re_prefix.match(line):
+                if isinstance(record, Prefix):
                     # Found |\mmzPrefix|: create the extern directory, but only
                     # later, if an extern file is actually produced.  We parse
                     # the prefix in two steps because we have to unquote the
                     # entire prefix.
-                    prefix = unquote(m_p['prefix'])
+                    prefix = record.path
                     if not (m_sp := re_split_prefix.match(prefix)):
-                        warning(f"Cannot parse line {line.strip()}")
+                        warning(f"Cannot parse line {text.strip()}")
                     dir_to_make = m_sp['dir_prefix']
-                elif m_ne := re_newextern.match(line):
+                elif isinstance(record, Extern) and record.new \
+                     and not record.commented:
                     # Found |\mmzNewExtern|: extract the extern page into an
-                    # extern file.
+                    # extern file, unless it was already extracted according
+                    # to the journal.
+                    if record.raw_path in journaled:
+                        raise NotExtracted()
                     done_message = "Done"
                     # The extern filename, as specified in |.mmz|:
-                    unquoted_extern_path = unquote(m_ne['extern_path'])
+                    unquoted_extern_path = record.path
                     extern_file = Path(unquoted_extern_path)
                     # We parse the extern filename in a separate step because
                     # we have to unquote the entire path.
                     if not (m_ep := re_extern_path.match(unquoted_extern_path)):
-                        warning(f"Cannot parse line {line.strip()}")
+                        warning(f"Cannot parse line {text.strip()}")
                     # The actual extern filename:
                     extern_file_out = find_out(extern_file)
                     paranoia_out(extern_file_out)
-                    page_n = int(m_ne['page_n'])-1
+                    page_n = record.page - 1
                     # Check whether c-memo and cc-memo exist (in any input
                     # directory).
                     c_memo = extern_file.with_name(
@@ -476,13 +2133,36 @@ if __name__ == '__main__':
                     # Load the PDF.  We only do this now so that we don't load
                     # it if there is nothing to extract.
                     if not pdf:
+                        # The same goes for the PDF processing library.  We can
+                        # report a failure to import it, as we have already
+                        # opened the log file.
+                        t = timings.start()
+                        try:
+                            backend = pdf_backend(args.backend)
+                        except ModuleNotFoundError as err:
+                            error(str(err),
+                                  'Have you followed the instructions is '
+                                  'section 1.1 of the manual?')
+                        timings.stop(f'import {backend.name}', t)
+                        t = timings.start()
                         if not access_in(pdf_file):
                             warning(f"Cannot open '{pdf_file}'")
                             endinput()
                         try:
                             # All safe, |paranoia_in| was already called above.
-                            pdf = pdfrw.PdfReader(pdf_file)
-                        except pdfrw.errors.PdfParseError as err:
+                            # Pruning by rewriting the PDF needs all the
+                            # pages, so we can't be lazy.
+                            if (args.lazy or args.raw) \
+                               and not args.prune_rewrite:
+                                try:
+                                    pdf = LazyPdfReader(pdf_file, backend)
+                                except LazyPdfError as err:
+                                    info(f"Cannot read '{pdf_file}' lazily "
+                                         f"({err}), reading it in full")
+                                    pdf = backend.read(pdf_file)
+                            else:
+                                pdf = backend.read(pdf_file)
+                        except backend.errors as err:
                             error(rf"File '{pdf_file}' seems corrupted. Perhaps you "
                                   rf"have to load Memoize earlier in the preamble",
                                   rf"In particular, Memoize must be loaded before "
@@ -491,17 +2171,22 @@ if __name__ == '__main__':
                                   rf"by writing \RequirePackage{{memoize}} before "
                                   rf"\documentclass{{beamer}}. "
                                   rf"This was the error thrown by Python: \n{err}")
+                        timings.stop('read pdf', t)
+                        # Copy the extern pages byte for byte?
+                        raw = args.raw and isinstance(pdf, LazyPdfReader)
                     # Does the page exist?
                     if page_n >= len(pdf.pages):
                         error(rf"I cannot extract page {page_n} from '{pdf_file}', "
                               rf"as it contains only {len(pdf.pages)} page" +
                               ('s' if len(pdf.pages) > 1 else ''), '')
                     # Check whether the page size matches the |.mmz|
-                    # expectations.
-                    page = pdf.pages[page_n]
-                    expected_width_pt = float(m_ne['expected_width'])
-                    expected_height_pt = float(m_ne['expected_height'])
-                    mb = page['/MediaBox']
+                    # expectations.  When copying the page byte for byte, we
+                    # don't need to load it.
+                    page = None if raw else pdf.pages[page_n]
+                    expected_width_pt = float(record.width)
+                    expected_height_pt = float(record.height)
+                    mb = pdf.media_box(page_n) if raw \
+                        else backend.media_box(page)
                     width_bp = float(mb[2]) - float(mb[0])
                     height_bp = float(mb[3]) - float(mb[1])
                     width_pt = width_bp / 72 * 72.27
@@ -522,49 +2207,183 @@ if __name__ == '__main__':
                         dir_to_make = None
                     # Now the extern file.  Note that |paranoia_out| was
                     # already called above.
-                    info(f"Page {page_n+1} --> {extern_file_out}")
-                    extern = pdfrw.PdfWriter(extern_file_out)
-                    extern.addpage(page)
-                    extern.write()
+                    # If the extern file exists (e.g.\ because the
+                    # previous extraction was interrupted before rewriting
+                    # the |.mmz| file), we leave it untouched if it is
+                    # identical to the extern we would write.
+                    exists = listings.exists(extern_file_out)
+                    if args.jobs == 1:
+                        t = timings.start()
+                        if raw:
+                            written = pdf.extract_page(
+                                page_n, extern_file_out, exists)
+                        else:
+                            written = backend_write_extern(
+                                backend, page, extern_file_out, exists)
+                        timings.stop('extern', t, extern = extern_file_out)
+                        info(f"Page {page_n+1} --> {extern_file_out}"
+                             + ('' if written else ' (unchanged)'))
+                        unchanged += not written
+                        if written:
+                            written_externs.append(extern_file_out)
+                        listings.created(extern_file_out)
+                    else:
+                        # Hand the page over to an extern writer process.
+                        if not pool:
+                            pool = extern_writer_pool(pdf, pdf_file, backend,
+                                                      args.jobs)
+                        info(f"Page {page_n+1} --> {extern_file_out}")
+                        extern_writers.append((extern_file_out, pool.submit(
+                            write_extern, pdf_file, backend.name,
+                            isinstance(pdf, LazyPdfReader), raw,
+                            page_n, extern_file_out, exists)))
+                        listings.created(extern_file_out)
                     # This page will get pruned.
                     if args.prune:
                         extern_pages.append(page_n)
-                    # Comment out this |\mmzNewExtern|.
-                    if not args.keep:
-                        line = '%' + line
+                    # Remember to mark this |\mmzNewExtern| as extracted.
+                    extracted.append(record.raw_path)
+                    if rewriter:
+                        rewriter.write('%' + text, changed = True)
+                        continue
             except NotExtracted:
                 pass
-            finally:
-                if not args.keep:
-                    new_mmz.append(line)
+            if rewriter:
+                rewriter.write(text)
         mmz.close()
+        # Wait for the extern writer processes.  Any exception raised while
+        # writing an extern is re-raised here, in the order of the externs in
+        # the |.mmz| file, so the outcome does not depend on the scheduling.
+        for extern_file_out, extern_writer in extern_writers:
+            written, wall, cpu = extern_writer.result()
+            unchanged += not written
+            if written:
+                written_externs.append(extern_file_out)
+            timings.add_extern(extern_file_out, wall, cpu)
+        timings.stop('mmz', t_mmz)
         indent = ''
         texindent = ''
-        info(done_message)
+        if isinstance(pdf, LazyPdfReader):
+            peak = peak_memory()
+            info(f"Read {pdf.objects_read} of {len(pdf.xref)} objects "
+                 f"from '{pdf_file}'" + (f" (peak memory {peak/2**20:.1f} MiB)"
+                                         if peak else ''))
+        if args.dedup and written_externs:
+            t = timings.start()
+            dedup_externs(written_externs)
+            timings.stop('dedup', t)
+        if args.store:
+            t = timings.start()
+            update_store(memos_and_externs, Path(args.store).absolute())
+            timings.stop('store', t)
+        if args.catalog:
+            t = timings.start()
+            update_catalog(memos_and_externs, mmz_file)
+            timings.stop('catalog', t)
+        if args.remote:
+            t = timings.start()
+            push_to_remote(memos_and_externs, args.remote)
+            timings.stop('remote', t)
 
-        # Write out the |.mmz| file with |\mmzNewExtern| lines commented
-        # out. (All safe, |paranoia_out| was already called above.)
-        if not args.keep:
-            with open(mmz_file, 'w') as mmz:
-                for line in new_mmz:
-                    print(line, file = mmz, end = '')
+        # Replace the |.mmz| file by the version with the extracted
+        # |\mmzNewExtern| lines commented out, or append the extracted externs
+        # to the journal.  (All safe, |paranoia_out| was already called
+        # above.)
+        t = timings.start()
+        if rewriter:
+            rewriter.commit()
+        elif args.journal and extracted and not args.keep:
+            with open(journal_file, 'a' if journal_is_valid else 'w') as journal:
+                if not journal_is_valid:
+                    print(stamp, file = journal)
+                for extern_path in extracted:
+                    print(rf'\mmzExtracted{{{extern_path}}}', file = journal)
+        timings.stop('rewrite mmz', t)
 
-        # Remove the extracted pages from the original PDF. (All safe,
-        # |paranoia_out| was already called above.)
+        # Remove the extracted pages from the original PDF, by appending an
+        # incremental update or, with |--prune-rewrite| or if the PDF cannot be
+        # read lazily, by rewriting it. (All safe, |paranoia_out| was already
+        # called above.)
         if args.prune and extern_pages:
-            pruned_pdf = pdfrw.PdfWriter(pdf_file)
-            pruned_pdf.addpages(
-                page for n, page in enumerate(pdf.pages) if n not in extern_pages)
-            pruned_pdf.write()
+            t = timings.start()
+            pruned = set(extern_pages)
+            update = None
+            if not args.prune_rewrite:
+                try:
+                    if not isinstance(pdf, LazyPdfReader):
+                        pdf = LazyPdfReader(pdf_file, backend)
+                    update = pdf.prune(pruned)
+                except LazyPdfError as err:
+                    info(f"Cannot prune '{pdf_file}' incrementally ({err}), "
+                         f"rewriting it")
+            # We are done reading the PDF lazily.
+            if isinstance(pdf, LazyPdfReader):
+                pdf.close()
+                pdf = None
+                _writer_pdf = (None, None)
+            if update is not None:
+                with open(pdf_file, 'ab') as f:
+                    f.write(update)
+            else:
+                # We write the pruned PDF into a temporary file, as the
+                # backend may still be reading the original.
+                pdf = pdf or backend.read(pdf_file)
+                pruned_file = pdf_file.with_name(
+                    f'{pdf_file.name}.{os.getpid()}.tmp')
+                backend.write((page for n, page in enumerate(pdf.pages)
+                               if n not in pruned), pruned_file)
+                os.replace(pruned_file, pdf_file)
             info(f"The following extern pages were pruned out of the PDF: " +
                  ",".join(str(page+1) for page in extern_pages))
+            timings.stop('prune', t)
+
+        # Summarize the extraction.
+        if done_message == "Done":
+            n = len(written_externs)
+            size = sum(os.stat(f).st_size for f in written_externs)
+            remarks = [f"wrote {n} extern{'' if n == 1 else 's'}, "
+                       f"{size} bytes, in "
+                       f"{time.perf_counter() - start_time:.2f}s"]
+            if unchanged:
+                remarks.append(f"{unchanged} identical extern"
+                               f"{'s were' if unchanged > 1 else ' was'} "
+                               f"left untouched")
+            if args.prune and extern_pages:
+                remarks.append(f"pruned {len(extern_pages)} page"
+                               f"{'' if len(extern_pages) == 1 else 's'} "
+                               f"out of the PDF")
+            if (saved := listings.report()) > 0:
+                remarks.append(f"directory listings saved {saved} "
+                               f"file system calls")
+            done_message += f" ({'; '.join(remarks)})"
+        report(done_message)
+
+        # Write the timings.
+        if args.timings:
+            timings.stop('total', t_total)
+            timings_file = find_out(
+                given_mmz_file.with_suffix('.mmz.timings.json'))
+            paranoia_out(timings_file)
+            timings.write(timings_file)
+            report(timings.summary())
 
         # Report that extraction was successful.
         endinput()
 
     # Catch any errors in the script and output them to the log.
     except Exception as err:
+        import traceback
         error(f'Python error: {err}', traceback.format_exc())
+
+    # If we exit before the rewrite is committed, the |.mmz| file is left
+    # intact.
+    finally:
+        if rewriter:
+            rewriter.discard()
+
+# We don't delve into the real script when loaded from the testing code.
+if __name__ == '__main__':
+    main()
         
 # Local Variables:
 # fill-column: 79
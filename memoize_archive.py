@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+# This file is a part of Memoize, a TeX package for externalization of
+# graphics and memoization of compilation results in general, available at
+# https://ctan.org/pkg/memoize and https://github.com/sasozivanovic/memoize.
+#
+# Copyright (c) 2020- Saso Zivanovic <saso.zivanovic@guest.arnes.si>
+#
+# This work may be distributed and/or modified under the conditions of the
+# LaTeX Project Public License, either version 1.3c of this license or (at
+# your option) any later version.  The latest version of this license is in
+# https://www.latex-project.org/lppl.txt and version 1.3c or later is part of
+# all distributions of LaTeX version 2008 or later.
+#
+# This work has the LPPL maintenance status `maintained'.
+# The Current Maintainer of this work is Saso Zivanovic.
+#
+# The files belonging to this work and covered by LPPL are listed in
+# <texmf>/doc/generic/memoize/FILES.
+
+__version__ = '2024/12/02 v1.4.1'
+
+# This script packs the memos and externs used by a compilation into a single
+# archive, and unpacks them, e.g.\ to restore the memo directory of a document
+# from a build artifact at the price of a single sequential read.  Command
+# |export| archives exactly the memos and externs listed in the given |.mmz|
+# files; command |import| unpacks an archive in a single streaming pass (the
+# archive may be read from the standard input), skipping the files which
+# already exist with the same content; command |list| shows the index.
+#
+# The archive consists of the entries, followed by the index and the trailer.
+# An entry is a header --- magic |MMZE|, the length of the path, the length of
+# the content, and the SHA-256 digest of the content --- followed by the path
+# (relative to the base directory of export, in UTF-8) and the content.  The index,
+# introduced by magic |MMZI|, repeats the headers with the offsets of the
+# entries, and the trailer gives the offset of the index and the number of
+# entries, so that the index can be read without scanning the archive.
+
+import hashlib, os, struct, sys
+from pathlib import Path, PurePosixPath
+
+MAGIC = b'MMZA\x01\n'
+_entry = struct.Struct('>4sHQ32s')          # magic, path length, size, digest
+_index_entry = struct.Struct('>QHQ32s')     # offset, path length, size, digest
+_trailer = struct.Struct('>4sQQ')           # magic, index offset, entries
+
+class ArchiveError(Exception):
+    pass
+
+# \paragraph{Export}
+
+# The memos and externs listed in the given |.mmz| files, as |(file, name)|
+# pairs: the file as found from the current directory, and the name under
+# which it is archived, i.e.\ its path relative to directory |base|.  A file
+# listed by several documents is archived once.  A file outside |base| could
+# not be unpacked (see |_safe_path|), so we refuse to archive it.
+def listed_files(mmz_files, base = '.'):
+    from memoize_mmz import parse_mmz, Memo, Extern
+    files = {}
+    for mmz_file in mmz_files:
+        mmz_parent = Path(mmz_file).parent
+        with open(mmz_file) as mmz:
+            for line, record in parse_mmz(mmz):
+                if isinstance(record, (Memo, Extern)):
+                    f = mmz_parent / record.path
+                    name = os.path.relpath(f, base).replace(os.sep, '/')
+                    try:
+                        _safe_path(name)
+                    except ArchiveError:
+                        raise ArchiveError(
+                            f"Refusing to archive '{f}', which is outside "
+                            f"'{base}' (use option --directory)")
+                    files.setdefault(name, f)
+    return [(f, name) for name, f in files.items()]
+
+def export(archive, files):
+    offset = 0
+    def write(data):
+        nonlocal offset
+        archive.write(data)
+        offset += len(data)
+    write(MAGIC)
+    index = []
+    missing = 0
+    for path, name in files:
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            missing += 1
+            continue
+        name = name.encode()
+        digest = hashlib.sha256(data).digest()
+        index.append((offset, name, len(data), digest))
+        write(_entry.pack(b'MMZE', len(name), len(data), digest))
+        write(name)
+        write(data)
+    write(b'MMZI')
+    index_offset = offset
+    for entry_offset, name, size, digest in index:
+        write(_index_entry.pack(entry_offset, len(name), size, digest))
+        write(name)
+    write(_trailer.pack(b'MMZT', index_offset, len(index)))
+    return len(index), missing
+
+# \paragraph{Import}
+
+def _read(archive, n):
+    data = archive.read(n)
+    if len(data) != n:
+        raise ArchiveError('Unexpected end of archive')
+    return data
+
+# An archived path must be relative, and may not leave the target directory.
+def _safe_path(name):
+    path = PurePosixPath(name)
+    if path.is_absolute() or '..' in path.parts or not path.parts:
+        raise ArchiveError(f"Refusing to unpack '{name}'")
+    return Path(*path.parts)
+
+def _same_content(path, size, digest):
+    try:
+        if os.stat(path).st_size != size:
+            return False
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).digest() == digest
+    except FileNotFoundError:
+        return False
+
+# Unpack the archive into directory |target|, returning the numbers of the
+# written and the skipped files.  The archive is read sequentially, so it can
+# be a pipe.  Nothing is unpacked unless the entire archive is valid: if the
+# archive is seekable, we check the paths in the index upfront; in any case,
+# the files are written into temporary files, which replace the unpacked files
+# only once the archive has been read to the end.
+def unpack(archive, target = Path('.')):
+    if archive.seekable():
+        for name, size, digest in read_index(archive):
+            _safe_path(name)
+        archive.seek(0)
+    if archive.read(len(MAGIC)) != MAGIC:
+        raise ArchiveError('Not a memo archive')
+    skipped = 0
+    made = set()
+    staged = {}
+    try:
+        while True:
+            magic = _read(archive, 4)
+            if magic == b'MMZI':
+                break
+            if magic != b'MMZE':
+                raise ArchiveError('Corrupted archive')
+            _, name_length, size, digest = _entry.unpack(
+                magic + _read(archive, _entry.size - 4))
+            path = target / _safe_path(_read(archive, name_length).decode())
+            data = _read(archive, size)
+            if hashlib.sha256(data).digest() != digest:
+                raise ArchiveError(f"Corrupted entry '{path}'")
+            if _same_content(path, size, digest):
+                skipped += 1
+                continue
+            if path.parent not in made:
+                path.parent.mkdir(parents = True, exist_ok = True)
+                made.add(path.parent)
+            tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+            staged[path] = tmp
+            tmp.write_bytes(data)
+        for path, tmp in staged.items():
+            os.replace(tmp, path)
+    except BaseException:
+        for tmp in staged.values():
+            tmp.unlink(missing_ok = True)
+        raise
+    return len(staged), skipped
+
+# \paragraph{Index}
+
+# Read the index, by seeking to the trailer; returns a list of |(path, size,
+# digest)| triples.
+def read_index(archive):
+    archive.seek(-_trailer.size, os.SEEK_END)
+    magic, index_offset, n = _trailer.unpack(_read(archive, _trailer.size))
+    if magic != b'MMZT':
+        raise ArchiveError('Not a memo archive, or truncated')
+    archive.seek(index_offset)
+    index = []
+    for _ in range(n):
+        offset, name_length, size, digest = _index_entry.unpack(
+            _read(archive, _index_entry.size))
+        index.append((_read(archive, name_length).decode(), size, digest))
+    return index
+
+# \paragraph{Commands}
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description = "Pack the memos and externs of documents into an archive, "
+                      "and unpack them.",
+        epilog = "For details, see the man page of memoize-extract.",
+        prog = 'memoize_archive.py',
+    )
+    parser.add_argument('-V', '--version', action = 'version',
+        version = f"%(prog)s of Memoize " + __version__)
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    p = commands.add_parser('export',
+        help = 'archive the memos and externs listed in MMZ files')
+    p.add_argument('archive', help = "the archive ('-' for standard output)")
+    p.add_argument('mmz', nargs = '+', help = 'the record files')
+    p.add_argument('-C', '--directory', default = '.',
+        help = 'archive the files relative to DIRECTORY')
+    p = commands.add_parser('import', help = 'unpack the archive')
+    p.add_argument('archive', help = "the archive ('-' for standard input)")
+    p.add_argument('-C', '--directory', default = '.',
+        help = 'unpack into DIRECTORY')
+    p = commands.add_parser('list', help = 'list the archived files')
+    p.add_argument('archive')
+    args = parser.parse_args()
+    try:
+        if args.command == 'export':
+            files = listed_files(args.mmz, args.directory)
+            if args.archive == '-':
+                n, missing = export(sys.stdout.buffer, files)
+            else:
+                with open(args.archive, 'wb') as archive:
+                    n, missing = export(archive, files)
+            print(f"Exported {n} files" +
+                  (f" ({missing} listed files do not exist)" if missing else ""),
+                  file = sys.stderr)
+        elif args.command == 'import':
+            if args.archive == '-':
+                written, skipped = unpack(sys.stdin.buffer, Path(args.directory))
+            else:
+                with open(args.archive, 'rb') as archive:
+                    written, skipped = unpack(archive, Path(args.directory))
+            print(f"Imported {written} files, skipped {skipped} identical files",
+                  file = sys.stderr)
+        else:
+            with open(args.archive, 'rb') as archive:
+                for name, size, digest in read_index(archive):
+                    print(f'{size:>10} {digest.hex()[:16]} {name}')
+    except ArchiveError as err:
+        sys.exit(f'{parser.prog}: {err}')
+
+if __name__ == '__main__':
+    main()
+
+# Local Variables:
+# fill-column: 79
+# End:
@@ -0,0 +1,155 @@
+# This file is a part of Memoize, a TeX package for externalization of
+# graphics and memoization of compilation results in general, available at
+# https://ctan.org/pkg/memoize and https://github.com/sasozivanovic/memoize.
+#
+# Copyright (c) 2020- Saso Zivanovic <saso.zivanovic@guest.arnes.si>
+#
+# This work may be distributed and/or modified under the conditions of the
+# LaTeX Project Public License, either version 1.3c of this license or (at
+# your option) any later version.  The latest version of this license is in
+# https://www.latex-project.org/lppl.txt and version 1.3c or later is part of
+# all distributions of LaTeX version 2008 or later.
+#
+# This work has the LPPL maintenance status `maintained'.
+# The Current Maintainer of this work is Saso Zivanovic.
+#
+# The files belonging to this work and covered by LPPL are listed in
+# <texmf>/doc/generic/memoize/FILES.
+
+__version__ = '2024/12/02 v1.4.1'
+
+# This module maintains the optional catalog of the memos and externs, used by
+# |memoize-extract.py| and |memoize-clean.py| given option |--catalog|.  The
+# catalog is an SQLite database, |memoize-catalog.db|, in the directory
+# holding the memos and externs, i.e.\ the memo directory or, without one, the
+# document directory.  It records every memo and extern in the directory
+# with its size, the |.mmz| file of the document which last used it, its path
+# prefix, and the time of that compilation (i.e.\ the modification time of the
+# |.mmz| file).  The catalog is only a cache: it can always be rebuilt from
+# the directory, and the |.mmz| files.
+
+import os, re
+
+CATALOG_NAME = 'memoize-catalog.db'
+
+# The memo, extern and log files, with their path prefix.  Compare
+# |populate_tbdeleted| in |memoize-clean.py|.
+re_memo_file = re.compile(
+    r'(?P<prefix>.*?)[0-9A-F]{32}(?:-[0-9A-F]{32})?'
+    r'(?:-[0-9]+)?(?:(?P<memo>\.memo)|(?:-[0-9]+)?(?P<extern>\.pdf)|\.log)$')
+
+# Return the kind of the file and its path prefix, or |None| if this is not a
+# memo, extern or log file.
+def classify(name):
+    if m := re_memo_file.match(name):
+        return ('memo' if m['memo'] else 'extern' if m['extern'] else 'log',
+                m['prefix'])
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS files (
+    name TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    size INTEGER,
+    document TEXT,
+    prefix TEXT,
+    last_used REAL
+);
+CREATE INDEX IF NOT EXISTS files_document ON files (document);
+'''
+
+class Catalog:
+    # Open (and create, if necessary) the catalog in |directory|.  SQLite is
+    # imported only now, as the catalog is optional.
+    def __init__(self, directory):
+        import sqlite3
+        self.directory = directory
+        self.file = os.path.join(directory, CATALOG_NAME)
+        self.db = sqlite3.connect(self.file, timeout = 60)
+        self.db.executescript(_schema)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    # Record that the compilation of |document|, finished at time
+    # |last_used|, used the memos and externs |names| (the filenames in the
+    # directory).  The size of a file is only
+    # determined (by calling |stat|) if the file is not in the catalog yet, or
+    # is listed in |new|, i.e.\ was (re)created by the compilation.  A file
+    # which does not exist is not recorded.
+    def record(self, names, document, last_used, new = ()):
+        known = self.known(names)
+        used, created = [], []
+        for name in names:
+            if name in known and name not in new:
+                used.append((name, document, last_used))
+                continue
+            if not (k := classify(name)):
+                continue
+            try:
+                size = os.stat(os.path.join(self.directory, name)).st_size
+            except FileNotFoundError:
+                continue
+            created.append((name, k[0], size, document, k[1], last_used))
+        self.db.executemany(
+            'UPDATE files SET document = ?2, last_used = ?3 '
+            'WHERE name = ?1', used)
+        self.db.executemany(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', created)
+        self.db.commit()
+
+    def known(self, names):
+        known = set()
+        names = list(names)
+        # Stay below SQLite's limit on the number of query parameters.
+        for i in range(0, len(names), 500):
+            chunk = names[i:i+500]
+            known.update(name for name, in self.db.execute(
+                'SELECT name FROM files WHERE name IN (%s)'
+                % ','.join('?' * len(chunk)), chunk))
+        return known
+
+    # The catalogued files whose name starts with |basename_prefix|.
+    def names(self, basename_prefix = ''):
+        escaped = re.sub(r'([\\%_])', r'\\\1', basename_prefix)
+        return [name for name, in self.db.execute(
+            r"SELECT name FROM files WHERE name LIKE ? ESCAPE '\'",
+            (escaped + '%',))]
+
+    def forget(self, names):
+        self.db.executemany('DELETE FROM files WHERE name = ?',
+                            ((name,) for name in names))
+        self.db.commit()
+
+    # Regenerate the catalog from the directory.  The files which remain
+    # catalogued keep their document and the time of last use; the new ones
+    # get the modification time of the file instead.
+    def rebuild(self):
+        catalogued = dict(
+            (name, row) for name, *row in self.db.execute(
+                'SELECT name, document, last_used FROM files'))
+        rows = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if (k := classify(entry.name)) and entry.is_file():
+                    st = entry.stat()
+                    document, last_used = catalogued.get(
+                        entry.name, (None, st.st_mtime))
+                    rows.append((entry.name, k[0], st.st_size,
+                                 document, k[1], last_used))
+        self.db.execute('DELETE FROM files')
+        self.db.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.db.commit()
+        return len(rows)
+
+    # The number and the total size of the catalogued files, by document
+    # and kind.
+    def stats(self):
+        return self.db.execute(
+            'SELECT document, kind, count(*), sum(size), max(last_used) '
+            'FROM files GROUP BY document, kind ORDER BY document, kind'
+        ).fetchall()
+
+# Local Variables:
+# fill-column: 79
+# End:
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+# This file is a part of Memoize, a TeX package for externalization of
+# graphics and memoization of compilation results in general, available at
+# https://ctan.org/pkg/memoize and https://github.com/sasozivanovic/memoize.
+#
+# Copyright (c) 2020- Saso Zivanovic <saso.zivanovic@guest.arnes.si>
+#
+# This work may be distributed and/or modified under the conditions of the
+# LaTeX Project Public License, either version 1.3c of this license or (at
+# your option) any later version.  The latest version of this license is in
+# https://www.latex-project.org/lppl.txt and version 1.3c or later is part of
+# all distributions of LaTeX version 2008 or later.
+#
+# This work has the LPPL maintenance status `maintained'.
+# The Current Maintainer of this work is Saso Zivanovic.
+#
+# The files belonging to this work and covered by LPPL are listed in
+# <texmf>/doc/generic/memoize/FILES.
+
+__version__ = '2024/12/02 v1.4.1'
+
+# This module stores byte-identical externs once.  The same picture, memoized
+# in different contexts, yields identical externs under different names (only
+# the MD5 sum of the context differs), which can take a good share of the memo
+# directory of, say, a large presentation.  We find the identical externs by
+# their size and, only among the externs of the same size, by their SHA-256
+# digest, and replace all but one of them by hard links to the remaining one
+# or, with |--reflink|, by clones sharing its data blocks (on file systems
+# which support this, like Btrfs and XFS).  |memoize-extract.py --dedup|
+# deduplicates the externs it has just extracted against the externs in their
+# directories; command |dedup| of this script deduplicates the externs in the
+# given directories.
+#
+# Deduplication is safe for the other tools.  An extern is only replaced if it
+# has no other hard link, so that we never change what a link we don't know
+# about, e.g.\ from the global store of |memoize-extract.py --store|, refers
+# to; the space it took is therefore always reclaimed.  Deduplicated externs
+# published into the store become entries which are hard links of one
+# another, so |memoize-clean.py --gc-store| only counts the links of an entry
+# from outside the store.  The replacement is atomic: the link is made under a
+# temporary name, and renamed over the extern.  The scripts never write into
+# an existing extern, but replace it, so a shared file is never modified
+# through one of its names; and removing a name, e.g.\ by |memoize-clean.py|,
+# leaves the other names intact.
+
+import hashlib, os, re, sys
+from pathlib import Path
+
+# The extern files; compare |re_memo_file| in |memoize_catalog.py|.
+re_extern_file = re.compile(r'.*[0-9A-F]{32}-[0-9A-F]{32}(?:-[0-9]+)?\.pdf$')
+
+# The ioctl request cloning a file on Linux.
+FICLONE = 0x40049409
+
+def reflink(source, target):
+    import fcntl
+    with open(source, 'rb') as s, open(target, 'xb') as t:
+        fcntl.ioctl(t.fileno(), FICLONE, s.fileno())
+
+# The externs in |directory|, as |(path, stat)| pairs.
+def externs(directory):
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if re_extern_file.match(entry.name) \
+                   and entry.is_file(follow_symlinks = False):
+                    yield Path(directory) / entry.name, entry.stat()
+    except FileNotFoundError:
+        pass
+
+class Deduplicator:
+    # Function |report|, if given, is called with a message for every
+    # deduplicated extern.  With |dry_run|, the externs are only compared.
+    def __init__(self, reflink = False, dry_run = False, report = None):
+        self.reflink = reflink
+        self.dry_run = dry_run
+        self.report = report
+        # The externs which may be linked to, keyed by the device and the
+        # size, as |(path, stat)| pairs.
+        self.originals = {}
+        # The digests computed so far, keyed by the device and the inode.
+        self.digests = {}
+        self.scanned = set()
+        self.deduplicated = self.reclaimed = self.failed = 0
+
+    # Make the externs in |directory| available for linking to, without
+    # deduplicating them.  The externs with the most hard links come first, so
+    # that they are preferred as the originals.
+    def scan(self, directory):
+        if directory in self.scanned:
+            return
+        self.scanned.add(directory)
+        for path, st in sorted(externs(directory),
+                               key = lambda f: -f[1].st_nlink):
+            self.originals.setdefault((st.st_dev, st.st_size), []).append(
+                (path, st))
+
+    def digest(self, path, st):
+        key = st.st_dev, st.st_ino
+        if key not in self.digests:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                while chunk := f.read(1 << 20):
+                    digest.update(chunk)
+            self.digests[key] = digest.digest()
+        return self.digests[key]
+
+    # Replace extern |path| by a link to an identical extern, if there is one.
+    # Otherwise, the extern becomes available for linking to.  Returns the
+    # path of the identical extern, or |None|.
+    def dedup(self, path, st = None):
+        st = st or os.stat(path)
+        originals = self.originals.setdefault((st.st_dev, st.st_size), [])
+        originals[:] = [original for original in originals
+                        if original[0] != path]
+        if st.st_nlink == 1 and st.st_size:
+            for original, original_st in originals:
+                if original_st.st_ino != st.st_ino and \
+                   self.digest(original, original_st) == self.digest(path, st):
+                    if self.dry_run or self.link(original, path):
+                        self.deduplicated += 1
+                        self.reclaimed += st.st_size
+                        if self.report:
+                            self.report(f"Extern '{path}' is identical to "
+                                        f"'{original}'")
+                        return original
+                    break
+        originals.append((path, st))
+
+    def link(self, original, path):
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        try:
+            if self.reflink:
+                reflink(original, tmp)
+            else:
+                os.link(original, tmp)
+            os.replace(tmp, path)
+            return True
+        except OSError:
+            # E.g.\ the file system supports neither hard links nor clones.
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            self.failed += 1
+            return False
+
+    def summary(self):
+        return (f"{'Found' if self.dry_run else 'Deduplicated'} "
+                f"{self.deduplicated} identical extern"
+                f"{'' if self.deduplicated == 1 else 's'}, "
+                f"{'reclaimable' if self.dry_run else 'reclaiming'} "
+                f"{self.reclaimed} bytes" +
+                (f" ({self.failed} could not be "
+                 f"{'cloned' if self.reflink else 'linked'})"
+                 if self.failed else ''))
+
+# Deduplicate the externs in the given directories, also across them (if they
+# are on the same device).
+def dedup(directories, reflink = False, dry_run = False, report = None):
+    deduplicator = Deduplicator(reflink, dry_run, report)
+    files = [f for directory in directories for f in externs(directory)]
+    files.sort(key = lambda f: -f[1].st_nlink)
+    for path, st in files:
+        deduplicator.dedup(path, st)
+    return deduplicator
+
+# \paragraph{Commands}
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description = "Store the identical externs once, as hard links "
+                      "to the same file.",
+        epilog = "For details, see the man page of memoize-extract.",
+        prog = 'memoize_dedup.py',
+    )
+    parser.add_argument('-V', '--version', action = 'version',
+        version = f"%(prog)s of Memoize " + __version__)
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    p = commands.add_parser('dedup',
+        help = 'deduplicate the externs in the directories')
+    p.add_argument('directory', nargs = '+',
+        help = 'a memo directory, or the directory of a document')
+    p.add_argument('-n', '--dry-run', action = 'store_true',
+        help = 'only report the identical externs')
+    p.add_argument('--reflink', action = 'store_true',
+        help = 'clone the externs rather than hard-linking them '
+               '(Linux, on file systems supporting this)')
+    p.add_argument('-q', '--quiet', action = 'store_true')
+    args = parser.parse_args()
+    deduplicator = dedup(args.directory, args.reflink, args.dry_run,
+                         None if args.quiet else print)
+    print(deduplicator.summary())
+
+if __name__ == '__main__':
+    main()
+
+# Local Variables:
+# fill-column: 79
+# End:
@@ -0,0 +1,221 @@
+# This file is a part of Memoize, a TeX package for externalization of
+# graphics and memoization of compilation results in general, available at
+# https://ctan.org/pkg/memoize and https://github.com/sasozivanovic/memoize.
+#
+# Copyright (c) 2020- Saso Zivanovic <saso.zivanovic@guest.arnes.si>
+#
+# This work may be distributed and/or modified under the conditions of the
+# LaTeX Project Public License, either version 1.3c of this license or (at
+# your option) any later version.  The latest version of this license is in
+# https://www.latex-project.org/lppl.txt and version 1.3c or later is part of
+# all distributions of LaTeX version 2008 or later.
+#
+# This work has the LPPL maintenance status `maintained'.
+# The Current Maintainer of this work is Saso Zivanovic.
+#
+# The files belonging to this work and covered by LPPL are listed in
+# <texmf>/doc/generic/memoize/FILES.
+
+__version__ = '2024/12/02 v1.4.1'
+
+# This module parses the |.mmz| record files for |memoize-extract.py| and
+# |memoize-clean.py|.  It lives next to the scripts, which find it because
+# Python puts the (symlink-resolved) directory of the script on |sys.path|.
+
+import re
+
+# \paragraph{Records}
+
+# Each line of a |.mmz| file is a single record, i.e.\ a macro followed by
+# braced arguments.  The first argument is a path (or a path prefix), given as
+# written by \hologo{TeX}, i.e.\ possibly containing double quotes; property
+# |path| unquotes it.  A record is ``commented'' if the line starts with |%|,
+# which is how |memoize-extract| marks the extracted externs.
+
+class Record:
+    __slots__ = ('raw_path',)
+
+    @property
+    def path(self):
+        raw_path = self.raw_path
+        return unquote(raw_path) if '"' in raw_path else raw_path
+
+# |\mmzPrefix{<path prefix>}|
+class Prefix(Record):
+    __slots__ = ()
+    def __init__(self, raw_path):
+        self.raw_path = raw_path
+
+# |\mmzNewCMemo|, |\mmzNewCCMemo|, |\mmzUsedCMemo| and |\mmzUsedCCMemo|.
+class Memo(Record):
+    __slots__ = ('new', 'cc', 'commented')
+    def __init__(self, raw_path, new, cc, commented):
+        self.raw_path = raw_path
+        self.new = new
+        self.cc = cc
+        self.commented = commented
+
+# |\mmzNewExtern{<path>}{<page>}{<width>pt}{<height>pt}| and
+# |\mmzUsedExtern{<path>}|.  For a new extern, |page| is the (one-based) page
+# number in the document PDF, and |width| and |height| are the expected
+# dimensions in points, as strings.
+class Extern(Record):
+    __slots__ = ('new', 'commented', 'page', 'width', 'height')
+    def __init__(self, raw_path, new, commented,
+                 page = None, width = None, height = None):
+        self.raw_path = raw_path
+        self.new = new
+        self.commented = commented
+        self.page = page
+        self.width = width
+        self.height = height
+
+# |\endinput|, which Memoize writes at the end of a complete |.mmz| file.
+class EndInput:
+    __slots__ = ()
+
+ENDINPUT = EndInput()
+
+# \paragraph{Parsing}
+
+# Parse the open |.mmz| file |f| in a single streaming pass, yielding |(text,
+# record)| pairs whose texts concatenate into the entire file.  For a record,
+# |text| is its line; otherwise, |record| is |None| and |text| consists of one
+# or more lines which are not records (e.g.\ empty lines).  With |pending|,
+# only the |Prefix| records and the pending (i.e.\ new and not yet extracted)
+# externs are recognized, which is all the extraction needs.  Either way, the
+# memory usage does not depend on the size of the file.
+def parse_mmz(f, pending = False):
+    return _parse_pending(f) if pending else _parse(f)
+
+# The macro names, with the record class and its initial arguments.
+_macros = {
+    r'\mmzPrefix': (Prefix,),
+    r'\mmzNewCMemo': (Memo, True, False),
+    r'\mmzNewCCMemo': (Memo, True, True),
+    r'\mmzUsedCMemo': (Memo, False, False),
+    r'\mmzUsedCCMemo': (Memo, False, True),
+    r'\mmzNewExtern': (Extern, True),
+    r'\mmzUsedExtern': (Extern, False),
+}
+
+# Every line is parsed by a handful of string operations, rather than by trying
+# a regular expression for each kind of record.  Leading and trailing
+# whitespace is ignored, and so is the whitespace between the macro and its
+# first argument.
+def _parse(f):
+    get_macro = _macros.get
+    for line in f:
+        s = line.strip()
+        commented = s[:1] == '%'
+        if commented:
+            s = s[1:].lstrip()
+        i = s.find('{')
+        macro = get_macro(s[:i].rstrip()) if i > 0 and s[-1:] == '}' else None
+        record = None
+        if macro is None:
+            if s == r'\endinput' and not commented:
+                record = ENDINPUT
+        elif macro[0] is Memo:
+            if '}' not in (arg := s[i+1:-1]):
+                record = Memo(arg, macro[1], macro[2], commented)
+        elif macro[0] is Prefix:
+            if '}' not in (arg := s[i+1:-1]) and not commented:
+                record = Prefix(arg)
+        elif not macro[1]:
+            if '}' not in (arg := s[i+1:-1]):
+                record = Extern(arg, False, commented)
+        else:
+            args = s[i+1:-1].split('}{')
+            if len(args) == 4 and args[1].isdigit() \
+               and args[2].endswith('pt') and args[3].endswith('pt'):
+                record = Extern(args[0], True, commented, int(args[1]),
+                                args[2][:-2], args[3][:-2])
+        yield line, record
+
+# For the extraction, we don't even look at most lines.  The file is read in
+# chunks of 64 KiB, cut at the last newline, and a regular expression finds the
+# prefixes and the new externs; as it starts with a literal backslash, the
+# search is fast.  We check that the match starts the line (modulo whitespace)
+# ourselves, and pass the lines between the matches through in bulk.  (Larger
+# chunks are no faster, and the memory usage grows with the chunk size.)
+_re_pending = re.compile(
+    r'\\mmz(?:(Prefix) *{([^}\n]*)}'
+    r'|NewExtern *{([^}\n]*)}{([0-9]+)}{([0-9.]*)pt}{([0-9.]*)pt})'
+    r'[ \t\r]*(?:\n|\Z)')
+
+def _parse_pending(f, chunk_size = 1 << 16):
+    finditer = _re_pending.finditer
+    rest = ''
+    while True:
+        chunk = f.read(chunk_size)
+        data = rest + chunk
+        if chunk:
+            cut = data.rfind('\n') + 1
+            data, rest = data[:cut], data[cut:]
+        pos = 0
+        for m in finditer(data):
+            # Only whitespace may precede the macro on its line.
+            start = data.rfind('\n', 0, m.start()) + 1
+            if data[start:m.start()].strip(' \t'):
+                continue
+            if start > pos:
+                yield data[pos:start], None
+            prefix, prefix_path, path, page, width, height = m.groups()
+            yield m.group(), (Prefix(prefix_path) if prefix else
+                              Extern(path, True, False, int(page), width, height))
+            pos = m.end()
+        if pos < len(data):
+            yield data[pos:], None
+        if not chunk:
+            return
+
+# A quick check whether the |.mmz| file lists any pending externs, used by the
+# extraction to bail out early in the common case of a compilation which
+# produced no new externs.  Like |_parse_pending|, we read the file in chunks
+# cut at the last newline; the file is rewound afterwards.
+_re_pending_extern = re.compile(r'^[ \t]*\\mmzNewExtern\b', re.M)
+
+def has_pending_externs(f, chunk_size = 1 << 16):
+    search = _re_pending_extern.search
+    rest = ''
+    try:
+        while chunk := f.read(chunk_size):
+            data = rest + chunk
+            cut = data.rfind('\n') + 1
+            if search(data, 0, cut):
+                return True
+            rest = data[cut:]
+        return bool(search(rest))
+    finally:
+        f.seek(0)
+
+# \paragraph{Paths}
+
+_re_unquote = re.compile(r'"(.*?)"')
+def unquote(fn):
+    return _re_unquote.sub(r'\1', fn)
+
+# The filename of a memo or an extern consists of the path prefix, the MD5 sum
+# of the memoized code and, for cc-memos and externs, the MD5 sum of the
+# context, optionally followed by the extern's sequential number.
+re_extern_path = re.compile(
+    r'(?P<dir_prefix>.*/)?(?P<name_prefix>.*?)'
+    r'(?P<code_md5sum>[0-9A-F]{32})-'
+    r'(?P<context_md5sum>[0-9A-F]{32})(?:-[0-9]+)?.pdf')
+re_split_prefix = re.compile(r'(?P<dir_prefix>.*/)?(?P<name_prefix>.*?)')
+
+# The key of a memo or extern: its filename without the path prefix, i.e.\ the
+# MD5 sums (and the extension).  As the memos refer to their externs without
+# the prefix, files with the same key have the same content in all documents,
+# so the key can be used to share them across documents and machines.
+_re_key = re.compile(
+    r'.*?(?P<key>[0-9A-F]{32}(?:-[0-9A-F]{32})?(?:-[0-9]+)?(?:\.memo|\.pdf))$')
+
+def memo_key(name):
+    if m := _re_key.match(name):
+        return m['key']
+
+# Local Variables:
+# fill-column: 79
+# End:
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+
+# This file is a part of Memoize, a TeX package for externalization of
+# graphics and memoization of compilation results in general, available at
+# https://ctan.org/pkg/memoize and https://github.com/sasozivanovic/memoize.
+#
+# Copyright (c) 2020- Saso Zivanovic <saso.zivanovic@guest.arnes.si>
+#
+# This work may be distributed and/or modified under the conditions of the
+# LaTeX Project Public License, either version 1.3c of this license or (at
+# your option) any later version.  The latest version of this license is in
+# https://www.latex-project.org/lppl.txt and version 1.3c or later is part of
+# all distributions of LaTeX version 2008 or later.
+#
+# This work has the LPPL maintenance status `maintained'.
+# The Current Maintainer of this work is Saso Zivanovic.
+#
+# The files belonging to this work and covered by LPPL are listed in
+# <texmf>/doc/generic/memoize/FILES.
+
+__version__ = '2024/12/02 v1.4.1'
+
+# This module implements the remote cache of memos and externs.  After
+# extraction, |memoize-extract.py --remote| pushes the memos and externs listed
+# in the |.mmz| file to the remote cache; before the next compilation, perhaps
+# on another machine, command |pull| of this script fetches the files listed in
+# the |.mmz| file which are missing.  The files are keyed by their name without
+# the path prefix (see |memo_key| in |memoize_mmz.py|).
+#
+# A cache is accessed through a backend.  We provide a backend for a cache in a
+# directory (which may be on a network file system), and a backend for an HTTP
+# server, along with a minimal server (command |serve|), so that the remote
+# cache can be set up, and tested, without any external services.  Command
+# |push| is the counterpart of |pull|.
+
+import os, re, sys, threading
+from pathlib import Path
+
+# The exceptions signalling that the cache cannot be used: it cannot be
+# reached, or (over HTTP) its response is malformed.  The expression of an
+# |except| clause is only evaluated once an exception is raised, so
+# |http.client| is not imported when using a filesystem cache.
+def cache_errors():
+    from http.client import HTTPException
+    return OSError, HTTPException
+
+# \paragraph{Backends}
+
+# A backend provides methods |has|, |get| and |put|.  Method |get| returns the
+# content of the entry, or |None| if there is no such entry.  The methods may
+# be called from several threads at once.
+
+class FilesystemBackend:
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def entry(self, key):
+        return self.root / key[:2] / key
+
+    def has(self, key):
+        return self.entry(key).exists()
+
+    def get(self, key):
+        try:
+            return self.entry(key).read_bytes()
+        except FileNotFoundError:
+            return
+
+    # The entry appears atomically, so that a concurrent |get| never sees a
+    # partial file.
+    def put(self, key, data):
+        entry = self.entry(key)
+        entry.parent.mkdir(parents = True, exist_ok = True)
+        tmp = entry.with_name(
+            f'{key}.{os.getpid()}.{threading.get_ident()}.tmp')
+        tmp.write_bytes(data)
+        os.replace(tmp, entry)
+
+    def close(self):
+        pass
+
+# The HTTP backend issues |HEAD|, |GET| and |PUT| requests for |<url>/<key>|.
+# The connections are kept alive and reused through a pool; a connection which
+# the server has closed in the meantime is replaced once.
+class HttpBackend:
+    def __init__(self, url):
+        import http.client, queue, urllib.parse
+        self.http = http.client
+        self.empty = queue.Empty
+        url = urllib.parse.urlsplit(url)
+        self.connection_class = (http.client.HTTPSConnection
+                                 if url.scheme == 'https'
+                                 else http.client.HTTPConnection)
+        self.netloc = url.netloc
+        self.path = url.path.rstrip('/') + '/'
+        self.pool = queue.LifoQueue()
+
+    def request(self, method, key, body = None):
+        for attempt in (1, 2):
+            try:
+                connection = self.pool.get_nowait()
+            except self.empty:
+                connection = self.connection_class(self.netloc, timeout = 60)
+            try:
+                connection.request(method, self.path + key, body = body)
+                response = connection.getresponse()
+                data = response.read()
+            except (self.http.RemoteDisconnected, BrokenPipeError,
+                    ConnectionResetError):
+                connection.close()
+                if attempt == 2:
+                    raise
+                continue
+            except self.http.HTTPException:
+                connection.close()
+                raise
+            self.pool.put(connection)
+            if response.status == 404:
+                return
+            if response.status >= 300:
+                raise OSError(f'{method} {self.path + key}: '
+                              f'{response.status} {response.reason}')
+            return data
+
+    def has(self, key):
+        return self.request('HEAD', key) is not None
+
+    def get(self, key):
+        return self.request('GET', key)
+
+    def put(self, key, data):
+        self.request('PUT', key, data)
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
+
+def backend(location):
+    if location.startswith(('http://', 'https://')):
+        return HttpBackend(location)
+    return FilesystemBackend(location)
+
+# \paragraph{Pushing and pulling}
+
+# The memos and externs listed in |.mmz| file |mmz_file|, as |(key, path)|
+# pairs; the paths are relative to the directory of the |.mmz| file.
+def listed_files(mmz_file):
+    from memoize_mmz import parse_mmz, Memo, Extern, memo_key
+    mmz_parent = Path(mmz_file).parent
+    files = []
+    with open(mmz_file) as mmz:
+        for line, record in parse_mmz(mmz):
+            if isinstance(record, (Memo, Extern)):
+                path = mmz_parent / record.path
+                if key := memo_key(path.name):
+                    files.append((key, path))
+    return files
+
+# Upload the given files which exist locally and are not in the cache yet,
+# using |jobs| threads.  Returns the number of uploaded files.
+def push(cache, files, jobs = 8):
+    def push_one(key_path):
+        key, path = key_path
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return False
+        if cache.has(key):
+            return False
+        cache.put(key, data)
+        return True
+    return _concurrently(push_one, files, jobs)
+
+# Download the given files which are missing locally, using |jobs| threads.
+# Returns the number of downloaded files.
+def pull(cache, files, jobs = 8):
+    def pull_one(key_path):
+        key, path = key_path
+        if path.exists() or (data := cache.get(key)) is None:
+            return False
+        path.parent.mkdir(parents = True, exist_ok = True)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        return True
+    return _concurrently(pull_one, files, jobs)
+
+def _concurrently(function, items, jobs):
+    if jobs == 1 or len(items) <= 1:
+        return sum(map(function, items))
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(jobs) as pool:
+        return sum(pool.map(function, items))
+
+# \paragraph{The server}
+
+# A minimal HTTP server for the remote cache, storing the entries in a
+# directory, using the filesystem backend.  It is meant for testing, and for
+# trusted networks: there is no authentication.
+_re_key = re.compile(r'/(?:.*/)?([0-9A-F]{32}(?:-[0-9A-F]{32})?'
+                     r'(?:-[0-9]+)?\.(?:memo|pdf))')
+
+def serve(root, host = '127.0.0.1', port = 0):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    cache = FilesystemBackend(root)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def key(self):
+            if m := _re_key.fullmatch(self.path):
+                return m[1]
+            self.reply(400)
+
+        def reply(self, status, data = b'', head = False):
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            if not head:
+                self.wfile.write(data)
+
+        def do_GET(self, head = False):
+            if key := self.key():
+                data = cache.get(key)
+                self.reply(404 if data is None else 200, data or b'', head)
+
+        def do_HEAD(self):
+            self.do_GET(head = True)
+
+        def do_PUT(self):
+            if key := self.key():
+                length = int(self.headers.get('Content-Length', 0))
+                cache.put(key, self.rfile.read(length))
+                self.reply(201)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f'Serving {root} at http://{host}:{server.server_port}/', flush = True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+# \paragraph{Commands}
+
+def main():
+    import argparse
+    def jobs_type(jobs):
+        if not re.fullmatch(r'[1-9][0-9]*', jobs):
+            raise argparse.ArgumentTypeError(
+                f"invalid number of jobs: '{jobs}'")
+        return int(jobs)
+    parser = argparse.ArgumentParser(
+        description = "Share the memos and externs through a remote cache.",
+        epilog = "For details, see the man page of memoize-extract.",
+        prog = 'memoize_remote.py',
+    )
+    parser.add_argument('-j', '--jobs', type = jobs_type, default = 8,
+        metavar = 'N',
+        help = 'transfer the files using N threads')
+    parser.add_argument('-V', '--version', action = 'version',
+        version = f"%(prog)s of Memoize " + __version__)
+    commands = parser.add_subparsers(dest = 'command', required = True)
+    for command, help in (('pull', 'fetch the missing files listed in MMZ'),
+                          ('push', 'upload the files listed in MMZ')):
+        p = commands.add_parser(command, help = help)
+        p.add_argument('cache', help = 'a directory or an HTTP URL')
+        p.add_argument('mmz', nargs = '+', help = 'the record files')
+    p = commands.add_parser('serve', help = 'serve the cache in DIR over HTTP')
+    p.add_argument('dir')
+    p.add_argument('--host', default = '127.0.0.1')
+    p.add_argument('--port', type = int, default = 0,
+                   help = 'the port (by default, a free port is chosen)')
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args.dir, args.host, args.port)
+        return
+    cache = backend(args.cache)
+    transfer = pull if args.command == 'pull' else push
+    try:
+        for mmz in args.mmz:
+            try:
+                files = listed_files(mmz)
+            except FileNotFoundError:
+                print(f"File '{mmz}' does not exist, skipping it")
+                continue
+            try:
+                n = transfer(cache, files, args.jobs)
+            except cache_errors() as err:
+                # As the cache is only an optimization, this is not an error.
+                print(f"Cannot {args.command} the files listed in '{mmz}': "
+                      f"{err!r}")
+                continue
+            print(f"{'Pulled' if transfer is pull else 'Pushed'} {n} of "
+                  f"{len(files)} files listed in '{mmz}'")
+    finally:
+        cache.close()
+
+if __name__ == '__main__':
+    main()
+
+# Local Variables:
+# fill-column: 79
+# End:
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 from pathlib import Path
-import filecmp, os, collections, argparse, itertools, stat, shutil, subprocess, shutil, glob, braceexpand, re, platform
+import filecmp, os, collections, argparse, itertools, stat, shutil, subprocess, shutil, glob, braceexpand, re, platform, time, signal
 
 TestData = collections.namedtuple('Test', ['targets', 'deps', 'wds'])
 
@@ -144,6 +144,22 @@ def rm(*files):
     for fn in expand(*files):
         Path(fn).unlink()
 
+# Run a script with |-X importtime|, returning the set of imported modules and
+# the total import time in seconds.
+def import_times(args, *, env = {}, **kwargs):
+    echo(import_times, args, env = env, **kwargs)
+    args = ['python', '-X', 'importtime', str(Path.cwd() / args[0])] + args[1:]
+    stderr = subprocess.run(args, env = dict(os.environ, **env),
+                            capture_output = True, text = True, **kwargs).stderr
+    modules, total = set(), 0
+    for line in stderr.splitlines():
+        if m := re.match(r'import time:\s*\d+ \|\s*(\d+) \| ( *)(\S+)', line):
+            modules.add(m[3])
+            if not m[2]:
+                total += int(m[1])
+    print(f'Imported {len(modules)} modules in {total/1000} ms')
+    return modules, total / 1e6
+
 parser = argparse.ArgumentParser()
 parser.add_argument('-B', '--always-make', action = 'store_true')
 parser.add_argument('targets', nargs = '*')
@@ -345,7 +361,9 @@ for pyl in ('py', 'pl'):
                      [f'memoize-extract.{pyl}', f'build/nomemodir/doc.pdf'],
                      "Create .mmz.log for LaTeX"):
         cp('build/nomemodir/*', 'test')
-        assert run(f'memoize-extract.{pyl} -F latex doc.mmz'.split(), cwd = 'test')
+        # The Python script only reports every extern with --verbose.
+        options = ' -v' if pyl == 'py' else ''
+        assert run(f'memoize-extract.{pyl}{options} -F latex doc.mmz'.split(), cwd = 'test')
         assert exists('test/doc.mmz.log')
         print('Expecting 4 lines in: ', end = '')
         assert sum(1 for _ in grep(r'^\\PackageInfo', 'test/doc.mmz.log')) == 4
@@ -360,3 +378,538 @@ for pyl in ('py', 'pl'):
         rm('test/doc.799CD96D5634EBEB7E30191285AF4082.memo', 'test/doc.7DBC7B29C0C49BCFD5C4A18740E06E80-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.memo')
         assert not run(f'memoize-extract.{pyl} doc'.split(), cwd = 'test',
                        env = {'TEXMFOUTPUT': str(Path.cwd() / 'tmp/does/not/exist')})
+
+for test in Test(['mmz-log-summary.py'],
+                 ['memoize-extract.py', 'build/nomemodir/doc.pdf'],
+                 "Summarize the extraction in .mmz.log",
+                 "Without --verbose, a single line is logged"):
+    cp('build/nomemodir/*', 'test')
+    assert run('memoize-extract.py -F latex doc.mmz'.split(), cwd = 'test')
+    print('Expecting 1 line in: ', end = '')
+    assert sum(1 for _ in grep(r'^\\PackageInfo', 'test/doc.mmz.log')) == 1
+    print('Expecting 1 line in: ', end = '')
+    assert sum(1 for _ in grep(r'^\\PackageInfo{.*}{Done \(wrote 2 externs, [1-9][0-9]* bytes, in [0-9.]+s', 'test/doc.mmz.log')) == 1
+    print('Expecting 1 line in: ', end = '')
+    assert sum(1 for _ in grep(r'^\\endinput$', 'test/doc.mmz.log')) == 1
+
+if platform.system() != 'Windows': # no Unix sockets
+    for test in Test(['extract-server.py'],
+                     ['memoize-extract.py', 'build/nomemodir/doc.pdf'],
+                     'Extract through an extraction server',
+                     "The server should receive exactly one job; the externs "
+                     "get the same mode as when extracted in-process, and "
+                     "a socket accessible to others is not used"):
+        cp('build/nomemodir', 'test')
+        cp('build/nomemodir', 'tmp/in-process')
+        os.umask(0o022)
+        socket = str(Path.cwd() / 'tmp/server.sock')
+        with open('tmp/server.log', 'w') as server_log:
+            server = subprocess.Popen(
+                ['python', 'memoize-extract.py', '--serve', '--socket', socket],
+                stdout = server_log)
+        for _ in range(100):
+            if Path(socket).exists():
+                break
+            time.sleep(0.1)
+        try:
+            assert run(['memoize-extract.py', '--socket', socket, 'doc.mmz'],
+                       cwd = 'test')
+            os.chmod(socket, 0o777)
+            assert run(['memoize-extract.py', '--socket', socket, 'doc.mmz'],
+                       cwd = 'tmp/in-process')
+        finally:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+        assert diff('expected/extract-nomemodir/doc.mmz', 'test/doc.mmz')
+        for extern in ('799CD96D5634EBEB7E30191285AF4082-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf',
+                       '7DBC7B29C0C49BCFD5C4A18740E06E80-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf'):
+            assert exists(f'test/doc.{extern}')
+            assert os.stat(f'test/doc.{extern}').st_mode == \
+                os.stat(f'tmp/in-process/doc.{extern}').st_mode
+        print('Expecting 1 line in: ', end = '')
+        assert sum(1 for _ in grep(r'^Job in', 'tmp/server.log')) == 1
+
+for test in Test(['extract-lazy.py'],
+                 ['memoize-extract.py', 'build/memodir/doc.pdf'],
+                 'Extract from a [memodir] document with a lazy PDF reader'):
+    cp('build/memodir', 'test')
+    assert run('memoize-extract.py --lazy -v -F latex doc.mmz'.split(), cwd = 'test')
+    assert diff('expected/extract-memodir/doc.mmz', 'test/doc.mmz')
+    assert exists('test/doc.memo.dir/799CD96D5634EBEB7E30191285AF4082-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf')
+    assert exists('test/doc.memo.dir/7DBC7B29C0C49BCFD5C4A18740E06E80-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf')
+    print('Expecting 1 line in: ', end = '')
+    assert sum(1 for _ in grep(r'^\\PackageInfo{.*}{Read [0-9]+ of [0-9]+ objects', 'test/doc.mmz.log')) == 1
+
+for test in Test(['extract-raw.py'],
+                 ['memoize-extract.py', 'build/memodir/doc.pdf'],
+                 'Extract from a [memodir] document by copying the pages byte for byte'):
+    cp('build/memodir', 'test')
+    assert run('memoize-extract.py --raw --jobs 2 -F latex doc.mmz'.split(), cwd = 'test')
+    assert diff('expected/extract-memodir/doc.mmz', 'test/doc.mmz')
+    from pdfrw import PdfReader
+    for extern, width in (('7DBC7B29C0C49BCFD5C4A18740E06E80', 172.06781),
+                          ('799CD96D5634EBEB7E30191285AF4082', 208.76233)):
+        pdf = PdfReader(f'test/doc.memo.dir/{extern}-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf')
+        assert len(pdf.pages) == 1
+        assert abs(float(pdf.pages[0].MediaBox[2]) / 72 * 72.27 - width) < 0.01
+
+for test in Test(['extract-backends.py'],
+                 ['memoize-extract.py', 'build/memodir/doc.pdf'],
+                 'Extract from a [memodir] document using every installed PDF backend'):
+    import importlib.util
+    for backend in ('pdfrw', 'pypdf', 'pikepdf'):
+        if not importlib.util.find_spec(backend):
+            continue
+        cp('build/memodir', f'test/{backend}')
+        assert run(f'memoize-extract.py --backend {backend} --prune doc.mmz'.split(), cwd = f'test/{backend}')
+        assert diff('expected/extract-memodir/doc.mmz', f'test/{backend}/doc.mmz')
+        assert exists(f'test/{backend}/doc.memo.dir/799CD96D5634EBEB7E30191285AF4082-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf')
+        assert exists(f'test/{backend}/doc.memo.dir/7DBC7B29C0C49BCFD5C4A18740E06E80-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf')
+    # By default, pdfrw is preferred.
+    if importlib.util.find_spec('pdfrw'):
+        cp('build/memodir', 'test/auto')
+        assert run('memoize-extract.py --timings -F latex doc.mmz'.split(), cwd = 'test/auto',
+                   env = {'MEMOIZE_EXTRACT_BACKEND': 'auto'})
+        print('Expecting 1 line in: ', end = '')
+        assert sum(1 for _ in grep(r'^\\PackageInfo{.*}{Timings: .*import pdfrw', 'test/auto/doc.mmz.log')) == 1
+
+for test in Test(['extract-unchanged.py'],
+                 ['memoize-extract.py', 'build/memodir/doc.pdf'],
+                 'Leave identical externs untouched',
+                 "With -k, the second extraction finds the externs already extracted"):
+    import importlib.util
+    for i, options in enumerate(('-k', '-k --raw', '-k --jobs 2',
+                                 '-k --backend pypdf', '-k --backend pikepdf')):
+        if options.startswith('-k --backend') and \
+           not importlib.util.find_spec(options.split()[-1]):
+            continue
+        cp('build/memodir', f'test/{i}')
+        assert run(f'memoize-extract.py {options} doc.mmz'.split(), cwd = f'test/{i}')
+        externs = sorted(expand(f'test/{i}/doc.memo.dir/*.pdf'))
+        assert len(externs) == 2
+        mtimes = [os.stat(extern).st_mtime_ns for extern in externs]
+        assert run(f'memoize-extract.py {options} -F latex doc.mmz'.split(), cwd = f'test/{i}')
+        assert [os.stat(extern).st_mtime_ns for extern in externs] == mtimes
+        print('Expecting 1 line in: ', end = '')
+        assert sum(1 for _ in grep(r'^\\PackageInfo{.*}{Done \(wrote 0 externs, 0 bytes, in [0-9.]+s; 2 identical externs were left untouched', f'test/{i}/doc.mmz.log')) == 1
+
+for test in Test(['extract-jobs.py'],
+                 ['memoize-extract.py', 'build/memodir/doc.pdf'],
+                 'Extract from a [memodir] document using extern writer processes'):
+    cp('build/memodir', 'test')
+    # A negative number of jobs is rejected by the argument parser.
+    assert subprocess.run(['python', str(Path.cwd() / 'memoize-extract.py'),
+                           '--jobs', '-1', 'doc.mmz'], cwd = 'test').returncode == 2
+    assert run('memoize-extract.py --jobs 2 doc.mmz'.split(), cwd = 'test')
+    assert diff('expected/extract-memodir/doc.mmz', 'test/doc.mmz')
+    assert exists('test/doc.memo.dir/799CD96D5634EBEB7E30191285AF4082-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf')
+    assert exists('test/doc.memo.dir/7DBC7B29C0C49BCFD5C4A18740E06E80-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf')
+
+for test in Test(['extract-timings.py'],
+                 ['memoize-extract.py', 'build/memodir/doc.pdf'],
+                 'Record the timings of the extraction phases'):
+    cp('build/memodir', 'test')
+    assert run('memoize-extract.py --timings -F latex doc.mmz'.split(), cwd = 'test')
+    assert diff('expected/extract-memodir/doc.mmz', 'test/doc.mmz')
+    import json
+    with open('test/doc.mmz.timings.json') as f:
+        timings = json.load(f)
+    assert [p for p in timings['phases'] if p['phase'] == 'total']
+    assert len(timings['externs']) == 2
+    print('Expecting 1 line in: ', end = '')
+    assert sum(1 for _ in grep(r'^\\PackageInfo{.*}{Timings: total', 'test/doc.mmz.log')) == 1
+
+for test in Test(['extract-synthetic.py'],
+                 ['memoize-extract.py', 'memoize-clean.py', 'synthetic_corpus.py'],
+                 'Extract from and clean a synthetic corpus',
+                 "The corpus is generated without TeX"):
+    from synthetic_corpus import generate
+    externs = generate('test', externs = 30, image_size = 1024, stale = 5)
+    assert run('memoize-extract.py --no-server -q doc.mmz'.split(), cwd = 'test')
+    assert all(exists(extern) for extern in externs)
+    assert run('memoize-clean.py -y -q doc.mmz'.split(), cwd = 'test')
+    assert len(list(expand('test/doc.memo.dir/*'))) == 3 * 30
+
+for test in Test(['extract-batch.py'],
+                 ['memoize-extract.py', 'build/nomemodir/doc.pdf',
+                  'build/memodir with spaces/doc with spaces.pdf'],
+                 'Extract from several documents in one invocation',
+                 "The second document is given by a manifest"):
+    cp('build/nomemodir', 'test')
+    cp('build/memodir with spaces', 'test')
+    with open('test/manifest', 'w') as manifest:
+        print('# document\tPDF', file = manifest)
+        print('doc with spaces.mmz\tdoc with spaces.pdf', file = manifest)
+    assert run('memoize-extract.py -F latex --jobs 2 --manifest manifest doc.mmz'.split(),
+               cwd = 'test')
+    assert diff('expected/extract-nomemodir/doc.mmz', 'test/doc.mmz')
+    assert diff('expected/extract-memodir-with-spaces/doc with spaces.mmz', 'test/doc with spaces.mmz')
+    assert exists('test/doc.mmz.log')
+    assert exists('test/doc with spaces.mmz.log')
+    assert exists('test/doc.799CD96D5634EBEB7E30191285AF4082-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf')
+    assert exists('test/doc with spaces.memo.dir/prefix with spaces.799CD96D5634EBEB7E30191285AF4082-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf')
+    # A missing manifest is reported as an error, not by a traceback.
+    result = subprocess.run(['python', str(Path.cwd() / 'memoize-extract.py'),
+                             '--manifest', 'missing', 'doc.mmz'],
+                            cwd = 'test', capture_output = True, text = True)
+    print(result.stdout + result.stderr)
+    assert result.returncode == 11
+    assert "I cannot read manifest 'missing'" in result.stdout
+    assert 'Traceback' not in result.stderr
+
+for test in Test(['extract-prune.py'],
+                 ['memoize-extract.py', 'build/nomemodir/doc.pdf'],
+                 'Prune the extern pages out of the document',
+                 "By appending an incremental update, and by rewriting the PDF"):
+    import pdfrw
+    for option in ('--prune', '--prune-rewrite'):
+        cp('build/nomemodir', 'test')
+        assert run(['memoize-extract.py', option, 'doc.mmz'], cwd = 'test')
+        assert diff('expected/extract-nomemodir/doc.mmz', 'test/doc.mmz')
+        assert len(pdfrw.PdfReader('test/doc.pdf').pages) == 1
+        if option == '--prune':
+            original = Path('build/nomemodir/doc.pdf').read_bytes()
+            assert Path('test/doc.pdf').read_bytes().startswith(original)
+    # The page tree nodes of a PDF with object streams get new numbers in the
+    # incremental update; the remaining pages must point to them.
+    import importlib.util
+    if importlib.util.find_spec('pikepdf'):
+        import pikepdf
+        cp('build/nomemodir', 'test/objstm')
+        with pikepdf.open('build/nomemodir/doc.pdf') as pdf:
+            pdf.save('test/objstm/doc.pdf',
+                     object_stream_mode = pikepdf.ObjectStreamMode.generate)
+        assert run('memoize-extract.py --lazy --prune doc.mmz'.split(), cwd = 'test/objstm')
+        with pikepdf.open('test/objstm/doc.pdf') as pdf:
+            assert len(pdf.pages) == 1
+            for page in pdf.pages:
+                node = page.obj
+                while b'/Parent' in node:
+                    assert any(kid.objgen == node.objgen for kid in node.Parent.Kids)
+                    node = node.Parent
+                print(f"Page tree root: {node.objgen}, /Pages: {pdf.Root.Pages.objgen}")
+                assert node.objgen == pdf.Root.Pages.objgen
+
+for test in Test(['extract-journal.py'],
+                 ['memoize-extract.py', 'build/nomemodir/doc.pdf'],
+                 'Mark the extracted externs in a journal',
+                 "The .mmz is left alone, and the second run extracts nothing"):
+    cp('build/nomemodir', 'test')
+    assert run('memoize-extract.py --journal doc.mmz'.split(), cwd = 'test')
+    assert diff('build/nomemodir/doc.mmz', 'test/doc.mmz')
+    print('Expecting 2 lines in: ', end = '')
+    assert sum(1 for _ in grep(r'^\\mmzExtracted{', 'test/doc.mmz.done')) == 2
+    rm('test/doc.*-*.pdf')
+    assert run('memoize-extract.py --journal doc.mmz'.split(), cwd = 'test')
+    assert not exists('test/doc.799CD96D5634EBEB7E30191285AF4082-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf')
+    assert run('memoize-extract.py doc.mmz'.split(), cwd = 'test')
+    assert diff('expected/extract-nomemodir/doc.mmz', 'test/doc.mmz')
+    assert not list(expand('test/*.tmp'))
+
+for test in Test(['clean.py'],
+                 ['memoize-clean.py', 'memoize_mmz.py',
+                  'build/memodir with spaces/doc with spaces.pdf'],
+                 'Clean up a stale memo',
+                 "The paths in the .mmz are quoted"):
+    cp('build/memodir with spaces', 'test')
+    memo_dir = 'test/doc with spaces.memo.dir/prefix with spaces.'
+    Path(memo_dir + 32 * 'F' + '.memo').touch()
+    assert run(['memoize-clean.py', '--yes', 'doc with spaces.mmz'], cwd = 'test')
+    assert not exists(memo_dir + 32 * 'F' + '.memo')
+    assert exists(memo_dir + '7DBC7B29C0C49BCFD5C4A18740E06E80.memo')
+
+for test in Test(['clean-shared.py'],
+                 ['memoize-clean.py', 'build/nomemodir/doc.pdf'],
+                 'Clean up the stale memos of several prefixes in one directory',
+                 "The directory is shared by the document and prefix \"other.\""):
+    cp('build/nomemodir', 'test')
+    for stale in ('doc.', 'other.'):
+        Path('test/' + stale + 32 * 'F' + '.memo').touch()
+    Path('test/unrelated.' + 32 * 'F' + '.memo').touch()
+    assert run('memoize-clean.py --yes -p other. doc.mmz'.split(), cwd = 'test')
+    assert not exists('test/doc.' + 32 * 'F' + '.memo')
+    assert not exists('test/other.' + 32 * 'F' + '.memo')
+    assert exists('test/unrelated.' + 32 * 'F' + '.memo')
+    assert exists('test/doc.7DBC7B29C0C49BCFD5C4A18740E06E80.memo')
+
+for test in Test(['clean-plan.py'],
+                 ['memoize-clean.py', 'build/nomemodir/doc.pdf'],
+                 'Plan the clean-up, then clean up using several threads'):
+    import json
+    cp('build/nomemodir', 'test')
+    for stale in ('doc.' + 32 * 'E', 'doc.' + 32 * 'F'):
+        Path('test/' + stale + '.memo').write_text('stale')
+    with open('tmp/plan.json', 'w') as plan:
+        assert run('memoize-clean.py --plan json doc.mmz'.split(), cwd = 'test',
+                   stdout = plan)
+    plan = json.loads(Path('tmp/plan.json').read_text())
+    assert plan['files_total'] == 2 and plan['size_total'] == 10
+    assert exists('test/doc.' + 32 * 'F' + '.memo')
+    # A negative number of jobs is rejected by the argument parser.
+    assert subprocess.run(['python', str(Path.cwd() / 'memoize-clean.py'),
+                           '--yes', '--jobs', '-1', 'doc.mmz'], cwd = 'test').returncode == 2
+    assert exists('test/doc.' + 32 * 'E' + '.memo')
+    assert run('memoize-clean.py --yes --jobs 2 doc.mmz'.split(), cwd = 'test')
+    assert not exists('test/doc.' + 32 * 'E' + '.memo')
+    assert not exists('test/doc.' + 32 * 'F' + '.memo')
+    assert exists('test/doc.7DBC7B29C0C49BCFD5C4A18740E06E80.memo')
+
+for test in Test(['clean-budget.py'],
+                 ['memoize-clean.py', 'build/nomemodir/doc.pdf'],
+                 'Evict the least recently used memo groups',
+                 "A group unused for ten days is evicted by --max-age; "
+                 "--max-size 0 evicts everything"):
+    import json
+    cp('build/nomemodir', 'test')
+    old = time.time() - 10 * 86400
+    for name in (32 * 'E' + '.memo', 32 * 'E' + '-' + 32 * 'F' + '.memo'):
+        Path('test/doc.' + name).touch()
+        os.utime('test/doc.' + name, (old, old))
+    assert run('memoize-clean.py --yes --max-age 5d doc.mmz'.split(), cwd = 'test')
+    assert not exists('test/doc.' + 32 * 'E' + '.memo')
+    assert not exists('test/doc.' + 32 * 'E' + '-' + 32 * 'F' + '.memo')
+    assert exists('test/doc.7DBC7B29C0C49BCFD5C4A18740E06E80.memo')
+    with open('tmp/plan.json', 'w') as plan:
+        assert run('memoize-clean.py --max-size 0 --plan json doc.mmz'.split(),
+                   cwd = 'test', stdout = plan)
+    plan = json.loads(Path('tmp/plan.json').read_text())
+    assert plan['files_total'] == len(list(expand('test/doc.*.memo')))
+
+for test in Test(['catalog.py'],
+                 ['memoize-extract.py', 'memoize-clean.py', 'memoize_catalog.py',
+                  'build/memodir/doc.pdf'],
+                 'Maintain the catalog of the memos and externs',
+                 "A stale memo unknown to the catalog is only cleaned "
+                 "after rebuilding the catalog"):
+    import sqlite3
+    cp('build/memodir', 'test')
+    assert run('memoize-extract.py --catalog doc.mmz'.split(), cwd = 'test')
+    catalog = 'test/doc.memo.dir/memoize-catalog.db'
+    def catalogued(kind):
+        with sqlite3.connect(catalog) as db:
+            return db.execute('SELECT count(*) FROM files WHERE kind = ?',
+                              (kind,)).fetchone()[0]
+    assert catalogued('extern') == 2
+    stale = 'test/doc.memo.dir/' + 32 * 'F' + '.memo'
+    Path(stale).touch()
+    assert run('memoize-clean.py --yes --catalog doc.mmz'.split(), cwd = 'test')
+    assert exists(stale)
+    assert run('memoize-clean.py --yes --rebuild-catalog doc.mmz'.split(),
+               cwd = 'test')
+    assert not exists(stale)
+    assert catalogued('extern') == 2
+
+for test in Test(['store.py'],
+                 ['memoize-extract.py', 'memoize-clean.py', 'build/memodir/doc.pdf'],
+                 'Share the memos and externs through a global store',
+                 "Publish, materialize a lost extern, and collect the garbage "
+                 "once the document is gone"):
+    cp('build/memodir', 'test')
+    store = str(Path.cwd() / 'tmp/store')
+    shutil.rmtree(store, ignore_errors = True)
+    # There is no garbage in a store which does not exist yet.
+    assert run(['memoize-clean.py', '--yes', '--gc-store', store])
+    extern = '799CD96D5634EBEB7E30191285AF4082-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf'
+    assert run(['memoize-extract.py', '--store', store, 'doc.mmz'], cwd = 'test')
+    assert os.stat(f'{store}/79/{extern}').st_nlink == 2
+    rm(f'test/doc.memo.dir/{extern}')
+    assert run(['memoize-extract.py', '--store', store, 'doc.mmz'], cwd = 'test')
+    assert exists(f'test/doc.memo.dir/{extern}')
+    assert run(['memoize-clean.py', '--yes', '--gc-store', store])
+    assert exists(f'{store}/79/{extern}')
+    shutil.rmtree('test/doc.memo.dir')
+    assert run(['memoize-clean.py', '--yes', '--gc-store', store])
+    assert not exists(f'{store}/79/{extern}')
+
+for test in Test(['remote.py'],
+                 ['memoize-extract.py', 'memoize_remote.py', 'build/memodir/doc.pdf'],
+                 'Push to and pull from a remote cache',
+                 "Through the HTTP server, and through a directory"):
+    cp('build/memodir', 'test')
+    cache = Path.cwd() / 'tmp/remote'
+    shutil.rmtree(cache, ignore_errors = True)
+    server = subprocess.Popen(['python', 'memoize_remote.py', 'serve', str(cache)],
+                              stdout = subprocess.PIPE, text = True)
+    try:
+        url = server.stdout.readline().split()[-1]
+        for location in (url, str(Path.cwd() / 'tmp/remote-dir')):
+            assert run(['memoize-extract.py', '--remote', location, 'doc.mmz'],
+                       cwd = 'test')
+            assert len(list(expand('tmp/remote/*/*'))) == 6
+            shutil.rmtree('test/doc.memo.dir')
+            assert run(['memoize_remote.py', 'pull', location, 'doc.mmz'],
+                       cwd = 'test')
+            assert len(list(expand('test/doc.memo.dir/*'))) == 6
+    finally:
+        server.send_signal(signal.SIGINT)
+        server.wait()
+
+for test in Test(['remote-malformed.py'],
+                 ['memoize-extract.py', 'memoize_remote.py', 'build/memodir/doc.pdf'],
+                 'Survive a remote cache sending a malformed response',
+                 "Pushing only yields a warning (exit code 10), and pulling "
+                 "succeeds"):
+    import socketserver, threading
+    class Malformed(socketserver.BaseRequestHandler):
+        def handle(self):
+            self.request.recv(65536)
+            self.request.sendall(b'HELLO\r\n\r\n')
+    cp('build/memodir', 'test')
+    with socketserver.ThreadingTCPServer(('127.0.0.1', 0), Malformed) as server:
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        url = f'http://127.0.0.1:{server.server_address[1]}/'
+        try:
+            rc = subprocess.run(['python', str(Path.cwd() / 'memoize-extract.py'),
+                                 '--remote', url, 'doc.mmz'], cwd = 'test').returncode
+            print(f"Exit code: {rc}")
+            assert rc == 10
+            assert exists('test/doc.memo.dir/799CD96D5634EBEB7E30191285AF4082-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf')
+            shutil.rmtree('test/doc.memo.dir')
+            assert run(['memoize_remote.py', 'pull', url, 'doc.mmz'], cwd = 'test')
+        finally:
+            server.shutdown()
+
+for test in Test(['archive.py'],
+                 ['memoize-extract.py', 'memoize_archive.py', 'build/memodir/doc.pdf'],
+                 'Export and import the memos and externs of a document',
+                 "The second import skips the identical files"):
+    cp('build/memodir', 'test')
+    assert run('memoize-extract.py doc.mmz'.split(), cwd = 'test')
+    archive = str(Path.cwd() / 'tmp/doc.mmza')
+    assert run(['memoize_archive.py', 'export', archive, 'doc.mmz'], cwd = 'test')
+    shutil.rmtree('test/doc.memo.dir')
+    with open('tmp/import.log', 'w') as log:
+        for _ in range(2):
+            assert run(['memoize_archive.py', 'import', archive], cwd = 'test',
+                       stderr = log)
+    assert len(list(expand('test/doc.memo.dir/*'))) == 6
+    print('Expecting 1 line in: ', end = '')
+    assert sum(1 for _ in grep(r'^Imported 0 files, skipped 6', 'tmp/import.log')) == 1
+
+for test in Test(['archive-outside.py'],
+                 ['memoize-extract.py', 'memoize_archive.py', 'build/memodir/doc.pdf'],
+                 'Archive a memo directory outside the current directory',
+                 "Export refuses the files outside the base directory, and import "
+                 "writes nothing from an archive with an unsafe path"):
+    import memoize_archive
+    cp('build/memodir', 'test/doc')
+    assert run('memoize-extract.py doc.mmz'.split(), cwd = 'test/doc')
+    mv('test/doc/doc.memo.dir', 'test/shared')
+    mmz = Path('test/doc/doc.mmz')
+    mmz.write_text(mmz.read_text().replace('doc.memo.dir/', '../shared/'))
+    archive = str(Path.cwd() / 'tmp/doc.mmza')
+    assert not run(['memoize_archive.py', 'export', archive, 'doc.mmz'], cwd = 'test/doc')
+    assert run(['memoize_archive.py', 'export', '-C', '..', archive, 'doc.mmz'],
+               cwd = 'test/doc')
+    shutil.rmtree('test/shared')
+    assert run(['memoize_archive.py', 'import', '-C', '..', archive], cwd = 'test/doc')
+    assert len(list(expand('test/shared/*'))) == 6
+    # An archive whose second entry would leave the target directory.
+    with open('tmp/unsafe.mmza', 'wb') as f:
+        memoize_archive.export(f, [('test/doc/doc.mmz', 'first.mmz'),
+                                   ('test/doc/doc.mmz', '../second.mmz')])
+    # From a file, the index is checked upfront; from a pipe, the first entry
+    # is staged, and removed once the second one is found unsafe.
+    assert not run(['memoize_archive.py', 'import', '../tmp/unsafe.mmza'], cwd = 'test')
+    assert not run(['memoize_archive.py', 'import', '-'], cwd = 'test',
+                   input = Path('tmp/unsafe.mmza').read_bytes())
+    assert not exists('test/first.mmz')
+    assert not list(expand('test/*.tmp'))
+
+for test in Test(['dedup.py'],
+                 ['memoize-extract.py', 'memoize-clean.py', 'memoize_dedup.py',
+                  'build/memodir/doc.pdf'],
+                 'Store the identical externs once',
+                 "An extracted extern is linked to its identical copy of another "
+                 "context, and survives the cleanup of the copy"):
+    cp('build/memodir', 'test')
+    cp('build/memodir', 'tmp')
+    assert run('memoize-extract.py -k doc.mmz'.split(), cwd = 'tmp')
+    extern = 'test/doc.memo.dir/799CD96D5634EBEB7E30191285AF4082-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf'
+    copy = 'test/doc.memo.dir/799CD96D5634EBEB7E30191285AF4082-' + 32 * 'F' + '.pdf'
+    shutil.copyfile(extern.replace('test/', 'tmp/'), copy)
+    assert run('memoize-extract.py --dedup -F latex doc.mmz'.split(), cwd = 'test')
+    assert os.path.samefile(extern, copy)
+    print('Expecting 1 line in: ', end = '')
+    assert sum(1 for _ in grep(r'^\\PackageInfo{.*}{Deduplicated 1 identical extern, reclaiming [1-9]', 'test/doc.mmz.log')) == 1
+    # Deduplicate an existing directory.
+    rm(extern)
+    shutil.copyfile(copy, extern)
+    assert run('memoize_dedup.py dedup -n doc.memo.dir'.split(), cwd = 'test')
+    assert not os.path.samefile(extern, copy)
+    assert run('memoize_dedup.py dedup doc.memo.dir'.split(), cwd = 'test')
+    assert os.path.samefile(extern, copy)
+    # The copy is stale, but removing it leaves the extern intact.
+    assert run('memoize-clean.py --yes doc.mmz'.split(), cwd = 'test')
+    assert not exists(copy)
+    assert filecmp.cmp(extern, extern.replace('test/', 'tmp/'), shallow = False)
+
+for test in Test(['dedup-store.py'],
+                 ['memoize-extract.py', 'memoize-clean.py', 'memoize_dedup.py',
+                  'build/memodir/doc.pdf'],
+                 'Collect the deduplicated externs in the global store',
+                 "The store entries of identical externs are hard links of "
+                 "each other, but are collected once the document is gone"):
+    cp('build/memodir', 'test')
+    store = str(Path.cwd() / 'tmp/store')
+    # Extract page 2 also under another context.
+    code, context = '799CD96D5634EBEB7E30191285AF4082', 32 * 'F'
+    Path(f'test/doc.memo.dir/{code}-{context}.memo').touch()
+    with open('test/doc.mmz') as mmz:
+        lines = mmz.readlines()
+    with open('test/doc.mmz', 'w') as mmz:
+        for line in lines:
+            mmz.write(line)
+            if line.startswith(rf'\mmzNewExtern {{doc.memo.dir/{code}'):
+                mmz.write(line.replace('E778DCCCB8AAB0BBD3F6CFEEFD2421F8', context))
+    assert run(['memoize-extract.py', '--dedup', '--store', store, 'doc.mmz'], cwd = 'test')
+    assert os.path.samefile(f'{store}/79/{code}-E778DCCCB8AAB0BBD3F6CFEEFD2421F8.pdf',
+                            f'{store}/79/{code}-{context}.pdf')
+    assert run(['memoize-clean.py', '--yes', '--gc-store', store])
+    assert exists(f'{store}/79/{code}-{context}.pdf')
+    shutil.rmtree('test/doc.memo.dir')
+    assert run(['memoize-clean.py', '--yes', '--gc-store', store])
+    assert not list(expand(f'{store}/*/*'))
+
+for test in Test(['extract-noop.py'],
+                 ['memoize-extract.py', 'expected/extract-nomemodir/doc.mmz'],
+                 'Wall-clock time of extraction with nothing to extract',
+                 "The PDF is not even looked for (and here, it does not exist)"):
+    budget = 0.25 # seconds
+    cp('expected/extract-nomemodir/doc.mmz', 'test')
+    env = {'MEMOIZE_CACHE_DIR': str(Path.cwd() / 'tmp')}
+    # Populate the kpathsea cache.
+    assert run('memoize-extract.py -F latex doc.mmz'.split(), cwd = 'test', env = env)
+    import time
+    elapsed = []
+    for _ in range(5):
+        start = time.perf_counter()
+        assert run('memoize-extract.py -F latex doc.mmz'.split(), cwd = 'test', env = env)
+        elapsed.append(time.perf_counter() - start)
+    print(f'Best wall-clock time: {min(elapsed):.3f} s')
+    assert min(elapsed) < budget, f'Wall-clock time over budget ({budget} s)'
+    print('Expecting 1 line in: ', end = '')
+    assert sum(1 for _ in grep(r'^\\PackageInfo{.*}{Done \(there was nothing to extract\)}', 'test/doc.mmz.log')) == 1
+    print('Expecting 0 lines in: ', end = '')
+    assert sum(1 for _ in grep(r'.*doc\.pdf', 'test/doc.mmz.log')) == 0
+
+for test in Test(['startup.py'],
+                 ['memoize-extract.py', 'expected/extract-nomemodir/doc.mmz'],
+                 'Startup time',
+                 "--version, --mkdir and extraction with nothing to extract "
+                 "should only import the bare necessities"):
+    budget = 0.1 # seconds
+    cp('expected/extract-nomemodir/doc.mmz', 'test')
+    env = {'MEMOIZE_CACHE_DIR': str(Path.cwd() / 'tmp')}
+    # Populate the kpathsea cache.
+    import_times(['memoize-extract.py', '--mkdir', 'foo'], cwd = 'test', env = env)
+    for args, unwanted in (
+            (['--version'], {'subprocess', 'pdfrw'}),
+            (['--mkdir', 'bar'], {'argparse', 'subprocess', 'pdfrw'}),
+            (['doc.mmz'], {'subprocess', 'pdfrw'}),
+    ):
+        unwanted.update({'traceback', 'platform', 'socket', 'tempfile'})
+        modules, total = import_times(['memoize-extract.py'] + args,
+                                      cwd = 'test', env = env)
+        assert not modules & unwanted, f'Unwanted imports: {modules & unwanted}'
+        assert total < budget, f'Import time over budget ({budget} s)'
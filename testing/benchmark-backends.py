@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+# Compare the PDF backends of memoize-extract.py (option --backend) on
+# synthetic documents of increasing size (see |synthetic_corpus.py|; no TeX
+# required).  For every installed backend, we time the extraction with the
+# document read in full, and with --lazy; --raw, which bypasses the backend,
+# is included for reference.  We report the best wall-clock time of
+# |--repeat| runs, and the peak resident set size of the script.
+
+from pathlib import Path
+import argparse, importlib.util, os, shutil, subprocess, sys, tempfile, time
+
+here = Path(__file__).absolute().parent
+sys.path.insert(0, str(here))
+from synthetic_corpus import generate
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--sizes', type = int, nargs = '+',
+                    default = [100, 1000, 5000],
+                    help = 'the numbers of externs in the documents')
+parser.add_argument('-p', '--document-pages', type = int, default = 0,
+                    help = 'the number of additional, non-extern pages')
+parser.add_argument('-s', '--image-size', type = int, default = 16 * 1024,
+                    help = 'the size of the image on each page')
+parser.add_argument('-r', '--repeat', type = int, default = 3)
+parser.add_argument('-j', '--jobs', type = int, default = 1)
+args = parser.parse_args()
+
+backends = [backend for backend in ('pdfrw', 'pypdf', 'pikepdf')
+            if importlib.util.find_spec(backend)]
+variants = [(f'{backend}', ['--backend', backend]) for backend in backends] + \
+    [(f'{backend} --lazy', ['--backend', backend, '--lazy'])
+     for backend in backends] + [('--raw', ['--raw'])]
+
+def measure(command, cwd):
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd = cwd, stdout = subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status):
+        sys.exit(f"Command '{' '.join(command)}' failed")
+    return elapsed, usage.ru_maxrss
+
+print(f"Backends found: {', '.join(backends)}")
+print(f"{'externs':>7} {'variant':<16} {'time [s]':>9} {'RSS [MiB]':>10}")
+with tempfile.TemporaryDirectory() as tmp:
+    for size in args.sizes:
+        corpus = Path(tmp) / 'corpus'
+        generate(corpus, externs = size, image_size = args.image_size,
+                 document_pages = args.document_pages)
+        for name, options in variants:
+            best_time = best_rss = None
+            for _ in range(args.repeat):
+                work = Path(tmp) / 'work'
+                shutil.copytree(corpus, work)
+                elapsed, rss = measure(
+                    [sys.executable, str(here / 'memoize-extract.py'),
+                     '--no-server', '-q', '--jobs', str(args.jobs)]
+                    + options + ['doc.mmz'], work)
+                shutil.rmtree(work)
+                best_time = min(best_time or elapsed, elapsed)
+                best_rss = min(best_rss or rss, rss)
+            print(f'{size:>7} {name:<16} {best_time:>9.3f} {best_rss/1024:>10.1f}',
+                  flush = True)
+        shutil.rmtree(corpus)
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+# Benchmark the scaling of memoize-extract.py --jobs.  We generate a synthetic
+# document with many extern pages (see |synthetic_corpus.py|; no TeX
+# required), and time the extraction with an increasing number of extern
+# writer processes.
+
+from pathlib import Path
+import argparse, os, shutil, subprocess, sys, tempfile, time
+
+here = Path(__file__).absolute().parent
+sys.path.insert(0, str(here))
+from synthetic_corpus import generate
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--pages', type = int, default = 1000)
+parser.add_argument('-s', '--image-size', type = int, default = 64 * 1024,
+                    help = 'the size of the (incompressible) image on each page')
+parser.add_argument('-j', '--jobs', type = int, nargs = '+',
+                    default = [1, 2, 4, 8])
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as tmp:
+    source = Path(tmp) / 'source'
+    print(f'Generating {args.pages} pages with {args.image_size} byte images ...')
+    # No images shared by the pages, so that the time to write an extern is
+    # proportional to |--image-size|.
+    generate(source, externs = args.pages, image_size = args.image_size,
+             shared = 0)
+    print(f"{os.cpu_count()} CPUs available")
+    print(f"{'jobs':>5} {'time [s]':>9} {'speedup':>8}")
+    base = None
+    for jobs in args.jobs:
+        work = Path(tmp) / f'jobs{jobs}'
+        shutil.copytree(source, work)
+        start = time.perf_counter()
+        subprocess.run([sys.executable, str(here / 'memoize-extract.py'),
+                        '--no-server', '-q', '--jobs', str(jobs), 'doc.mmz'],
+                       cwd = work, check = True)
+        elapsed = time.perf_counter() - start
+        base = base or elapsed
+        print(f'{jobs:>5} {elapsed:>9.2f} {base/elapsed:>8.2f}')
+        shutil.rmtree(work)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# Benchmark the .mmz parser shared by memoize-extract.py and memoize-clean.py.
+# We generate a synthetic record file (see |synthetic_corpus.py|), and parse
+# it with the parser as used by the two scripts, and with the regular
+# expressions the scripts used before (the baselines).  We report the
+# throughput and the peak memory allocated while parsing, which should not
+# depend on the number of lines.
+
+from pathlib import Path
+import argparse, re, sys, tempfile, time, tracemalloc
+
+sys.path.insert(0, str(Path(__file__).absolute().parent))
+from memoize_mmz import parse_mmz, Prefix, Memo, Extern
+from synthetic_corpus import generate
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--lines', type = int, default = 2000000)
+parser.add_argument('-e', '--new-externs', type = float, default = 0.01,
+                    help = 'the fraction of memoized pieces with a new extern')
+args = parser.parse_args()
+
+# The baselines.
+
+re_prefix = re.compile(r'\\mmzPrefix *{(?P<prefix>.*?)}')
+re_newextern = re.compile(
+    r'\\mmzNewExtern *{(?P<extern_path>.*?)}{(?P<page_n>[0-9]+)}'
+    r'{(?P<expected_width>[0-9.]*)pt}{(?P<expected_height>[0-9.]*)pt}')
+re_memo = re.compile(r'%? *\\mmz(?:New|Used)(?:CC?Memo|Extern) *{(.*?)}')
+re_endinput = re.compile(r' *\\endinput *$')
+
+def extract_baseline(mmz):
+    externs = 0
+    for line in mmz:
+        if re_prefix.match(line):
+            pass
+        elif re_newextern.match(line):
+            externs += 1
+    return externs
+
+# Like |memoize-clean.py|, we construct the paths of the memos and externs
+# (but don't collect them, to measure the memory used by parsing alone).
+def clean_baseline(mmz):
+    files = 0
+    for line in mmz:
+        line = line.strip()
+        if not line:
+            pass
+        elif re_prefix.match(line):
+            pass
+        elif m := re_memo.match(line):
+            mmz_parent / m[1]
+            files += 1
+        elif re_endinput.match(line):
+            pass
+    return files
+
+# The shared parser.
+
+def extract_parser(mmz):
+    externs = 0
+    for text, record in parse_mmz(mmz, pending = True):
+        if record and not isinstance(record, Prefix):
+            externs += 1
+    return externs
+
+def clean_parser(mmz):
+    files = 0
+    for line, record in parse_mmz(mmz):
+        if isinstance(record, (Memo, Extern)):
+            mmz_parent / record.path
+            files += 1
+    return files
+
+with tempfile.TemporaryDirectory() as tmp:
+    mmz_file = Path(tmp) / 'doc.mmz'
+    mmz_parent = mmz_file.parent
+    print(f'Generating {args.lines} lines ...')
+    # Every memoized piece takes three lines, plus the prefix and
+    # |\endinput|.  The document PDF and the memos are a by-product: the
+    # pages are kept small, as only the |.mmz| file is parsed.
+    pieces = max(args.lines - 2, 0) // 3
+    externs = round(pieces * args.new_externs)
+    generate(tmp, externs = externs, image_size = 0, shared = 0,
+             document_pages = 0, used = pieces - externs)
+    lines = 3 * pieces + 2
+    print(f"{'':<20} {'result':>9} {'Mlines/s':>9} {'peak [KiB]':>11}")
+    for name, func in (('extract (baseline)', extract_baseline),
+                       ('extract (parser)', extract_parser),
+                       ('clean (baseline)', clean_baseline),
+                       ('clean (parser)', clean_parser)):
+        # Time without tracing the allocations, which slows things down.
+        with open(mmz_file) as mmz:
+            start = time.perf_counter()
+            result = func(mmz)
+            elapsed = time.perf_counter() - start
+        with open(mmz_file) as mmz:
+            tracemalloc.start()
+            func(mmz)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        print(f'{name:<20} {result:>9} {lines/elapsed/1e6:>9.2f} '
+              f'{peak/1024:>11.0f}')
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+# Benchmark memoize-extract.py and memoize-clean.py on synthetic corpora of
+# increasing size (see |synthetic_corpus.py|; no TeX required).  For every
+# size, we time the extraction, the extraction with |--prune|, and the cleanup
+# of the stale files, and record the peak resident set size of the script.
+# Each operation runs |--repeat| times, on a fresh copy of the corpus, and the
+# best result counts.
+#
+# The baselines depend on the machine, so none are shipped, and comparing to
+# them is opt-in.  Store the results in a baselines file with |--baselines FILE
+# --update|, e.g.\ before a change; later runs with |--baselines FILE| compare
+# the results to the baselines, and fail if an operation got slower, or took
+# more memory, than allowed by the tolerances.
+
+from pathlib import Path
+import argparse, json, os, shutil, subprocess, sys, tempfile, time
+
+here = Path(__file__).absolute().parent
+sys.path.insert(0, str(here))
+from synthetic_corpus import generate
+
+parser = argparse.ArgumentParser()
+parser.add_argument('-n', '--sizes', type = int, nargs = '+',
+                    default = [100, 1000, 5000],
+                    help = 'the numbers of externs in the corpora')
+parser.add_argument('-s', '--image-size', type = int, default = 16 * 1024,
+                    help = 'the size of the image on each page')
+parser.add_argument('--shared', type = int, default = 4,
+                    help = 'the number of images shared by all pages')
+parser.add_argument('--stale', type = float, default = 0.5,
+                    help = 'the number of stale memo groups, '
+                           'as a fraction of the externs')
+parser.add_argument('-r', '--repeat', type = int, default = 3)
+parser.add_argument('-b', '--baselines', type = Path, metavar = 'FILE',
+                    help = 'compare the results to the baselines in FILE')
+parser.add_argument('-u', '--update', action = 'store_true',
+                    help = 'store the results as the new baselines')
+parser.add_argument('--time-tolerance', type = float, default = 0.5,
+                    help = 'the allowed relative slowdown')
+parser.add_argument('--memory-tolerance', type = float, default = 0.2,
+                    help = 'the allowed relative growth of the peak RSS')
+args = parser.parse_args()
+if args.update and not args.baselines:
+    parser.error('option --update requires --baselines')
+
+extract = [sys.executable, str(here / 'memoize-extract.py'), '--no-server', '-q']
+clean = [sys.executable, str(here / 'memoize-clean.py'), '-y', '-q']
+operations = {
+    'extract': [extract + ['doc.mmz']],
+    'prune': [extract + ['--prune', 'doc.mmz']],
+    # The cleanup runs after the extraction, which is not measured.
+    'clean': [extract + ['doc.mmz'], clean + ['doc.mmz']],
+}
+
+# Run the commands in |cwd|, and return the wall-clock time and the peak RSS
+# (in KiB) of the last one.  We wait for the process by |os.wait4|, which
+# reports the resource usage of that process alone.
+def measure(commands, cwd):
+    for command in commands:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd = cwd,
+                                   stdout = subprocess.DEVNULL)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode:
+            sys.exit(f"Command '{' '.join(command)}' failed "
+                     f"with exit code {process.returncode}")
+    return elapsed, usage.ru_maxrss
+
+baselines = {}
+if args.baselines:
+    try:
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        pass
+
+results = {}
+regressions = []
+print(f"{'benchmark':<16} {'time [s]':>9} {'baseline':>9} "
+      f"{'RSS [MiB]':>10} {'baseline':>9}")
+with tempfile.TemporaryDirectory() as tmp:
+    for size in args.sizes:
+        corpus = Path(tmp) / f'corpus{size}'
+        generate(corpus, externs = size, image_size = args.image_size,
+                 shared = args.shared, stale = round(size * args.stale))
+        for operation, commands in operations.items():
+            best_time = best_rss = None
+            for _ in range(args.repeat):
+                work = Path(tmp) / 'work'
+                shutil.copytree(corpus, work)
+                elapsed, rss = measure(commands, work)
+                shutil.rmtree(work)
+                best_time = min(best_time or elapsed, elapsed)
+                best_rss = min(best_rss or rss, rss)
+            name = f'{operation}/{size}'
+            results[name] = {'time': round(best_time, 4), 'rss': best_rss}
+            baseline = baselines.get(name)
+            line = f'{name:<16} {best_time:>9.3f} '
+            line += f"{baseline['time']:>9.3f} " if baseline else f"{'-':>9} "
+            line += f'{best_rss/1024:>10.1f} '
+            line += f"{baseline['rss']/1024:>9.1f}" if baseline else f"{'-':>9}"
+            if baseline and not args.update:
+                if best_time > baseline['time'] * (1 + args.time_tolerance):
+                    regressions.append(f'{name}: time')
+                    line += '  SLOWER'
+                if best_rss > baseline['rss'] * (1 + args.memory_tolerance):
+                    regressions.append(f'{name}: memory')
+                    line += '  MORE MEMORY'
+            print(line, flush = True)
+        shutil.rmtree(corpus)
+
+if args.update:
+    baselines.update(results)
+    with open(args.baselines, 'w') as f:
+        json.dump(baselines, f, indent = 1, sort_keys = True)
+        print(file = f)
+    print(f"Stored the baselines in '{args.baselines}'")
+elif regressions:
+    sys.exit('Regressions: ' + ', '.join(regressions))
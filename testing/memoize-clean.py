@@ -0,0 +1 @@
+../memoize-clean.py
\ No newline at end of file
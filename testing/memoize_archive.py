@@ -0,0 +1 @@
+../memoize_archive.py
\ No newline at end of file
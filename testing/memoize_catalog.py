@@ -0,0 +1 @@
+../memoize_catalog.py
\ No newline at end of file
@@ -0,0 +1 @@
+../memoize_dedup.py
\ No newline at end of file
@@ -0,0 +1 @@
+../memoize_mmz.py
\ No newline at end of file
@@ -0,0 +1 @@
+../memoize_remote.py
\ No newline at end of file
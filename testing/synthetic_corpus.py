@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+# Generate a synthetic Memoize corpus, without TeX: a document PDF with the
+# given number of extern pages, the matching |.mmz| file and memos, and,
+# optionally, stale memos and externs for |memoize-clean.py| to remove, and the
+# records of the memoized pieces used in the compilation.  Every extern page
+# draws an (incompressible) image of its own, and the resources shared by all
+# pages: a font and |shared| images.  The PDF is written directly, a page at a
+# time, so that generating a large corpus takes little memory.  The output is
+# deterministic for a given |seed|.
+#
+# Used by the benchmarks in this directory and by |MakeTests.py|; run this
+# script to generate a corpus to play with.
+
+from pathlib import Path
+import random
+
+# The dimensions of an extern page in PostScript points, and as written into
+# the |.mmz| file by Memoize, in TeX points.
+WIDTH, HEIGHT = 100, 100
+TEX_WIDTH, TEX_HEIGHT = (f'{WIDTH / 72 * 72.27:.5f}',
+                         f'{HEIGHT / 72 * 72.27:.5f}')
+
+class _PdfFile:
+    def __init__(self, f):
+        self.f = f
+        self.offsets = {}
+        f.write(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+
+    def object(self, n, dictionary, stream = None):
+        self.offsets[n] = self.f.tell()
+        if stream is None:
+            self.f.write(f'{n} 0 obj\n{dictionary}\nendobj\n'.encode())
+        else:
+            self.f.write(f'{n} 0 obj\n<< {dictionary} /Length {len(stream)} >>'
+                         f'\nstream\n'.encode())
+            self.f.write(stream)
+            self.f.write(b'\nendstream\nendobj\n')
+
+    def close(self, root):
+        xref = self.f.tell()
+        size = max(self.offsets) + 1
+        self.f.write(f'xref\n0 {size}\n0000000000 65535 f \n'.encode())
+        for n in range(1, size):
+            self.f.write(f'{self.offsets[n]:010} 00000 n \n'.encode())
+        self.f.write(f'trailer\n<< /Size {size} /Root {root} 0 R >>\n'
+                     f'startxref\n{xref}\n%%EOF\n'.encode())
+
+def _image(rng, size):
+    # An RGB image 8 pixels high, as wide as needed to take |size| bytes.
+    width = max(size // 24, 1)
+    return (f'/Type /XObject /Subtype /Image /Width {width} /Height 8 '
+            f'/ColorSpace /DeviceRGB /BitsPerComponent 8',
+            rng.randbytes(width * 24))
+
+# Generate the corpus of document |name| in |directory|, and return the paths
+# of the externs which extraction should produce.
+def generate(directory, externs = 100, image_size = 16 * 1024, shared = 4,
+             shared_size = 64 * 1024, document_pages = 1, stale = 0,
+             used = 0, memo_dir = True, name = 'doc', seed = 0):
+    directory = Path(directory)
+    directory.mkdir(parents = True, exist_ok = True)
+    rng = random.Random(seed)
+    prefix = f'{name}.memo.dir/' if memo_dir else f'{name}.'
+    (directory / f'{prefix}x').parent.mkdir(exist_ok = True)
+    n_pages = externs + document_pages
+    # Objects 1 and 2 are the catalog and the page tree, object 3 is the
+    # shared font, followed by the shared images, and then by three objects
+    # (page, content, image) for each page.
+    first_page = 4 + shared
+    page_objects = [first_page + 3 * i for i in range(n_pages)]
+    resources = ('/Font << /F1 3 0 R >> /XObject << ' +
+                 ' '.join(f'/S{i} {4 + i} 0 R' for i in range(shared)))
+    shared_draw = ' '.join(f'q 10 0 0 10 {i * 10} 0 cm /S{i} Do Q'
+                           for i in range(shared))
+    paths = []
+    n_used = 0
+    with open(directory / f'{name}.pdf', 'wb') as f, \
+         open(directory / f'{name}.mmz', 'w') as mmz:
+        pdf = _PdfFile(f)
+        pdf.object(1, '<< /Type /Catalog /Pages 2 0 R >>')
+        pdf.object(2, '<< /Type /Pages /Kids [' +
+                   ' '.join(f'{n} 0 R' for n in page_objects) +
+                   f'] /Count {n_pages} >>')
+        pdf.object(3, '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>')
+        for i in range(shared):
+            pdf.object(4 + i, *_image(rng, shared_size))
+        print(rf'\mmzPrefix {{{prefix}}}', file = mmz)
+        for page, obj in enumerate(page_objects):
+            content = (f'q {WIDTH} 0 0 {HEIGHT} 0 0 cm /Im Do Q {shared_draw} '
+                       f'BT /F1 12 Tf 10 10 Td (page {page + 1}) Tj ET')
+            pdf.object(obj, f'<< /Type /Page /Parent 2 0 R '
+                       f'/MediaBox [0 0 {WIDTH} {HEIGHT}] '
+                       f'/Contents {obj + 1} 0 R /Resources << {resources} '
+                       f'/Im {obj + 2} 0 R >> >> >>')
+            pdf.object(obj + 1, '', content.encode())
+            pdf.object(obj + 2, *_image(rng, image_size))
+            if page < externs:
+                code, context = f'{page:032X}', f'{seed:032X}'
+                _memos(directory, prefix, code, context, mmz)
+                extern = f'{prefix}{code}-{context}.pdf'
+                print(rf'\mmzNewExtern {{{extern}}}{{{page + 1}}}'
+                      rf'{{{TEX_WIDTH}pt}}{{{TEX_HEIGHT}pt}}', file = mmz)
+                paths.append(directory / extern)
+                # The used pieces are spread evenly among the new externs.
+                n_used = _used(prefix, externs + stale, n_used,
+                               used * (page + 1) // externs, seed, mmz)
+        _used(prefix, externs + stale, n_used, used, seed, mmz)
+        print(r'\endinput', file = mmz)
+        pdf.close(1)
+    # The stale memos and externs, left over from the previous compilations.
+    for i in range(stale):
+        code, context = f'{externs + i:032X}', f'{seed + 1:032X}'
+        _memos(directory, prefix, code, context)
+        (directory / f'{prefix}{code}-{context}.pdf').write_bytes(
+            rng.randbytes(image_size))
+    return paths
+
+# Write the records of the used memoized pieces |start| to |end| (excluding),
+# i.e.\ the pieces produced by a previous compilation, and return |end|.  Only
+# the records are written, not the files.
+def _used(prefix, first, start, end, seed, mmz):
+    context = f'{seed:032X}'
+    for i in range(start, end):
+        code = f'{first + i:032X}'
+        print(rf'\mmzUsedCMemo {{{prefix}{code}.memo}}', file = mmz)
+        print(rf'\mmzUsedCCMemo {{{prefix}{code}-{context}.memo}}', file = mmz)
+        print(rf'\mmzUsedExtern {{{prefix}{code}-{context}.pdf}}', file = mmz)
+    return end
+
+def _memos(directory, prefix, code, context, mmz = None):
+    for cc, memo, text in (
+            ('C', f'{prefix}{code}.memo', r'\mmzMemo'),
+            ('CC', f'{prefix}{code}-{context}.memo',
+             rf'\mmzIncludeExtern{{{code}-{context}}}')):
+        (directory / memo).write_text(text + '\n')
+        if mmz:
+            print(rf'\mmzNew{cc}Memo {{{memo}}}', file = mmz)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description = 'Generate a synthetic Memoize corpus.')
+    parser.add_argument('directory')
+    parser.add_argument('-n', '--externs', type = int, default = 100)
+    parser.add_argument('-s', '--image-size', type = int, default = 16 * 1024,
+                        help = 'the size of the image on each page')
+    parser.add_argument('--shared', type = int, default = 4,
+                        help = 'the number of images shared by all pages')
+    parser.add_argument('--shared-size', type = int, default = 64 * 1024)
+    parser.add_argument('--document-pages', type = int, default = 1)
+    parser.add_argument('--stale', type = int, default = 0,
+                        help = 'the number of stale memo groups')
+    parser.add_argument('--used', type = int, default = 0,
+                        help = 'the number of used memoized pieces (only '
+                               'listed in the .mmz file)')
+    parser.add_argument('--no-memo-dir', dest = 'memo_dir',
+                        action = 'store_false')
+    parser.add_argument('--name', default = 'doc')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+    generate(**vars(args))
@@ -2,7 +2,7 @@
 
 from memoize_extract import *
 import memoize_extract
-import shutil, stat, pathlib, platform
+import shutil, stat, pathlib, platform, itertools, subprocess
 
 on_windows = platform.system() == 'Windows'
 
@@ -444,4 +444,54 @@ if not on_windows: # Directories don't have permissions on Windows.
         test(access_out, tmp / 'foo/bar/..', True)
         test(access_out, tmp / 'foo/bar/../..', False)
 
+# Directory listings: with the listings enabled, find_in, find_out and
+# access_out should give the same results as without them, twice.
+with Test('od', 'tmp'):
+    for f in ('cur.txt', 'od/od.txt', 'tmp/tmp.txt', 'od/both.txt', 'both.txt'):
+        create(f)
+    mkdir('memo.dir')
+    create('memo.dir/memo.txt')
+    if not on_windows:
+        chmod('-r', 'both.txt')
+        chmod('-w', 'od/both.txt')
+        os.symlink('does-not-exist', 'broken.txt')
+    files = [Path(f) for f in ('cur.txt', 'od.txt', 'tmp.txt', 'both.txt',
+                               'none.txt', 'broken.txt', 'memo.dir',
+                               'memo.dir/memo.txt', 'memo.dir/none.txt',
+                               'none.dir/none.txt')]
+    def resolve():
+        return [(find_in(f), find_out(f), access_out(f)) for f in files]
+    expected = resolve()
+    memoize_extract.listings = DirectoryListings(enabled = True)
+    try:
+        for _ in range(2):
+            result = resolve()
+            print(f'{result == expected} (saved {memoize_extract.listings.saved})')
+            assert result == expected, f'Expected: {expected}'
+        assert memoize_extract.listings.saved > 0
+    finally:
+        memoize_extract.listings = DirectoryListings()
+
+# The kpathsea cache: once the cache is populated, kpsewhich should not be
+# executed again.
+with Test(None, None):
+    os.environ['MEMOIZE_CACHE_DIR'] = str(Path('cache').absolute())
+    memoize_extract.kpathsea()
+    assert Path('cache/kpathsea.json').exists()
+    probed = (memoize_extract.openin_any, memoize_extract.openout_any,
+              memoize_extract.texmfoutput_setting)
+    subprocess_run = subprocess.run
+    def no_subprocess(*args, **kwargs):
+        raise TestError()
+    subprocess.run = no_subprocess
+    try:
+        memoize_extract.kpathsea()
+    finally:
+        subprocess.run = subprocess_run
+        del os.environ['MEMOIZE_CACHE_DIR']
+    cached = (memoize_extract.openin_any, memoize_extract.openout_any,
+              memoize_extract.texmfoutput_setting)
+    print(f'kpathsea() --> {cached} (cached)')
+    assert cached == probed, f'Expected: {probed}'
+
 print('Done.')